@@ -0,0 +1,318 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+benchmarks.deploy_stages
+========================
+
+Measures the deployment stages offline: a synthetic repository is served by a local server
+imitating the github tarball endpoint, and images and containers are created on a fake docker
+daemon listening on a UNIX socket. Repositories are generated from a seed, so runs with the
+same parameters are comparable.
+
+    python benchmarks/deploy_stages.py [--files 2000] [--size-mb 20] [--repeat 5] [--stages fetch,unpack]
+                                       [--output results.json] [--compare baseline.json] [--max-regression 10]
+"""
+import io
+import os
+import sys
+import gzip
+import json
+import random
+import shutil
+import logging
+import tarfile
+import argparse
+import platform
+import tempfile
+import statistics
+import time
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+SOURCE_PATH = os.path.join(BENCHMARKS_PATH, os.pardir, "src", "main", "python")
+# The fake github and docker servers are shared with the unit tests
+FAKES_PATH = os.path.join(BENCHMARKS_PATH, os.pardir, "src", "unittest", "python")
+sys.path[:0] = [os.path.abspath(SOURCE_PATH), os.path.abspath(FAKES_PATH)]
+
+from docker import APIClient  # noqa: E402
+from fake_docker import FakeDockerServer, API_VERSION  # noqa: E402
+from fake_github import FakeGithubServer  # noqa: E402
+from shippy import repository_archive, utils  # noqa: E402
+from shippy.container_stack import ContainerStack, terminate_stacks  # noqa: E402
+from shippy.data_volume import DataVolume  # noqa: E402
+from shippy.downloader import Downloader  # noqa: E402
+from shippy.engine_stack import EngineStack  # noqa: E402
+
+STAGES = ("fetch", "fetch_extract", "unpack", "context_directory", "context_stream", "compose_render", "start")
+REPOSITORY_URL = "https://github.com/shippy-bench/app"
+SHA = "0123456789abcdef0123456789abcdef01234567"
+FILES_PER_DIRECTORY = 50
+
+
+def synthetic_archive(files, size_bytes, seed=0):
+    """
+    Generates a github style tarball, with every file under a <user>-<repo>-<sha> directory.
+    Half of each file is random and half repeated text, so it compresses like sourcecode
+    with some binary assets. The output only depends on the arguments.
+
+    :param files: (int) Number of files
+    :param size_bytes: (int) Total uncompressed size of the files
+    :param seed: (int) Random seed. Default: 0
+    :return: (tuple) Gzipped tarball bytes, and the uncompressed size of its files
+    """
+    rng = random.Random(seed)
+    prefix = "shippy-bench-app-{0}".format(SHA[:7])
+    file_size = max(size_bytes // max(files, 1), 1)
+    text = b"module.exports = function () { return 'shippy'; };\n"
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.PAX_FORMAT) as archive:
+        directories = set()
+        for index in range(files):
+            directory = "{0}/lib/d{1:04d}".format(prefix, index // FILES_PER_DIRECTORY)
+            for path in (prefix, prefix + "/lib", directory):
+                if path not in directories:
+                    directories.add(path)
+                    info = tarfile.TarInfo(path)
+                    info.type, info.mode, info.mtime = tarfile.DIRTYPE, 0o755, 0
+                    archive.addfile(info)
+            random_part = file_size // 2
+            payload = rng.getrandbits(random_part * 8).to_bytes(random_part, "little") if random_part else b""
+            payload += (text * (file_size // len(text) + 1))[:file_size - random_part]
+            info = tarfile.TarInfo("{0}/f{1:06d}.js".format(directory, index))
+            info.size, info.mode, info.mtime = len(payload), 0o644, 0
+            archive.addfile(info, io.BytesIO(payload))
+    return gzip.compress(buffer.getvalue(), compresslevel=6, mtime=0), file_size * files
+
+
+class BenchmarkEnvironment:
+    """
+    The servers and working directories shared by the stage benchmarks
+    """
+
+    def __init__(self, workdir, files, size_bytes, seed=0, latency=0.0, create_delay=0.0):
+        """
+        Constructor
+
+        :param workdir: (str) Scratch directory, removed by close()
+        :param files: (int) Number of files in the synthetic repository
+        :param size_bytes: (int) Uncompressed size of the synthetic repository
+        :param seed: (int) Random seed of the repository contents. Default: 0
+        :param latency: (float) Seconds the github server waits before each response. Default: 0
+        :param create_delay: (float) Seconds the docker server takes per container. Default: 0
+        """
+        self.workdir = workdir
+        self.files = files
+        self.archive, self.size_bytes = synthetic_archive(files, size_bytes, seed=seed)
+        self.config = {
+            "app_name": "app",
+            "application_repository": REPOSITORY_URL,
+            "application_image": "shippy-bench/app",
+            "application_config": {"NODE_ENV": "production"},
+            "application_source_mountpoint": "/usr/src/app",
+            "database_image": "mysql",
+            "database_config": {"MYSQL_DATABASE": "app"},
+        }
+        self.github = FakeGithubServer({"/repos/shippy-bench/app/tarball/" + SHA: self.archive},
+                                       chunk_size=64 * 1024, latency=latency).start()
+        repository_archive.GITHUB_API_BASEURL = self.github.base_url
+        self.repo = repository_archive.RepositoryArchive(REPOSITORY_URL, downloader=Downloader(backoff=0, progress=False))
+        self.docker = FakeDockerServer(os.path.join(workdir, "docker.sock"), create_delay=create_delay,
+                                       images=[self.config["application_image"], self.config["database_image"], "busybox"]).start()
+        self.client = APIClient(base_url=self.docker.base_url, version=API_VERSION)
+        # Called after each measured run, outside the measurement
+        self.teardown = []
+
+        # Fixtures for the stages which don't download or unpack themselves
+        self.archive_path = os.path.join(workdir, "fixture", "app.tar.gz")
+        os.makedirs(os.path.dirname(self.archive_path))
+        with open(self.archive_path, "wb") as f:
+            f.write(self.archive)
+        self.source_dir = utils.unpack_archive(self.archive_path, "app", working_dir=os.path.dirname(self.archive_path))
+
+    def scratch(self, name):
+        path = os.path.join(self.workdir, name)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        return path
+
+    def close(self):
+        self.client.close()
+        self.docker.stop()
+        self.github.stop()
+
+
+def bench_fetch(env, scratch):
+    env.repo.fetch(SHA, download_path=scratch)
+    return len(env.archive), "bytes"
+
+
+def bench_fetch_extract(env, scratch):
+    env.repo.fetch_extract(SHA, os.path.join(scratch, "app"))
+    return len(env.archive), "bytes"
+
+
+def bench_unpack(env, scratch):
+    utils.unpack_archive(env.archive_path, "app", working_dir=scratch)
+    return env.files, "files"
+
+
+def _bench_context(env, context):
+    config = dict(env.config, data_volume={"context": context})
+    before = len(env.docker.builds)
+    DataVolume(env.source_dir, SHA, config, client=env.client).build(archive_path=env.archive_path)
+    return env.docker.builds[before]["context_bytes"], "bytes"
+
+
+def bench_context_directory(env, scratch):
+    return _bench_context(env, "directory")
+
+
+def bench_context_stream(env, scratch):
+    return _bench_context(env, "stream")
+
+
+def bench_compose_render(env, scratch):
+    ContainerStack(env.config, SHA, scratch, "shippy_app_data_bench").write_compose_file()
+    return None, None
+
+
+def bench_start(env, scratch):
+    stack = EngineStack(env.config, SHA, scratch, "busybox", client=env.client)
+    env.teardown.append(lambda: terminate_stacks(env.client, stack=stack.project))
+    stack.start()
+    return None, None
+
+
+def measure(env, stage, repeat, warmup):
+    """
+    Runs one stage benchmark repeatedly
+
+    :param env: (BenchmarkEnvironment) Servers and fixtures
+    :param stage: (str) Stage name
+    :param repeat: (int) Measured runs
+    :param warmup: (int) Unmeasured runs first
+    :return: (dict) Latency statistics in seconds, and the median throughput per second if the stage reports an amount
+    """
+    bench = globals()["bench_" + stage]
+    samples = []
+    amount = unit = None
+    for run in range(warmup + repeat):
+        # A fresh working directory per run, cleaned up outside the measurement
+        scratch = env.scratch(stage)
+        began = time.perf_counter()
+        try:
+            amount, unit = bench(env, scratch)
+            elapsed = time.perf_counter() - began
+        finally:
+            while env.teardown:
+                env.teardown.pop()()
+        if run >= warmup:
+            samples.append(elapsed)
+    median = statistics.median(samples)
+    result = {"runs": repeat, "min": min(samples), "median": median, "mean": statistics.mean(samples),
+              "max": max(samples), "stdev": statistics.stdev(samples) if len(samples) > 1 else 0.0}
+    if amount:
+        result.update(amount=amount, unit=unit, throughput=amount / median)
+    return result
+
+
+def format_throughput(result):
+    if "throughput" not in result:
+        return "-"
+    if result["unit"] == "bytes":
+        return "{0:.1f} MB/s".format(result["throughput"] / 1048576.0)
+    return "{0:.0f} {1}/s".format(result["throughput"], result["unit"])
+
+
+def compare(results, baseline, max_regression=None):
+    """
+    Prints the change of each median against a previous run
+
+    :param results: (dict) Output of this run
+    :param baseline: (dict) Output of the previous run
+    :param max_regression: (float) Percentage slowdown of a median which counts as a failure. Default: None
+    :return: (bool) Whether any stage regressed beyond max_regression
+    """
+    if baseline.get("params") != results["params"]:
+        print("warning: the baseline was run with different parameters: {0}".format(baseline.get("params")))
+    regressed = False
+    print("\n{0:<20} {1:>10} {2:>10} {3:>8}".format("STAGE", "BASELINE", "NOW", "CHANGE"))
+    for stage, result in results["stages"].items():
+        previous = baseline.get("stages", {}).get(stage)
+        if previous is None:
+            continue
+        change = (result["median"] / previous["median"] - 1) * 100
+        failed = max_regression is not None and change > max_regression
+        regressed = regressed or failed
+        print("{0:<20} {1:>9.1f}ms {2:>9.1f}ms {3:>+7.1f}%{4}".format(
+            stage, previous["median"] * 1000, result["median"] * 1000, change, "  REGRESSED" if failed else ""))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=2000, help="Files in the synthetic repository")
+    parser.add_argument("--size-mb", type=float, default=20, help="Uncompressed size of the synthetic repository")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the repository contents")
+    parser.add_argument("--repeat", type=int, default=5, help="Measured runs per stage")
+    parser.add_argument("--warmup", type=int, default=1, help="Unmeasured runs per stage before measuring")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the fake github waits before responding")
+    parser.add_argument("--create-delay", type=float, default=0.0, help="Seconds the fake docker takes per container")
+    parser.add_argument("--stages", type=str, default=",".join(STAGES), help="Comma separated stages to run")
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON to this file")
+    parser.add_argument("--compare", type=str, default=None, help="Compare with the JSON results of a previous run")
+    parser.add_argument("--max-regression", type=float, default=None, help="Fail when a median is this many percent slower than --compare")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = sorted(set(stages) - set(STAGES))
+    if unknown:
+        parser.error("unknown stages: {0}".format(", ".join(unknown)))
+
+    params = {"files": args.files, "size_mb": args.size_mb, "seed": args.seed, "repeat": args.repeat,
+              "warmup": args.warmup, "latency": args.latency, "create_delay": args.create_delay}
+    results = {"params": params, "python": platform.python_version(), "platform": platform.platform(), "stages": {}}
+
+    workdir = tempfile.mkdtemp(prefix="shippy-bench-")
+    try:
+        env = BenchmarkEnvironment(workdir, args.files, int(args.size_mb * 1048576), seed=args.seed,
+                                   latency=args.latency, create_delay=args.create_delay)
+        try:
+            print("Repository: {0} files, {1:.1f}MB, {2:.1f}MB gzipped".format(
+                env.files, env.size_bytes / 1048576.0, len(env.archive) / 1048576.0))
+            print("{0:<20} {1:>10} {2:>10} {3:>10} {4:>14}".format("STAGE", "MEDIAN", "MIN", "MAX", "THROUGHPUT"))
+            for stage in stages:
+                result = measure(env, stage, args.repeat, args.warmup)
+                results["stages"][stage] = result
+                print("{0:<20} {1:>9.1f}ms {2:>9.1f}ms {3:>9.1f}ms {4:>14}".format(
+                    stage, result["median"] * 1000, result["min"] * 1000, result["max"] * 1000, format_throughput(result)))
+        finally:
+            env.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.max_regression):
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+benchmarks.import_time
+======================
+
+Measures the import cost of the modules loaded by quick CLI commands, using `python -X importtime`,
+and fails when any exceeds its budget.
+
+    python benchmarks/import_time.py [--runs 5] [--budget-scale 1.0]
+"""
+import os
+import re
+import sys
+import argparse
+import subprocess
+
+SOURCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src", "main", "python")
+
+# Cumulative import time budgets in milliseconds, the best of several runs must stay below them
+BUDGETS_MS = {
+    "shippy.cli": 50,
+    "shippy.engine_api": 50,
+    "shippy.container_stack": 50,
+}
+
+# Modules which must only be loaded by the commands which need them
+HEAVY_MODULES = ("docker", "requests", "jinja2", "tqdm", "validictory")
+
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$")
+
+
+def import_profile(module):
+    """
+    Imports a module in a fresh interpreter
+
+    :param module: (str) Module to import
+    :return: (list) (module name, self µs, cumulative µs, depth) tuples in the order reported
+    """
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(SOURCE_PATH))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import {0}".format(module)],
+                            env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    profile = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            profile.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+    return profile
+
+
+def measure(module, runs):
+    """
+    :param module: (str) Module to import
+    :param runs: (int) Number of fresh interpreters to measure
+    :return: (tuple) Best cumulative import time in ms, and the profile of that run
+    """
+    best = None
+    for _ in range(runs):
+        profile = import_profile(module)
+        cumulative_ms = next(cumulative for name, _, cumulative, depth in profile if name == module and depth == 0) / 1000.0
+        if best is None or cumulative_ms < best[0]:
+            best = (cumulative_ms, profile)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Interpreters started per module, the best run counts")
+    parser.add_argument("--budget-scale", type=float, default=1.0, help="Multiplier applied to every budget, for slow machines")
+    parser.add_argument("--top", type=int, default=5, help="Slowest imports shown per module")
+    args = parser.parse_args()
+
+    failed = False
+    for module, budget_ms in sorted(BUDGETS_MS.items()):
+        budget_ms *= args.budget_scale
+        cumulative_ms, profile = measure(module, args.runs)
+        heavy = sorted({name.split(".")[0] for name, _, _, _ in profile} & set(HEAVY_MODULES))
+        ok = cumulative_ms <= budget_ms and not heavy
+        failed = failed or not ok
+        print("{0:<28} {1:8.1f} ms  (budget {2:.0f} ms)  {3}".format(module, cumulative_ms, budget_ms, "ok" if ok else "FAIL"))
+        if heavy:
+            print("    loads heavy modules: {0}".format(", ".join(heavy)))
+        for name, self_us, _, _ in sorted(profile, key=lambda entry: entry[1], reverse=True)[:args.top]:
+            print("    {0:<40} {1:8.1f} ms self".format(name, self_us / 1000.0))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
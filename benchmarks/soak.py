@@ -0,0 +1,354 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+benchmarks.soak
+===============
+
+Runs many deploy and terminate flows at once against the fake github and docker servers, with
+injected latency and failures, to find where shippy stops scaling on one host. Each flow deploys
+a commit hash through deploy_shas, the function behind `shippy_deploy` and the daemon, then
+removes its stack the way `shippy_terminate` does. All flows share one docker client, as the
+daemon's workers do. Drawing the hashes from a small pool makes concurrent flows deploy the same
+hash into the same working directory.
+
+The report holds the throughput, p50/p95/p99 latency per stage, error counts, and the peak
+RSS, open file descriptors and threads. It is written as sorted JSON, so reports of two releases
+can be diffed, or compared with --compare.
+
+    python benchmarks/soak.py [--concurrency 50] [--flows 200] [--distinct-shas 50] [--failure-rate 0.02]
+                              [--output report.json] [--compare previous.json]
+"""
+import os
+import re
+import sys
+import json
+import math
+import random
+import shutil
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import time
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from deploy_stages import synthetic_archive  # also puts the sources and fakes on sys.path
+
+from docker import APIClient  # noqa: E402
+from fake_docker import FakeDockerServer, API_VERSION  # noqa: E402
+from fake_github import FakeGithubServer  # noqa: E402
+from shippy import downloader, repository_archive  # noqa: E402
+from shippy.container_stack import terminate_stacks  # noqa: E402
+from shippy.deployment import deploy_shas  # noqa: E402
+
+PERCENTILES = (50, 95, 99)
+REPOSITORY_URL = "https://github.com/shippy-soak/app"
+
+
+def percentile(values, pct):
+    """
+    :param values: (list) Samples
+    :param pct: (float) Percentile, 0 to 100
+    :return: (float) Nearest-rank percentile, None without samples
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(int(math.ceil(pct / 100.0 * len(ordered))) - 1, 0)]
+
+
+def _process_status():
+    """
+    :return: (tuple) Resident set size in bytes, open file descriptors and threads of this process
+    """
+    rss = 0
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+        fds = len(os.listdir("/proc/self/fd"))
+    except OSError:
+        # Not Linux, fall back to the peak RSS, which is in bytes on macOS
+        rss, fds = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 0
+    return rss, fds, threading.active_count()
+
+
+class ResourceSampler:
+    """
+    Samples the memory, file descriptors and threads of the process on a background thread
+    """
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="soak-sampler", daemon=True)
+
+    def _run(self):
+        while True:
+            self.samples.append(_process_status())
+            if self._stop.wait(self.interval):
+                break
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.samples.append(_process_status())
+
+    def summary(self):
+        summary = {}
+        for index, name in enumerate(("rss_mb", "fds", "threads")):
+            values = [sample[index] / (1048576.0 if name == "rss_mb" else 1) for sample in self.samples]
+            summary[name] = {"start": values[0], "peak": max(values), "end": values[-1]}
+        return summary
+
+
+class SoakHarness:
+    """
+    The fake servers, configuration and bookkeeping of one soak run
+    """
+
+    def __init__(self, workdir, args):
+        """
+        Constructor
+
+        :param workdir: (str) Scratch directory holding the workspace, caches and span files
+        :param args: (argparse.Namespace) Command line arguments
+        """
+        self.workdir = workdir
+        self.args = args
+        rng = random.Random(args.seed)
+        self.shas = ["{0:040x}".format(rng.getrandbits(160)) for _ in range(args.distinct_shas)]
+        self.flow_shas = [rng.choice(self.shas) for _ in range(args.flows)]
+        archive, _ = synthetic_archive(args.files, int(args.size_mb * 1048576), seed=args.seed)
+
+        self.github = FakeGithubServer({"/repos/shippy-soak/app/tarball/" + sha: archive for sha in self.shas},
+                                       chunk_size=64 * 1024, latency=args.latency,
+                                       disconnect_rate=args.disconnect_rate, seed=args.seed).start()
+        repository_archive.GITHUB_API_BASEURL = self.github.base_url
+        # The process-wide downloader, without dozens of interleaved progress bars
+        downloader._DEFAULT_DOWNLOADER = downloader.Downloader(progress=False)
+        self.docker = FakeDockerServer(os.path.join(workdir, "docker.sock"), images=["shippy-soak/app", "mysql", "busybox"],
+                                       create_delay=args.create_delay, failure_rate=args.failure_rate, seed=args.seed).start()
+        self.client = APIClient(base_url=self.docker.base_url, version=API_VERSION, timeout=600)
+
+        self.workspace = os.path.join(workdir, "archives")
+        self.appconfig = os.path.join(workdir, "config.js")
+        with open(self.appconfig, "w") as f:
+            f.write("module.exports = {};\n")
+        self.config = {
+            "app_name": "app",
+            "application_repository": REPOSITORY_URL,
+            "application_image": "shippy-soak/app",
+            "application_config": {"NODE_ENV": "production"},
+            "application_source_mountpoint": "/usr/src/app",
+            "application_build_cmds": [args.build_cmd] if args.build_cmd else [],
+            "database_image": "mysql",
+            "database_config": {"MYSQL_DATABASE": "app"},
+            "stack_backend": "engine",
+            "archive_cache": {"path": os.path.join(workdir, "cache", "archives")},
+            "build_cache": {"path": os.path.join(workdir, "cache", "builds")},
+        }
+        self.latencies = {}
+        self.errors = Counter()
+        self._lock = threading.Lock()
+
+    def close(self):
+        self.client.close()
+        self.docker.stop()
+        self.github.stop()
+
+    def _record(self, name, seconds):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+
+    def _error(self, stage, error):
+        message = str(error).splitlines()[0] if str(error) else ""
+        # Group the same error across flows
+        message = re.sub(r"[0-9a-f]{32,}", "<id>", message.replace(self.workdir, "<workdir>"))[:160]
+        with self._lock:
+            self.errors["{0}: {1}: {2}".format(stage, type(error).__name__, message)] += 1
+
+    def flow(self, index):
+        """
+        Deploys one commit hash and terminates its stack
+
+        :param index: (int) Flow number
+        :return: (bool) Whether both succeeded
+        """
+        sha = self.flow_shas[index]
+        spans_path = os.path.join(self.workdir, "spans", "{0:05d}.jsonl".format(index))
+        config = dict(self.config, tracing={"jsonl_path": spans_path})
+        began = time.perf_counter()
+        ok = True
+        try:
+            deploy_shas(config, [sha], self.appconfig, docker_client=self.client, workspace=self.workspace)
+        except (Exception, SystemExit) as e:
+            self._error("deploy", e)
+            ok = False
+        deployed = time.perf_counter()
+        self._record("deploy", deployed - began)
+
+        try:
+            terminate_stacks(self.client, app_name=self.config["app_name"], sha=sha)
+        except Exception as e:
+            self._error("terminate", e)
+            ok = False
+        self._record("terminate", time.perf_counter() - deployed)
+        self._record("flow", time.perf_counter() - began)
+        return ok
+
+    def stage_latencies(self):
+        """
+        Reads the top-level spans the flows' tracers wrote
+
+        :return: (dict) Maps stage names to lists of seconds
+        """
+        stages = {}
+        spans_dir = os.path.join(self.workdir, "spans")
+        for name in sorted(os.listdir(spans_dir)) if os.path.isdir(spans_dir) else []:
+            with open(os.path.join(spans_dir, name)) as f:
+                for line in f:
+                    span = json.loads(line)
+                    if span["parent_id"] is None:
+                        stages.setdefault(span["name"], []).append(span["duration"])
+        return stages
+
+    def run(self):
+        """
+        Runs every flow, at most --concurrency at once
+
+        :return: (dict) Report
+        """
+        with ResourceSampler() as sampler:
+            began = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=self.args.concurrency, thread_name_prefix="soak") as executor:
+                outcomes = list(executor.map(self.flow, range(self.args.flows)))
+            elapsed = time.perf_counter() - began
+
+        latencies = dict(self.stage_latencies(), **self.latencies)
+        stages = {}
+        for name, values in sorted(latencies.items()):
+            stages[name] = {"count": len(values), "max_ms": round(max(values) * 1000, 1)}
+            for pct in PERCENTILES:
+                stages[name]["p{0}_ms".format(pct)] = round(percentile(values, pct) * 1000, 1)
+
+        resources = sampler.summary()
+        return {
+            "params": {key: value for key, value in sorted(vars(self.args).items()) if key not in ("output", "compare", "verbose")},
+            "python": platform.python_version(),
+            "flows": {"total": len(outcomes), "succeeded": sum(outcomes), "failed": len(outcomes) - sum(outcomes)},
+            "throughput_flows_per_s": round(len(outcomes) / elapsed, 2),
+            "elapsed_s": round(elapsed, 2),
+            "stages": stages,
+            "errors": dict(sorted(self.errors.items())),
+            "resources": {name: {key: round(value, 1) for key, value in values.items()} for name, values in resources.items()},
+            "peak_creates": self.docker.peak_creates,
+            "leftover_containers": len(self.docker.containers),
+        }
+
+
+def print_report(report):
+    flows = report["flows"]
+    print("{0} flows in {1}s, {2} flows/s, {3} failed".format(
+        flows["total"], report["elapsed_s"], report["throughput_flows_per_s"], flows["failed"]))
+    print("\n{0:<12} {1:>7} {2:>10} {3:>10} {4:>10} {5:>10}".format("STAGE", "COUNT", "P50", "P95", "P99", "MAX"))
+    for name, stage in report["stages"].items():
+        print("{0:<12} {1:>7} {2:>8.1f}ms {3:>8.1f}ms {4:>8.1f}ms {5:>8.1f}ms".format(
+            name, stage["count"], stage["p50_ms"], stage["p95_ms"], stage["p99_ms"], stage["max_ms"]))
+    print("\n{0:<12} {1:>10} {2:>10} {3:>10}".format("RESOURCE", "START", "PEAK", "END"))
+    for name, values in report["resources"].items():
+        print("{0:<12} {1:>10} {2:>10} {3:>10}".format(name, values["start"], values["peak"], values["end"]))
+    print("\nLeftover containers: {0}".format(report["leftover_containers"]))
+    if report["errors"]:
+        print("\nERRORS")
+        for error, count in report["errors"].items():
+            print("{0:>6}  {1}".format(count, error))
+
+
+def compare(report, previous):
+    """
+    Prints how the percentiles, throughput and peak resources changed since a previous report
+
+    :param report: (dict) This run's report
+    :param previous: (dict) Previous report
+    :return: None
+    """
+    if previous.get("params") != report["params"]:
+        print("warning: the previous report was run with different parameters")
+    print("\n{0:<24} {1:>12} {2:>12} {3:>8}".format("METRIC", "PREVIOUS", "NOW", "CHANGE"))
+    rows = [("throughput_flows_per_s", previous.get("throughput_flows_per_s"), report["throughput_flows_per_s"])]
+    for name, stage in report["stages"].items():
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            rows.append(("{0}.{1}".format(name, key), previous.get("stages", {}).get(name, {}).get(key), stage[key]))
+    for name, values in report["resources"].items():
+        rows.append(("{0}.peak".format(name), previous.get("resources", {}).get(name, {}).get("peak"), values["peak"]))
+    for metric, before, now in rows:
+        if before:
+            print("{0:<24} {1:>12} {2:>12} {3:>+7.1f}%".format(metric, before, now, (now / before - 1) * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=50, help="Flows running at once")
+    parser.add_argument("--flows", type=int, default=200, help="Deploy and terminate flows in total")
+    parser.add_argument("--distinct-shas", type=int, default=50, help="Commit hashes the flows are drawn from")
+    parser.add_argument("--files", type=int, default=500, help="Files in the synthetic repository")
+    parser.add_argument("--size-mb", type=float, default=5, help="Uncompressed size of the synthetic repository")
+    parser.add_argument("--build-cmd", type=str, default="true", help="Build command run by each deploy")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds the fake github waits before responding")
+    parser.add_argument("--create-delay", type=float, default=0.05, help="Seconds the fake docker takes per container")
+    parser.add_argument("--disconnect-rate", type=float, default=0.05, help="Probability of a github download dropping part way")
+    parser.add_argument("--failure-rate", type=float, default=0.01, help="Probability of a container creation failing")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the repository, hashes and injected failures")
+    parser.add_argument("--output", type=str, default=None, help="Write the report as JSON to this file")
+    parser.add_argument("--compare", type=str, default=None, help="Compare with a previous JSON report")
+    parser.add_argument("--verbose", action="store_true", help="Show shippy's log output")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    workdir = tempfile.mkdtemp(prefix="shippy-soak-")
+    try:
+        harness = SoakHarness(workdir, args)
+        try:
+            report = harness.run()
+        finally:
+            harness.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,7 +13,7 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-from logging import getLogger, Formatter, INFO, StreamHandler
+from logging import getLogger, Formatter, INFO, NullHandler, StreamHandler
 
 __author__ = "Vik Bhatti"
 __version__ = "${version}"
@@ -25,18 +25,16 @@ LOGGING_FORMAT = "%(asctime)-15s: %(name)s: %(levelname)-8s : %(message)s"
 
 def initialise_root_logger(log_level=INFO):
     """
-    Returns a root logger with logs to stdout using the given log_level
+    Returns a root logger with logs to stdout using the given log_level. Called by the
+    command-line scripts, importing the package leaves logging configuration to the caller.
     """
-    formatter = Formatter(LOGGING_FORMAT)
-
-    console_handler = StreamHandler()
-    console_handler.setFormatter(formatter)
-
     root_logger = getLogger(__name__)
     root_logger.setLevel(log_level)
-    root_logger.addHandler(console_handler)
+    if not any(isinstance(handler, StreamHandler) for handler in root_logger.handlers):
+        console_handler = StreamHandler()
+        console_handler.setFormatter(Formatter(LOGGING_FORMAT))
+        root_logger.addHandler(console_handler)
     return root_logger
 
 
-# Setup the module-level logger
-LOGGER = initialise_root_logger(INFO)
+getLogger(__name__).addHandler(NullHandler())
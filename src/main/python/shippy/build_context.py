@@ -0,0 +1,298 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+shippy.build_context
+====================
+
+Generates docker build contexts as a tar stream, without walking or re-archiving the unpacked sourcecode
+"""
+import io
+import os
+import time
+import queue
+import logging
+import tarfile
+import threading
+
+from shippy import tracing
+
+LOGGER = logging.getLogger(__name__)
+
+CHUNK_QUEUE_SIZE = 16
+LAYER_DIRECTORY = "layers"
+_END_OF_STREAM = object()
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class _QueueWriter:
+    """
+    Minimal writable file object handing every write to a bounded queue
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.chunks.put(bytes(data))
+        self.bytes_written += len(data)
+        return len(data)
+
+
+class BuildContext:
+    """
+    Iterable producing an uncompressed tar build context in chunks, suitable for
+    `APIClient.build(fileobj=..., custom_context=True)`.
+
+    Members of the downloaded github tarball are re-wrapped with the top-level directory
+    stripped, the generated Dockerfile is injected as an extra member, and overlay paths
+    (build outputs, the application config file) are added from the unpacked sourcecode.
+
+    When vendor paths are given, members are laid out as one directory per vendor path
+    followed by one for everything else, below `layers/`, so a Dockerfile can copy each
+    into its own image layer.
+
+    The tar is written on a producer thread into a bounded queue, so only a few chunks
+    are held in memory at any time.
+    """
+
+    def __init__(self, sourcecode_path, dockerfile, archive_path=None, overlay_paths=None, strip_components=1,
+                 matcher=None, vendor_paths=None):
+        """
+        Constructor
+
+        :param sourcecode_path: (str) Path to the unpacked sourcecode
+        :param dockerfile: (str) Rendered Dockerfile contents
+        :param archive_path: (str) Downloaded github tarball. Default: None, add the whole sourcecode path instead
+        :param overlay_paths: (list) Paths relative to sourcecode_path to add from disk. Default: None
+        :param strip_components: (int) Leading path components to remove from archive members. Default: 1
+        :param matcher: (shippy.context_filter.PathMatcher) Rules pruning the context. Default: None, keep everything
+        :param vendor_paths: (list) Dependency paths split into their own layers. Default: None, no layer layout
+        """
+        self.sourcecode_path = sourcecode_path
+        self.dockerfile = dockerfile.encode("utf-8")
+        self.archive_path = archive_path
+        self.overlay_paths = [os.path.normpath(path) for path in overlay_paths or []]
+        self.strip_components = strip_components
+        self.matcher = matcher
+        self.vendor_paths = None if vendor_paths is None else [os.path.normpath(path) for path in vendor_paths]
+        self.bytes_sent = 0
+
+    @staticmethod
+    def layer_names(vendor_paths):
+        """
+        Returns the context directories of each layer, in the order they should be copied
+
+        :param vendor_paths: (list) Dependency paths split into their own layers
+        :return: (list) Layer directory names
+        """
+        names = ["{0}/{1}".format(LAYER_DIRECTORY, index) for index in range(len(vendor_paths))]
+        names.append("{0}/app".format(LAYER_DIRECTORY))
+        return names
+
+    def _context_name(self, name):
+        """
+        Maps a path relative to the sourcecode root to its name in the context
+
+        :param name: (str) Relative path
+        :return: (str) Member name
+        """
+        if self.vendor_paths is None:
+            return name
+        for index, vendor_path in enumerate(self.vendor_paths):
+            if name == vendor_path or name.startswith(vendor_path + "/"):
+                return "{0}/{1}/{2}".format(LAYER_DIRECTORY, index, name)
+        return "{0}/app/{1}".format(LAYER_DIRECTORY, name)
+
+    def __iter__(self):
+        chunks = queue.Queue(maxsize=CHUNK_QUEUE_SIZE)
+        cancelled = threading.Event()
+        errors = []
+
+        def produce():
+            try:
+                self._write(_QueueWriter(chunks), cancelled)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                chunks.put(_END_OF_STREAM)
+
+        producer = threading.Thread(target=produce, name="build-context", daemon=True)
+        producer.start()
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is _END_OF_STREAM:
+                    break
+                self.bytes_sent += len(chunk)
+                yield chunk
+        finally:
+            cancelled.set()
+            # Unblock the producer if the consumer stopped early
+            while producer.is_alive():
+                try:
+                    chunks.get_nowait()
+                except queue.Empty:
+                    producer.join(0.01)
+
+        if errors:
+            raise errors[0]
+        LOGGER.info("Sent %d bytes of build context", self.bytes_sent)
+        tracing.count(context_bytes_sent=self.bytes_sent)
+
+    def _write(self, writer, cancelled):
+        """
+        Writes the complete context tar to writer
+
+        :param writer: (file) Writable file object
+        :param cancelled: (threading.Event) Set when the consumer has gone away
+        :return: None
+        """
+        with tarfile.open(fileobj=writer, mode="w|") as context:
+            self._add_generated(context, "Dockerfile", self.dockerfile)
+            if self._writes_dockerignore():
+                self._add_generated(context, ".dockerignore", self.matcher.to_dockerignore(self.overlay_paths).encode("utf-8"))
+            if self.vendor_paths is not None:
+                # Every layer directory must exist for its COPY instruction, even if empty
+                for layer in self.layer_names(self.vendor_paths):
+                    info = tarfile.TarInfo(layer)
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0o755
+                    info.mtime = time.time()
+                    context.addfile(info)
+
+            if self.archive_path:
+                self._add_archive_members(context, cancelled)
+            else:
+                self._add_directory(context, self.sourcecode_path, "", cancelled)
+
+            for overlay in self.overlay_paths:
+                path = os.path.join(self.sourcecode_path, overlay)
+                if os.path.lexists(path):
+                    self._add_directory(context, path, overlay, cancelled)
+                else:
+                    LOGGER.warning("Overlay path does not exist, skipping: %s", path)
+
+    @staticmethod
+    def _add_generated(context, name, data):
+        """
+        Adds a file generated by shippy to the root of the context
+
+        :param context: (tarfile.TarFile) Context being written
+        :param name: (str) Member name
+        :param data: (bytes) File contents
+        :return: None
+        """
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        info.mode = 0o644
+        context.addfile(info, io.BytesIO(data))
+
+    def _is_generated(self, name):
+        """
+        Returns True if name is one of the files shippy injects into the context root
+
+        :param name: (str) Member name relative to the context root
+        :return: (bool)
+        """
+        return name == "Dockerfile" or (name == ".dockerignore" and self._writes_dockerignore())
+
+    def _writes_dockerignore(self):
+        """
+        Returns True if a generated .dockerignore is injected. Layered contexts are already
+        pruned and don't match the rules' paths, so they don't get one.
+
+        :return: (bool)
+        """
+        return bool(self.matcher) and self.vendor_paths is None
+
+    def _is_overlaid(self, name):
+        """
+        Returns True if name is replaced by one of the overlay paths
+
+        :param name: (str) Member name relative to the context root
+        :return: (bool)
+        """
+        for overlay in self.overlay_paths:
+            if name == overlay or name.startswith(overlay + "/"):
+                return True
+        return False
+
+    def _add_archive_members(self, context, cancelled):
+        """
+        Re-wraps the members of the downloaded tarball under the context root
+
+        :param context: (tarfile.TarFile) Context being written
+        :param cancelled: (threading.Event) Set when the consumer has gone away
+        :return: None
+        """
+        with tarfile.open(self.archive_path, mode="r|gz") as archive:
+            for member in archive:
+                if cancelled.is_set():
+                    return
+                parts = [part for part in member.name.split("/") if part and part != "."]
+                parts = parts[self.strip_components:]
+                if not parts:
+                    continue
+                name = "/".join(parts)
+                if self._is_generated(name) or self._is_overlaid(name):
+                    continue
+                if self.matcher and not self.matcher.matches(name, is_dir=member.isdir()):
+                    continue
+
+                member.name = self._context_name(name)
+                if member.islnk():
+                    link_parts = [part for part in member.linkname.split("/") if part]
+                    member.linkname = self._context_name("/".join(link_parts[self.strip_components:]))
+                source = archive.extractfile(member) if member.isfile() else None
+                context.addfile(member, source)
+
+    def _add_directory(self, context, path, arcname, cancelled):
+        """
+        Adds a file or directory tree from disk to the context
+
+        :param context: (tarfile.TarFile) Context being written
+        :param path: (str) Path on disk
+        :param arcname: (str) Name inside the context, "" for the context root
+        :param cancelled: (threading.Event) Set when the consumer has gone away
+        :return: None
+        """
+        def prune(info):
+            if cancelled.is_set():
+                raise _Cancelled()
+            if self._is_generated(info.name):
+                return None
+            if self.matcher and info.name != arcname and not self.matcher.matches(info.name, is_dir=info.isdir()):
+                return None
+            if info.islnk():
+                info.linkname = self._context_name(info.linkname)
+            info.name = self._context_name(info.name)
+            return info
+
+        if arcname:
+            entries = [(path, arcname)]
+        else:
+            entries = [(os.path.join(path, name), name) for name in sorted(os.listdir(path))]
+
+        try:
+            for entry_path, entry_name in entries:
+                context.add(entry_path, arcname=entry_name, filter=prune)
+        except _Cancelled:
+            pass
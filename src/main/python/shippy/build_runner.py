@@ -0,0 +1,268 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+shippy.build_runner
+===================
+
+Runs the application build commands against the unpacked sourcecode, restoring cached outputs where possible
+"""
+import os
+import signal
+import logging
+import threading
+import subprocess
+
+from functools import partial
+from concurrent.futures import CancelledError
+from shippy import tracing, command_runner
+from shippy.dag import Task, run_graph
+from shippy.log_sink import LogSink
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_BUILD_WORKERS = 4
+STDERR_TAIL_BYTES = 4096
+LOG_FILENAME = "build.log.gz"
+
+
+class BuildCommand:
+    """
+    A single entry of `application_build_cmds`.
+
+    Entries are either a plain command string, or an object with the command and optionally:
+
+    * `inputs`/`outputs`: files or globs the command depends on and paths it produces, which
+      make the command cacheable, e.g. `{"cmd": "npm install --production", "inputs": ["package.json"], "outputs": ["node_modules"]}`
+    * `name`/`depends_on`: a name for the command and the names of commands which must finish
+      before it starts. When any entry declares `depends_on` the commands form a graph and
+      independent commands run concurrently, otherwise they run one after another.
+    * `env`: extra environment variables
+    * `cwd`: working directory relative to the sourcecode root
+    * `timeout`: seconds after which the command is killed
+    """
+
+    def __init__(self, cmd, inputs=None, outputs=None, name=None, depends_on=None, env=None, cwd=None, timeout=None):
+        """
+        Constructor
+
+        :param cmd: (str) Shell command to run
+        :param inputs: (list) Files or globs, relative to the sourcecode, which determine the outputs. Default: None
+        :param outputs: (list) Paths, relative to the sourcecode, produced by the command. Default: None
+        :param name: (str) Command name referenced by depends_on. Default: None, use the command string
+        :param depends_on: (list) Names of commands which must finish first. Default: None
+        :param env: (dict) Extra environment variables. Default: None
+        :param cwd: (str) Working directory relative to the sourcecode root. Default: None
+        :param timeout: (float) Seconds after which the command is killed. Default: None, no limit
+        """
+        self.cmd = cmd
+        self.inputs = list(inputs or [])
+        self.outputs = list(outputs or [])
+        self.name = name or cmd
+        self.depends_on = depends_on
+        self.env = dict(env or {})
+        self.cwd = cwd
+        self.timeout = timeout
+
+    @classmethod
+    def from_config(cls, entry):
+        """
+        Parses an `application_build_cmds` entry
+
+        :param entry: (str|dict) Config entry
+        :return: (BuildCommand)
+        """
+        if isinstance(entry, str):
+            return cls(entry)
+        return cls(entry["cmd"], inputs=entry.get("inputs"), outputs=entry.get("outputs"), name=entry.get("name"),
+                   depends_on=entry.get("depends_on"), env=entry.get("env"), cwd=entry.get("cwd"),
+                   timeout=entry.get("timeout"))
+
+    @property
+    def cacheable(self):
+        """
+        Commands can only be cached when both their inputs and outputs are declared
+
+        :return: (bool)
+        """
+        return bool(self.inputs and self.outputs)
+
+    def __repr__(self):
+        return "BuildCommand({0!r})".format(self.cmd)
+
+
+class BuildRunner:
+    """
+    Runs the configured build commands inside the sourcecode directory, either in order or,
+    when dependencies are declared, as a graph on a bounded worker pool
+    """
+
+    def __init__(self, config, sourcecode_path, cache=None, log_dir=None):
+        """
+        Constructor
+
+        :param config: (dict) Configuration object as parsed by shippy.config
+        :param sourcecode_path: (str) Path to the unpacked sourcecode
+        :param cache: (shippy.cache.BuildCache) Cache of command outputs. Default: None
+        :param log_dir: (str) Directory receiving the compressed output of the commands. Default: None, inherit the console
+        """
+        self.sourcecode_path = sourcecode_path
+        self.cache = cache
+        self.log_dir = log_dir
+        self.log_sink = LogSink(os.path.join(log_dir, LOG_FILENAME), tail_bytes=STDERR_TAIL_BYTES) if log_dir else None
+        self.workers = config.get("application_build_workers", DEFAULT_BUILD_WORKERS)
+        self.commands = [BuildCommand.from_config(entry) for entry in config.get("application_build_cmds", [])]
+        self._futures = set()
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+
+    def _build_tasks(self):
+        """
+        Converts the commands into graph tasks. Without any declared dependencies every
+        command depends on the one before it, preserving the sequential behaviour.
+
+        :return: (list) shippy.dag.Task instances
+        """
+        graph_mode = any(command.depends_on is not None for command in self.commands)
+        tasks = []
+        previous = None
+        for command in self.commands:
+            if graph_mode:
+                depends_on = command.depends_on or []
+            else:
+                depends_on = [previous] if previous else []
+            tasks.append(Task(command.name, partial(self.run_command, command), depends_on))
+            previous = command.name
+        return tasks
+
+    def run(self):
+        """
+        Runs every build command, restoring outputs from the cache instead where a matching entry exists
+
+        :return: None
+        :raises: (SystemExit) If a command fails or the dependencies are invalid
+        """
+        try:
+            run_graph(self._build_tasks(), max_workers=self.workers, on_failure=lambda e: self.cancel())
+        except ValueError as e:
+            LOGGER.error("Invalid application_build_cmds: %s", e)
+            raise SystemExit(1)
+        except subprocess.SubprocessError as e:
+            LOGGER.error(e)
+            raise SystemExit(1)
+        finally:
+            if self.log_sink:
+                self.log_sink.close()
+
+    def run_command(self, command):
+        """
+        Runs a single build command
+
+        :param command: (BuildCommand) Command to run
+        :return: None
+        :raises: (subprocess.SubprocessError) If the command fails or times out
+        """
+        with tracing.span("command", command=command.name):
+            key = None
+            if self.cache and command.cacheable:
+                key, hit = self._restore_cached(command)
+                if hit:
+                    LOGGER.info("Restored cached outputs of: %s", command.name)
+                    tracing.annotate(cache="hit")
+                    return
+                tracing.annotate(cache="miss")
+
+            self._execute(command)
+
+            if key is not None:
+                try:
+                    self.cache.save(key, command.outputs, self.sourcecode_path)
+                except OSError as e:
+                    LOGGER.warning("Could not cache the outputs of %s: %s", command.name, e)
+
+    def _restore_cached(self, command):
+        """
+        Restores the cached outputs of a command. The cache is best-effort, any failure
+        counts as a miss.
+
+        :param command: (BuildCommand) Cacheable command
+        :return: (tuple) Cache key, None if it couldn't be computed, and whether the outputs were restored
+        """
+        try:
+            key = self.cache.make_key(command.cmd, command.inputs, self.sourcecode_path,
+                                      extra={"env": command.env, "cwd": command.cwd})
+        except OSError as e:
+            LOGGER.warning("Could not compute the cache key of %s: %s", command.name, e)
+            return None, False
+        try:
+            return key, self.cache.restore(key, command.outputs, self.sourcecode_path)
+        except OSError as e:
+            LOGGER.warning("Could not restore the cached outputs of %s: %s", command.name, e)
+            return key, False
+
+    def _execute(self, command):
+        """
+        Runs the command on the shared command runner, in its own process group so it can be
+        cancelled along with any children. Output goes to the log sink when there is one.
+
+        :param command: (BuildCommand) Command to run
+        :return: None
+        :raises: (subprocess.CalledProcessError) If the command fails or is cancelled
+        :raises: (subprocess.TimeoutExpired) If the command ran out of time
+        """
+        working_dir = os.path.join(self.sourcecode_path, command.cwd) if command.cwd else self.sourcecode_path
+        env = dict(os.environ, **command.env)
+        on_data = partial(self._write_output, command) if self.log_sink else None
+
+        LOGGER.info("Executing command: %s (in %s)", command.cmd, working_dir)
+        future = None
+        try:
+            with self._lock:
+                if self._cancelled.is_set():
+                    raise subprocess.CalledProcessError(-signal.SIGTERM, command.cmd)
+                future = command_runner.get_runner().submit(command.cmd, cwd=working_dir, env=env, on_data=on_data,
+                                                            timeout=command.timeout, check=False)
+                self._futures.add(future)
+            try:
+                returncode = future.result().returncode
+            except CancelledError:
+                raise subprocess.CalledProcessError(-signal.SIGTERM, command.cmd)
+        finally:
+            with self._lock:
+                self._futures.discard(future)
+
+        if returncode != 0:
+            if self.log_sink:
+                tail = self.log_sink.tail(self._source(command, "stderr")) or self.log_sink.tail(self._source(command, "stdout"))
+                LOGGER.error("Command %s failed, full logs in: %s\n%s", command.name, self.log_sink.path, tail)
+            raise subprocess.CalledProcessError(returncode, command.cmd)
+
+    @staticmethod
+    def _source(command, stream):
+        return "{0} ({1})".format(command.name, stream)
+
+    def _write_output(self, command, stream, data):
+        self.log_sink.write(self._source(command, stream), data)
+
+    def cancel(self):
+        """
+        Stops any running commands and prevents new ones from starting
+
+        :return: None
+        """
+        with self._lock:
+            self._cancelled.set()
+            for future in self._futures:
+                future.cancel()
@@ -0,0 +1,474 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+shippy.cache
+============
+
+Persistent, size-bounded on-disk caches shared between shippy invocations
+"""
+import os
+import glob
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from contextlib import contextmanager
+from shippy.utils import create_directory
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_ARCHIVE_CACHE_DIR = "/tmp/shippy/cache/archives"
+DEFAULT_ARCHIVE_CACHE_SIZE_MB = 2048
+DEFAULT_BUILD_CACHE_DIR = "/tmp/shippy/cache/builds"
+DEFAULT_BUILD_CACHE_SIZE_MB = 4096
+INDEX_FILENAME = "index.json"
+LOCK_FILENAME = ".lock"
+STAGING_PREFIX = ".staging-"
+HASH_CHUNK_SIZE = 1024 * 1024
+# Linux ioctl sharing a file's extents with another file on copy-on-write filesystems
+FICLONE = 0x40049409
+
+
+def file_digest(path):
+    """
+    Computes the sha256 digest of a file
+
+    :param path: (str) Path to the file
+    :return: (str) Hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_or_copy(source, destination):
+    """
+    Hardlinks source to destination, falling back to a copy when the paths are on
+    different filesystems. An existing destination is replaced.
+
+    :param source: (str) Path to existing file
+    :param destination: (str) Path to create
+    :return: (str) destination
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+    return destination
+
+
+def reflink_or_copy(source, destination):
+    """
+    Clones source to destination with a reflink, so both share disk blocks until either is
+    modified, falling back to a copy on filesystems without reflink support
+
+    :param source: (str) Path to existing file
+    :param destination: (str) Path to create
+    :return: (str) destination
+    """
+    try:
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+        return shutil.copy2(source, destination)
+    shutil.copystat(source, destination)
+    return destination
+
+
+def link_tree(source, destination, link=True):
+    """
+    Recreates a file or directory tree at destination, hardlinking files where possible.
+    An existing destination is replaced.
+
+    :param source: (str) Existing file or directory
+    :param destination: (str) Path to create
+    :param link: (bool) Hardlink files, else reflink or copy them so the trees share no inodes. Default: True
+    :return: (str) destination
+    """
+    copy_function = link_or_copy if link else reflink_or_copy
+    remove_path(destination)
+    parent = os.path.dirname(destination)
+    if parent:
+        create_directory(parent)
+    if os.path.isdir(source) and not os.path.islink(source):
+        shutil.copytree(source, destination, symlinks=True, copy_function=copy_function)
+    elif os.path.islink(source):
+        os.symlink(os.readlink(source), destination)
+    else:
+        copy_function(source, destination)
+    return destination
+
+
+def path_size(path):
+    """
+    Returns the size in bytes of a file, or of all files below a directory
+
+    :param path: (str) File or directory path
+    :return: (int) Size in bytes
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            filepath = os.path.join(root, name)
+            if not os.path.islink(filepath):
+                total += os.path.getsize(filepath)
+    return total
+
+
+def remove_path(path):
+    """
+    Removes a file or directory tree, ignoring paths which no longer exist
+
+    :param path: (str) Path to remove
+    :return: None
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+class DiskCache:
+    """
+    Least-recently-used cache of files or directories stored below a root directory.
+
+    Entries are tracked in an index file guarded by an exclusive flock, so several
+    shippy processes can share the same cache.
+    """
+
+    def __init__(self, root, max_size):
+        """
+        Constructor
+
+        :param root: (str) Directory holding cache entries and the index
+        :param max_size: (int) Disk budget in bytes
+        """
+        self.root = root
+        self.max_size = max_size
+        self.index_path = os.path.join(root, INDEX_FILENAME)
+        create_directory(root)
+
+    @contextmanager
+    def _locked(self):
+        """
+        Holds the cache-wide lock and yields the loaded index, which is written
+        back when the block exits cleanly
+
+        :return: (dict) Index mapping keys to entry metadata
+        """
+        with open(os.path.join(self.root, LOCK_FILENAME), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                index = self._read_index()
+                yield index
+                self._write_index(index)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        tmp_path = "{0}.tmp".format(self.index_path)
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def entry_path(self, key):
+        """
+        Returns the path an entry for the given key is stored at
+
+        :param key: (str) Cache key
+        :return: (str) Path below the cache root
+        """
+        return os.path.join(self.root, key)
+
+    def lookup(self, key):
+        """
+        Returns metadata for a cached entry, marking it as recently used
+
+        :param key: (str) Cache key
+        :return: (dict) Entry metadata, or None on a miss
+        """
+        with self._locked() as index:
+            entry = index.get(key)
+            if entry is None:
+                return None
+            if not os.path.lexists(self.entry_path(key)):
+                LOGGER.warning("Cache entry %s is missing from disk, dropping it", key)
+                del index[key]
+                return None
+            entry["last_access"] = time.time()
+            return dict(entry)
+
+    def _staging_directory(self):
+        """
+        Creates a private directory below the root to prepare an entry in, so concurrent
+        stores of the same key, from any thread or process, never share files
+
+        :return: (str) Directory path
+        """
+        return tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=self.root)
+
+    def store(self, key, source, **metadata):
+        """
+        Adds source to the cache under key, then evicts old entries to stay under budget.
+        Files are hardlinked where possible, directories are moved. When another store of
+        the same key finished first, its entry is kept and source is left out.
+
+        :param key: (str) Cache key
+        :param source: (str) File or directory to add
+        :param metadata: Extra fields recorded alongside the entry
+        :return: (str) Path to the cached entry
+        """
+        target = self.entry_path(key)
+        staging_dir = self._staging_directory()
+        try:
+            staging = os.path.join(staging_dir, "entry")
+            if os.path.isdir(source):
+                shutil.move(source, staging)
+            else:
+                link_or_copy(source, staging)
+            size = path_size(staging)
+
+            with self._locked() as index:
+                if key in index and os.path.lexists(target):
+                    LOGGER.info("Cache entry %s was stored concurrently, keeping the first", key)
+                    index[key]["last_access"] = time.time()
+                    return target
+                remove_path(target)
+                os.replace(staging, target)
+                entry = dict(metadata)
+                entry.update({"size": size, "last_access": time.time()})
+                index[key] = entry
+                self._evict(index, keep=key)
+            return target
+        finally:
+            remove_path(staging_dir)
+
+    def discard(self, key):
+        """
+        Removes an entry from the cache
+
+        :param key: (str) Cache key
+        :return: None
+        """
+        with self._locked() as index:
+            index.pop(key, None)
+            remove_path(self.entry_path(key))
+
+    def _evict(self, index, keep=None):
+        """
+        Removes least-recently-used entries until the cache fits its budget
+
+        :param index: (dict) Locked index to modify
+        :param keep: (str) Key which must not be evicted
+        :return: None
+        """
+        total = sum(entry["size"] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]["last_access"]):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            LOGGER.info("Evicting cache entry: %s", key)
+            total -= index.pop(key)["size"]
+            remove_path(self.entry_path(key))
+
+
+class ArchiveCache(DiskCache):
+    """
+    Caches downloaded repository archives keyed by repository, sha and archive format
+    """
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates an archive cache from the optional `archive_cache` config section
+
+        :param config: (dict) Configuration object as parsed by shippy.config
+        :return: (ArchiveCache) Cache instance, or None if caching is disabled
+        """
+        cache_config = config.get("archive_cache", {})
+        if not cache_config.get("enabled", True):
+            return None
+        path = cache_config.get("path", DEFAULT_ARCHIVE_CACHE_DIR)
+        max_size_mb = cache_config.get("max_size_mb", DEFAULT_ARCHIVE_CACHE_SIZE_MB)
+        return cls(path, int(max_size_mb * 1024 * 1024))
+
+    @staticmethod
+    def make_key(repository, sha, format):
+        """
+        Generates the cache key for an archive
+
+        :param repository: (str) Repository URL
+        :param sha: (str) Commit hash
+        :param format: (str) Archive format
+        :return: (str) Cache key
+        """
+        identity = "{0}\n{1}\n{2}".format(repository, sha, format)
+        return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+    def get(self, repository, sha, format, destination):
+        """
+        Places a cached archive at destination after checking it against the digest recorded
+        at download time. Corrupt entries are discarded.
+
+        :param repository: (str) Repository URL
+        :param sha: (str) Commit hash
+        :param format: (str) Archive format
+        :param destination: (str) Path to place the archive at
+        :return: (bool) True on a cache hit
+        """
+        key = self.make_key(repository, sha, format)
+        entry = self.lookup(key)
+        if entry is None:
+            return False
+
+        link_or_copy(self.entry_path(key), destination)
+        if file_digest(destination) != entry["digest"]:
+            LOGGER.warning("Cached archive for %s@%s failed digest check, discarding", repository, sha)
+            os.remove(destination)
+            self.discard(key)
+            return False
+
+        LOGGER.info("Using cached archive for %s@%s", repository, sha)
+        return True
+
+    def put(self, repository, sha, format, source, digest):
+        """
+        Adds a downloaded archive to the cache
+
+        :param repository: (str) Repository URL
+        :param sha: (str) Commit hash
+        :param format: (str) Archive format
+        :param source: (str) Path to the downloaded archive
+        :param digest: (str) sha256 hex digest of the archive
+        :return: (str) Path to the cached archive
+        """
+        key = self.make_key(repository, sha, format)
+        return self.store(key, source, digest=digest, repository=repository, sha=sha, format=format)
+
+
+class BuildCache(DiskCache):
+    """
+    Caches the outputs of build commands keyed by the command and the contents of its input files
+    """
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates a build cache from the optional `build_cache` config section
+
+        :param config: (dict) Configuration object as parsed by shippy.config
+        :return: (BuildCache) Cache instance, or None if caching is disabled
+        """
+        cache_config = config.get("build_cache", {})
+        if not cache_config.get("enabled", True):
+            return None
+        path = cache_config.get("path", DEFAULT_BUILD_CACHE_DIR)
+        max_size_mb = cache_config.get("max_size_mb", DEFAULT_BUILD_CACHE_SIZE_MB)
+        return cls(path, int(max_size_mb * 1024 * 1024))
+
+    @staticmethod
+    def make_key(cmd, inputs, sourcecode_path, extra=None):
+        """
+        Generates the cache key for a command from the command string and its input files.
+        Input entries may be globs; missing inputs are part of the key too.
+
+        :param cmd: (str) Command string
+        :param inputs: (list) Input files or globs relative to sourcecode_path
+        :param sourcecode_path: (str) Path the command runs in
+        :param extra: (dict) Additional values the outputs depend on. Default: None
+        :return: (str) Cache key
+        """
+        digest = hashlib.sha256()
+        digest.update(cmd.encode("utf-8"))
+        digest.update(json.dumps(extra or {}, sort_keys=True).encode("utf-8"))
+        for pattern in inputs:
+            digest.update(b"\0" + pattern.encode("utf-8"))
+            matches = sorted(glob.glob(os.path.join(sourcecode_path, pattern)))
+            for path in matches:
+                if os.path.isfile(path):
+                    relative = os.path.relpath(path, sourcecode_path)
+                    digest.update("\0{0}\0{1}".format(relative, file_digest(path)).encode("utf-8"))
+        return digest.hexdigest()
+
+    def restore(self, key, outputs, sourcecode_path):
+        """
+        Restores cached outputs into sourcecode_path. Files are reflinked where the filesystem
+        supports it, else copied. They are never hardlinked, as later build steps may modify
+        them in place and would change the cache entry too.
+
+        :param key: (str) Cache key
+        :param outputs: (list) Output paths relative to sourcecode_path
+        :param sourcecode_path: (str) Path to restore into
+        :return: (bool) True on a cache hit
+        """
+        if self.lookup(key) is None:
+            return False
+
+        entry_path = self.entry_path(key)
+        try:
+            for output in outputs:
+                cached = os.path.join(entry_path, output)
+                target = os.path.join(sourcecode_path, output)
+                if os.path.lexists(cached):
+                    link_tree(cached, target, link=False)
+                else:
+                    remove_path(target)
+        except OSError as e:
+            # Most likely evicted by another process while restoring
+            LOGGER.warning("Could not restore cache entry %s: %s", key, e)
+            return False
+        return True
+
+    def save(self, key, outputs, sourcecode_path):
+        """
+        Adds the outputs of a command to the cache
+
+        :param key: (str) Cache key
+        :param outputs: (list) Output paths relative to sourcecode_path
+        :param sourcecode_path: (str) Path the command ran in
+        :return: (str) Path to the cached entry
+        """
+        staging = self._staging_directory()
+        try:
+            for output in outputs:
+                source = os.path.join(sourcecode_path, output)
+                if os.path.lexists(source):
+                    # Reflinked or copied, as commands running later may still modify the outputs in place
+                    link_tree(source, os.path.join(staging, output), link=False)
+                else:
+                    LOGGER.warning("Build output does not exist, not caching it: %s", source)
+            return self.store(key, staging)
+        finally:
+            remove_path(staging)
@@ -18,94 +18,225 @@ shippy.cli
 ==========
 
 Command-line entrypoint
+
+Subcommands import what they need when they run, so quick commands don't pay for loading
+docker, requests, jinja2 and validictory.
 """
 import logging
 import argh
-from shippy.repository_archive import RepositoryArchive
-from shippy.data_volume import DataVolume
-from shippy.config_loader import ConfigLoader
-from shippy.container_stack import ContainerStack
-from shippy import utils
 
 LOGGER = logging.getLogger(__name__)
 
 
+def read_shas(shas, sha_file=None):
+    """
+    Collects the commit hashes to deploy from the arguments and an optional file, dropping
+    duplicates while keeping their order
+
+    :param shas: (list) Commit hashes given as arguments
+    :param sha_file: (str) Path to a file with one commit hash per line, `#` starts a comment. Default: None
+    :return: (list) Commit hashes
+    """
+    shas = list(shas or [])
+    if sha_file:
+        with open(sha_file) as f:
+            shas.extend(line.split("#", 1)[0].strip() for line in f)
+    return list(dict.fromkeys(sha for sha in shas if sha))
+
+
 @argh.arg("configpath", type=str, help="Path to build config")
 @argh.arg("appconfig", help="Path to application config")
-@argh.arg("sha", type=str, help="Commit hash to build source from")
+@argh.arg("sha", type=str, nargs="*", help="Commit hashes to build source from")
+@argh.arg("--sha-file", type=str, help="File listing commit hashes to deploy, one per line", default=None)
+@argh.arg("--parent-sha", type=str, help="Parent commit hash whose data image layers may be reused. Looked up on github if unspecified", default=None)
+@argh.arg("--app", type=str, help="Application to deploy from a multi-app build config", default=None)
+@argh.arg("--resume", help="Skip the stages an interrupted run completed, if their outputs are intact", default=False)
+@argh.arg("--force", help="Fetch and rebuild even when the data image was built from the same inputs", default=False)
+@argh.arg("--profile", type=str, help="Directory to write a cProfile dump of each stage to, readable with pstats", default=None)
 def deploy_stack(**kwargs):
     """
-    Deploys an application stack
+    Deploys an application stack for each given commit hash. Several hashes are deployed
+    through a staged pipeline, so fetches, builds and image builds overlap.
     """
-    if not kwargs["sha"]:
-        # raise KeyError("Missing --sha")
-        LOGGER.error("You must specify a SHA with the --sha flag")
-    sha = kwargs["sha"]
+    shas = read_shas(kwargs["sha"], kwargs.get("sha_file"))
+    if not shas:
+        LOGGER.error("You must specify at least one SHA, as an argument or with --sha-file")
+        raise SystemExit(1)
 
     if not kwargs["configpath"]:
         # raise KeyError("Missing --configpath")
         LOGGER.error("Missing --configpath")
     configpath = kwargs["configpath"]
 
-    # 1. load and parse build configuration file
-    LOGGER.info("Loading config...")
-    config_loader = ConfigLoader(config_filepath=configpath, sha=sha)
-    config = config_loader.get()
-
-    # Create work directory
-    workdir = "/tmp/shippy/archives/{app_name}_{sha}".format(app_name=config["app_name"], sha=sha)
-    utils.create_directory(workdir)
-
-    # 2. Fetch application sourcecode archive
-    LOGGER.info("About to fetch repo archive...")
-    repo = RepositoryArchive(config["application_repository"])
-    download_path = repo.fetch(kwargs["sha"], download_path=workdir)
-    LOGGER.info("Downloaded archive to: %s", download_path)
-
-    # 3. Unpack sourcecode archive
-    LOGGER.info("Downloaded archive to: %s", download_path)
-    LOGGER.info("Unpacking archive")
-    output_dir = utils.unpack_archive(download_path, config["app_name"], working_dir=workdir)
-    LOGGER.info("Unpacked archive into: %s", output_dir)
-
-    # 4. Run build commands
-    for cmd in config["application_build_cmds"]:
-        utils.execute_command(cmd, working_dir=output_dir)
-
-    # 5. Copy application config file into sourcecode path root
-    LOGGER.info("Copying application config file into: %s", output_dir)
-    utils.copy_file(kwargs["appconfig"], output_dir)
+    from docker import APIClient
+    from shippy.config_loader import ConfigLoader
+    from shippy.deployment import deploy_shas
 
-    # 6. Build docker sourcecode data volume
-    volume = DataVolume(output_dir, sha, config)
-    volume.build()
+    # 1. load and parse build configuration file, once for every hash
+    LOGGER.info("Loading config...")
+    config = ConfigLoader(config_filepath=configpath, sha=None, app=kwargs.get("app")).get()
+    docker_client = APIClient(base_url='unix://var/run/docker.sock')
+
+    # 2 - 8. Fetch, unpack, build and start each stack
+    failures = deploy_shas(config, shas, kwargs["appconfig"], parent_sha=kwargs.get("parent_sha"), docker_client=docker_client,
+                           resume=kwargs.get("resume", False), profile_dir=kwargs.get("profile"), force=kwargs.get("force", False))
+    if failures:
+        LOGGER.error("Failed to deploy %d of %d stacks: %s", len(failures), len(shas), ", ".join(failures))
+        raise SystemExit(1)
+    if len(shas) > 1:
+        LOGGER.info("All %d stacks are ready", len(shas))
+
+
+@argh.arg("--socket", type=str, help="UNIX socket to listen on. Default: /tmp/shippy/shippy.sock", default=None)
+@argh.arg("--listen", type=str, help="Listen on host:port instead of the UNIX socket, e.g. 127.0.0.1:8642", default=None)
+@argh.arg("--token", type=str, help="Token --listen requests must send in the X-Shippy-Token header. Default: $SHIPPY_DAEMON_TOKEN", default=None)
+@argh.arg("--workers", type=int, help="Number of jobs run at once. Default: 2", default=None)
+def run_daemon(**kwargs):
+    """
+    Runs the shippy daemon, accepting deploy, list and terminate requests over a local HTTP API
+    """
+    import os
+    from shippy.daemon import ShippyDaemon, DEFAULT_SOCKET_PATH, DEFAULT_WORKERS
+
+    address = None
+    if kwargs["listen"]:
+        host, _, port = kwargs["listen"].rpartition(":")
+        address = (host or "127.0.0.1", int(port))
+    daemon = ShippyDaemon(workers=kwargs["workers"] or DEFAULT_WORKERS)
+    try:
+        daemon.serve(socket_path=kwargs["socket"] or DEFAULT_SOCKET_PATH, address=address,
+                     token=kwargs["token"] or os.environ.get("SHIPPY_DAEMON_TOKEN"))
+    except ValueError as e:
+        LOGGER.error("%s, pass --token or listen on 127.0.0.1", e)
+        raise SystemExit(1)
+
+
+def format_age(seconds):
+    """
+    Formats a duration the way `docker ps` does, e.g. 3 minutes
 
-    # 7. Build and write docker-compose stack configuration
-    stack = ContainerStack(config, sha, output_dir, volume.get_name())
-    stack.write_compose_file()
+    :param seconds: (float) Duration
+    :return: (str)
+    """
+    for unit, length in (("day", 86400), ("hour", 3600), ("minute", 60)):
+        if seconds >= length:
+            count = int(seconds // length)
+            return "{0} {1}{2}".format(count, unit, "s" if count > 1 else "")
+    return "{0} seconds".format(max(int(seconds), 0))
 
-    # 8. Start docker-compose stack
-    LOGGER.info("Starting container stack")
-    stack.start()
-    LOGGER.info("Stack is ready, have a nice day!")
 
+def format_size(size):
+    """
+    Formats a byte count with a binary unit, e.g. 12.5MB
 
-@argh.arg("--sha", help="Commit hash to search for. If unspecified will return all running stacks", default="b37411239f70f538e198e238610a0e7e9c6b83b0")
+    :param size: (int) Bytes, None if unknown
+    :return: (str)
+    """
+    if size is None:
+        return "-"
+    for unit in ("B", "kB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return "{0:.0f}{1}".format(size, unit) if unit == "B" else "{0:.1f}{1}".format(size, unit)
+        size /= 1024.0
+
+
+@argh.arg("--sha", help="Commit hash to search for. If unspecified will return all stacks", default=None)
+@argh.arg("--app-name", help="Only list stacks of this application", default=None)
+@argh.arg("--size", help="Include the disk usage of the containers, slower", default=False)
+@argh.arg("--docker-socket", help="Docker daemon socket", default="/var/run/docker.sock")
 def list_stacks(**kwargs):
     """
-    Lists all running docker-compose stacks
-
-    :param kwargs:
-    :return:
+    Lists the stacks created by shippy, with their state, age and resource usage
     """
-    # 1. get list of all running containers with the shippy prefix
+    import time
+    from shippy.engine_api import EngineAPI
+    from shippy.container_stack import list_stacks as query_stacks
 
-    # 2. Build a prettytable chart
+    stacks = query_stacks(EngineAPI(kwargs["docker_socket"]), app_name=kwargs["app_name"], sha=kwargs["sha"],
+                          size=kwargs["size"])
 
-    # 3. Display table
+    now = time.time()
+    rows = [("STACK", "APP", "SHA", "STATE", "CONTAINERS", "AGE", "IMAGE SIZE", "DISK")]
+    rows += [(stack["stack"], stack["app"] or "-", stack["sha"] or "-", stack["state"],
+              "{0}/{1}".format(stack["running"], len(stack["containers"])), format_age(now - stack["created"]),
+              format_size(stack["image_size"]), format_size(stack["disk_size"]))
+             for stack in stacks]
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
 
 
 @argh.arg("--sha", help="Commit hash to terminate stack for", default=None)
+@argh.arg("--app-name", help="Only terminate the stack of this application", default=None)
+@argh.arg("--docker-socket", help="Docker daemon socket", default="/var/run/docker.sock")
 def terminate_stack(**kwargs):
+    """
+    Removes the containers, network and data image of a stack
+    """
     if not kwargs["sha"]:
         LOGGER.error("You must specify a stack to terminate with the --sha flag")
+        raise SystemExit(1)
+
+    from shippy.engine_api import EngineAPI
+    from shippy.container_stack import terminate_stacks
+
+    removed = terminate_stacks(EngineAPI(kwargs["docker_socket"]), app_name=kwargs["app_name"], sha=kwargs["sha"])
+    if not sum(removed.values()):
+        LOGGER.error("No stack found for %s", kwargs["sha"])
+        raise SystemExit(1)
+    LOGGER.info("Removed %d containers, %d networks and %d images", removed["containers"], removed["networks"], removed["images"])
+
+
+@argh.arg("--config", help="Build config whose `gc` section sets the policy", default=None)
+@argh.arg("--app", help="Application to read from a multi-app build config", default=None)
+@argh.arg("--max-stacks-per-app", type=int, help="Stacks kept per application", default=None)
+@argh.arg("--max-age-hours", type=float, help="Remove stacks not deployed for this long", default=None)
+@argh.arg("--disk-budget-mb", type=float, help="Disk space shippy's containers and data images may use", default=None)
+@argh.arg("--memory-budget-mb", type=float, help="Memory shippy's running containers may use", default=None)
+@argh.arg("--workers", type=int, help="Stacks removed at once. Default: 4", default=None)
+@argh.arg("--dry-run", help="Only print what would be removed", default=False)
+@argh.arg("--pin", help="Protect the stacks of this commit hash from garbage collection, then exit", default=None)
+@argh.arg("--unpin", help="Remove the pin of this commit hash, then exit", default=None)
+@argh.arg("--app-name", help="Application --pin and --unpin apply to. Default: every application", default=None)
+@argh.arg("--docker-socket", help="Docker daemon socket", default="/var/run/docker.sock")
+def collect_garbage(**kwargs):
+    """
+    Removes the least recently deployed stacks which break the garbage collection policy
+    """
+    import os
+    from shippy.journal import DeployJournal, DEFAULT_WORKSPACE, JOURNAL_FILENAME
+
+    journal = DeployJournal(os.path.join(DEFAULT_WORKSPACE, JOURNAL_FILENAME))
+    if kwargs["pin"] or kwargs["unpin"]:
+        if kwargs["pin"]:
+            journal.pin(kwargs["pin"], app_name=kwargs["app_name"])
+            LOGGER.info("Pinned %s", kwargs["pin"])
+        if kwargs["unpin"] and not journal.unpin(kwargs["unpin"], app_name=kwargs["app_name"]):
+            LOGGER.warning("%s was not pinned", kwargs["unpin"])
+        return
+
+    from shippy.engine_api import EngineAPI
+    from shippy.garbage_collector import GarbageCollector, GCPolicy, DEFAULT_GC_WORKERS
+
+    config = {}
+    if kwargs["config"]:
+        from shippy.config_loader import ConfigLoader
+        config = ConfigLoader(config_filepath=kwargs["config"], sha=None, app=kwargs["app"]).get()
+    policy = GCPolicy.from_config(config, **{key: kwargs[key] for key in
+                                             ("max_stacks_per_app", "max_age_hours", "disk_budget_mb", "memory_budget_mb")})
+    if not policy.enabled:
+        LOGGER.error("No garbage collection limit set, pass a limit or a config with a `gc` section")
+        raise SystemExit(1)
+
+    collector = GarbageCollector(EngineAPI(kwargs["docker_socket"]), policy, journal=journal, workspace=DEFAULT_WORKSPACE,
+                                 workers=kwargs["workers"] or config.get("gc", {}).get("workers", DEFAULT_GC_WORKERS))
+    evictions = collector.run(dry_run=kwargs["dry_run"])
+
+    import time
+    now = time.time()
+    rows = [("STACK", "LAST USED", "DISK", "MEMORY", "REASON")]
+    rows += [(stack["stack"], format_age(now - stack["last_used"]) + " ago", format_size(stack["disk_usage"]),
+              format_size(stack["memory_usage"]), reason) for stack, reason in evictions]
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
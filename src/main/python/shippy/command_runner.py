@@ -0,0 +1,417 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+shippy.command_runner
+=====================
+
+Runs shell commands as asyncio subprocesses on one event loop shared by the whole process.
+
+The loop lives on a background thread, so blocking code such as the stage workers submits
+commands and waits on the returned future, while coroutines can await run_async() directly.
+A process-wide limit bounds how many commands run at once, each command runs in its own
+process group so a timeout or cancellation also stops its children, and piped output reaches
+callbacks as batches of lines bounded in count and size.
+"""
+import os
+import time
+import signal
+import asyncio
+import logging
+import threading
+import subprocess
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONCURRENT = 8
+# Output is handed to callbacks once a batch reaches either bound, or has waited this long
+BATCH_MAX_LINES = 200
+BATCH_MAX_BYTES = 64 * 1024
+BATCH_INTERVAL = 0.2
+READ_SIZE = 64 * 1024
+# Seconds between SIGTERM and SIGKILL when stopping a command
+KILL_GRACE_PERIOD = 5
+
+
+class CommandResult:
+    """
+    Outcome of a finished command
+    """
+
+    def __init__(self, cmd, returncode, duration):
+        """
+        Constructor
+
+        :param cmd: (str) Shell command
+        :param returncode: (int) Exit status, negative when killed by a signal
+        :param duration: (float) Seconds the command ran for
+        """
+        self.cmd = cmd
+        self.returncode = returncode
+        self.duration = duration
+
+    def __repr__(self):
+        return "CommandResult({0!r}, returncode={1})".format(self.cmd, self.returncode)
+
+
+class OutputBatcher:
+    """
+    Splits a byte stream into lines and passes them to a callback in bounded batches
+    """
+
+    def __init__(self, stream, callback, max_lines=BATCH_MAX_LINES, max_bytes=BATCH_MAX_BYTES, interval=BATCH_INTERVAL):
+        """
+        Constructor
+
+        :param stream: (str) Stream name passed to the callback, "stdout" or "stderr"
+        :param callback: (callable) Called with the stream name and a list of decoded lines
+        :param max_lines: (int) Most lines per batch. Default: 200
+        :param max_bytes: (int) Most bytes per batch, longer lines are split. Default: 64KB
+        :param interval: (float) Seconds after which a partial batch is delivered. Default: 0.2
+        """
+        self.stream = stream
+        self.callback = callback
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.pending = []
+        self.size = 0
+        self.partial = b""
+        self.flushed_at = time.monotonic()
+
+    @property
+    def deadline(self):
+        """
+        :return: (float) Seconds until the pending lines are due, None when nothing is pending
+        """
+        if not self.pending:
+            return None
+        return max(self.flushed_at + self.interval - time.monotonic(), 0)
+
+    def feed(self, data):
+        """
+        Adds a chunk of output, delivering every batch it completes
+
+        :param data: (bytes) Output read from the process
+        :return: None
+        """
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        while len(self.partial) >= self.max_bytes:
+            lines.append(self.partial[:self.max_bytes])
+            self.partial = self.partial[self.max_bytes:]
+        for line in lines:
+            self._add(line)
+        if self.deadline == 0:
+            self.flush()
+
+    def _add(self, line):
+        self.pending.append(line.decode("utf-8", errors="replace").rstrip("\r"))
+        self.size += len(line)
+        if len(self.pending) >= self.max_lines or self.size >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        """
+        Delivers the pending lines, if any
+
+        :return: None
+        """
+        if self.pending:
+            lines, self.pending, self.size = self.pending, [], 0
+            try:
+                self.callback(self.stream, lines)
+            except Exception:
+                LOGGER.exception("Output callback failed")
+        self.flushed_at = time.monotonic()
+
+    def close(self):
+        """
+        Delivers the remaining output, including a final line without a newline
+
+        :return: None
+        """
+        if self.partial:
+            self._add(self.partial)
+            self.partial = b""
+        self.flush()
+
+
+class ChunkForwarder:
+    """
+    Passes each chunk read from a stream to a callback as is, for consumers such as log files
+    which have no use for lines
+    """
+
+    deadline = None
+
+    def __init__(self, stream, callback):
+        """
+        Constructor
+
+        :param stream: (str) Stream name passed to the callback, "stdout" or "stderr"
+        :param callback: (callable) Called with the stream name and the bytes read
+        """
+        self.stream = stream
+        self.callback = callback
+
+    def feed(self, data):
+        try:
+            self.callback(self.stream, data)
+        except Exception:
+            LOGGER.exception("Output callback failed")
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def log_output(stream, lines):
+    """
+    Default output callback, logging stdout as info and stderr as errors
+
+    :param stream: (str) "stdout" or "stderr"
+    :param lines: (list) Output lines
+    :return: None
+    """
+    level = logging.INFO if stream == "stdout" else logging.ERROR
+    LOGGER.log(level, "%s:\n%s", stream.upper(), "\n".join(lines))
+
+
+class CommandRunner:
+    """
+    Runs commands on a private event loop thread, at most max_concurrent at a time
+    """
+
+    def __init__(self, max_concurrent=DEFAULT_MAX_CONCURRENT):
+        """
+        Constructor
+
+        :param max_concurrent: (int) Most commands running at once. Default: 8
+        """
+        self.max_concurrent = max_concurrent
+        self.running = 0
+        self._loop = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        """
+        Returns the event loop, starting its thread on first use
+
+        :return: (asyncio.AbstractEventLoop)
+        """
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+                thread = threading.Thread(target=self._run_loop, args=(loop, ready), name="shippy-commands", daemon=True)
+                thread.start()
+                ready.wait()
+                self._loop = loop
+            return self._loop
+
+    def _run_loop(self, loop, ready):
+        asyncio.set_event_loop(loop)
+        self._slots = asyncio.Condition()
+        loop.call_soon(ready.set)
+        loop.run_forever()
+
+    def set_max_concurrent(self, max_concurrent):
+        """
+        Changes the concurrency limit. Commands already running are not affected.
+
+        :param max_concurrent: (int) Most commands running at once
+        :return: None
+        """
+        self.max_concurrent = max_concurrent
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._release(0), self._loop)
+
+    async def _acquire(self):
+        async with self._slots:
+            await self._slots.wait_for(lambda: self.running < self.max_concurrent)
+            self.running += 1
+
+    async def _release(self, count=1):
+        async with self._slots:
+            self.running -= count
+            self._slots.notify_all()
+
+    async def run_async(self, cmd, cwd=None, env=None, timeout=None, on_output=None, on_data=None, stdout=None,
+                        stderr=None, check=True):
+        """
+        Runs a shell command once a slot is free. Must be awaited on the runner's loop.
+
+        Output goes to the given files, else to on_data or on_output when set, else to the console.
+
+        :param cmd: (str) Shell command
+        :param cwd: (str) Working directory. Default: None, the current directory
+        :param env: (dict) Environment. Default: None, inherit
+        :param timeout: (float) Seconds before the command is killed. Default: None, no limit
+        :param on_output: (callable) Receives (stream name, lines) batches of piped output. Default: None
+        :param on_data: (callable) Receives (stream name, bytes) chunks of piped output, undecoded. Default: None
+        :param stdout: (file) File receiving stdout. Default: None
+        :param stderr: (file) File receiving stderr. Default: None
+        :param check: (bool) Raise when the command fails. Default: True
+        :return: (CommandResult)
+        :raises: (subprocess.CalledProcessError) If check is set and the command exits non-zero
+        :raises: (subprocess.TimeoutExpired) If the command ran out of time
+        """
+        await self._acquire()
+        try:
+            result = await self._run(cmd, cwd, env, timeout, on_output, on_data, stdout, stderr)
+        finally:
+            await self._release()
+
+        if check and result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, cmd)
+        return result
+
+    async def _run(self, cmd, cwd, env, timeout, on_output, on_data, stdout, stderr):
+        pipe = asyncio.subprocess.PIPE if on_output or on_data else None
+        began = time.monotonic()
+        process = await asyncio.create_subprocess_shell(cmd, cwd=cwd, env=env, start_new_session=True,
+                                                        stdout=stdout if stdout is not None else pipe,
+                                                        stderr=stderr if stderr is not None else pipe)
+        batchers = []
+        for name, stream in (("stdout", process.stdout), ("stderr", process.stderr)):
+            if stream is not None:
+                batchers.append((stream, ChunkForwarder(name, on_data) if on_data else OutputBatcher(name, on_output)))
+
+        try:
+            returncode = await asyncio.wait_for(self._communicate(process, batchers), timeout)
+        except asyncio.TimeoutError:
+            LOGGER.error("Command timed out after %ss: %s", timeout, cmd)
+            await self._kill(process)
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        except asyncio.CancelledError:
+            LOGGER.info("Cancelling command with pid %d: %s", process.pid, cmd)
+            await self._kill(process)
+            raise
+        return CommandResult(cmd, returncode, time.monotonic() - began)
+
+    async def _communicate(self, process, batchers):
+        await asyncio.gather(*(self._pump(stream, batcher) for stream, batcher in batchers))
+        return await process.wait()
+
+    async def _pump(self, stream, batcher):
+        """
+        Feeds a pipe into its batcher, delivering a partial batch once it is due
+
+        :param stream: (asyncio.StreamReader) Process pipe
+        :param batcher: (OutputBatcher|ChunkForwarder) Consumer of the pipe
+        :return: None
+        """
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(stream.read(READ_SIZE), batcher.deadline)
+                except asyncio.TimeoutError:
+                    batcher.flush()
+                    continue
+                if not data:
+                    break
+                batcher.feed(data)
+        finally:
+            batcher.close()
+
+    async def _kill(self, process):
+        """
+        Stops the process group of a command, escalating to SIGKILL after the grace period
+
+        :param process: (asyncio.subprocess.Process) Running command
+        :return: None
+        """
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(process.pid, sig)
+            except ProcessLookupError:
+                pass
+            try:
+                await asyncio.wait_for(process.wait(), KILL_GRACE_PERIOD)
+                return
+            except asyncio.TimeoutError:
+                LOGGER.warning("Command with pid %d ignored %s", process.pid, sig.name)
+
+    def submit(self, cmd, **kwargs):
+        """
+        Starts a command from any thread. Cancelling the returned future kills the command.
+
+        :param cmd: (str) Shell command
+        :param kwargs: See run_async
+        :return: (concurrent.futures.Future) Resolves to a CommandResult
+        """
+        return asyncio.run_coroutine_threadsafe(self.run_async(cmd, **kwargs), self.loop)
+
+    def run(self, cmd, **kwargs):
+        """
+        Runs a command from any thread other than the runner's, waiting for it to finish
+
+        :param cmd: (str) Shell command
+        :param kwargs: See run_async
+        :return: (CommandResult)
+        """
+        future = self.submit(cmd, **kwargs)
+        try:
+            return future.result()
+        except BaseException:
+            # Also reached on KeyboardInterrupt, which must not leave the command running
+            future.cancel()
+            raise
+
+
+_DEFAULT_RUNNER = None
+_DEFAULT_RUNNER_LOCK = threading.Lock()
+
+
+def get_runner():
+    """
+    Returns the process-wide runner, so every command counts towards the same limit
+
+    :return: (CommandRunner)
+    """
+    global _DEFAULT_RUNNER
+    with _DEFAULT_RUNNER_LOCK:
+        if _DEFAULT_RUNNER is None:
+            _DEFAULT_RUNNER = CommandRunner()
+        return _DEFAULT_RUNNER
+
+
+def configure(config):
+    """
+    Applies the optional `max_concurrent_commands` setting to the process-wide runner
+
+    :param config: (dict) Configuration object as parsed by shippy.config
+    :return: None
+    """
+    if "max_concurrent_commands" in config:
+        get_runner().set_max_concurrent(config["max_concurrent_commands"])
+
+
+def run(cmd, **kwargs):
+    """
+    Runs a command on the process-wide runner and logs its output
+
+    :param cmd: (str) Shell command
+    :param kwargs: See CommandRunner.run_async
+    :return: (CommandResult)
+    """
+    kwargs.setdefault("on_output", log_output)
+    LOGGER.info("Executing command: %s", cmd)
+    return get_runner().run(cmd, **kwargs)
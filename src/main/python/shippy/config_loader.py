@@ -19,67 +19,369 @@ shippy.config
 
 Parses and validates the build config file
 
+A config file either holds a single application config, or configs for several applications
+sharing defaults:
+
+    {
+        "defaults": {...},
+        "apps": {
+            "ghost": {"application_repository": "...", ...},
+            "ghost-canary": {"extends": "ghost", "application_image": "..."}
+        }
+    }
+
+Each app config is merged over the config it `extends`, or over the defaults. Nested objects are
+merged key by key, any other value replaces the inherited one.
 """
+import os
 import json
-import validictory
+import hashlib
 import logging
+import threading
+import validictory
 
-from collections import ChainMap
+from copy import deepcopy
 from shippy.utils import get_repository_appname
 
 LOGGER = logging.getLogger(__name__)
 
+CONFIG_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "application_image": {
+            "type": "string",
+            "required": True
+        },
+        "application_repository": {
+            "type": "string",
+            "required": True
+        },
+        "application_source_mountpoint": {
+            "type": "string",
+            "required": True
+        },
+        "application_config": {
+            "type": "object",
+            "required": True,
+        },
+        "database_image": {
+            "type": "string",
+            "required": True
+        },
+        "database_config": {
+            "type": "object",
+            "required": True
+        },
+        "application_build_cmds": {
+            "type": "array",
+            "required": False,
+            "items": {
+                "type": ["string", "object"],
+                "properties": {
+                    "cmd": {"type": "string", "required": True},
+                    "inputs": {"type": "array", "items": {"type": "string"}, "required": False},
+                    "outputs": {"type": "array", "items": {"type": "string"}, "required": False},
+                    "name": {"type": "string", "required": False},
+                    "depends_on": {"type": "array", "items": {"type": "string"}, "required": False},
+                    "env": {"type": "object", "required": False},
+                    "cwd": {"type": "string", "required": False},
+                    "timeout": {"type": "number", "minimum": 0, "required": False}
+                }
+            }
+        },
+        "application_build_workers": {
+            "type": "integer",
+            "minimum": 1,
+            "required": False
+        },
+        "max_concurrent_commands": {
+            "type": "integer",
+            "minimum": 1,
+            "required": False
+        },
+        "build_cache": {
+            "type": "object",
+            "required": False,
+            "properties": {
+                "enabled": {"type": "boolean", "required": False},
+                "path": {"type": "string", "required": False},
+                "max_size_mb": {"type": "number", "required": False}
+            }
+        },
+        "archive_stream": {
+            "type": "boolean",
+            "required": False
+        },
+        "data_volume": {
+            "type": "object",
+            "required": False,
+            "properties": {
+                "context": {"type": "string", "enum": ["directory", "stream"], "required": False},
+                "overlay_paths": {"type": "array", "items": {"type": "string"}, "required": False},
+                "layered": {"type": "boolean", "required": False},
+                "vendor_paths": {"type": "array", "items": {"type": "string"}, "required": False},
+                "include": {"type": "array", "items": {"type": "string"}, "required": False},
+                "exclude": {"type": "array", "items": {"type": "string"}, "required": False}
+            }
+        },
+        "archive_cache": {
+            "type": "object",
+            "required": False,
+            "properties": {
+                "enabled": {"type": "boolean", "required": False},
+                "path": {"type": "string", "required": False},
+                "max_size_mb": {"type": "number", "required": False}
+            }
+        },
+        "stack_backend": {
+            "type": "string",
+            "enum": ["compose", "engine"],
+            "required": False
+        },
+        "readiness": {
+            "type": "object",
+            "required": False,
+            "properties": {
+                "timeout": {"type": "number", "minimum": 0, "required": False},
+                "services": {
+                    "type": "object",
+                    "required": False,
+                    "additionalProperties": {
+                        "type": "object",
+                        "properties": {
+                            "tcp": {"type": ["integer", "object"], "required": False},
+                            "http": {"type": "object", "required": False},
+                            "log": {"type": "string", "required": False}
+                        }
+                    }
+                },
+                "warmup": {
+                    "type": "object",
+                    "required": False,
+                    "properties": {
+                        "service": {"type": "string", "required": False},
+                        "host": {"type": "string", "required": False},
+                        "port": {"type": "integer", "required": True},
+                        "path": {"type": "string", "required": False},
+                        "requests": {"type": "integer", "minimum": 1, "required": False},
+                        "concurrency": {"type": "integer", "minimum": 1, "required": False}
+                    }
+                }
+            }
+        },
+        "pipeline_concurrency": {
+            "type": "object",
+            "required": False,
+            "properties": {
+                stage: {"type": "integer", "minimum": 1, "required": False}
+                for stage in ("fetch", "unpack", "build", "volume", "compose", "start")
+            }
+        },
+        "gc": {
+            "type": "object",
+            "required": False,
+            "properties": {
+                "max_stacks_per_app": {"type": "integer", "minimum": 1, "required": False},
+                "max_age_hours": {"type": "number", "minimum": 0, "required": False},
+                "disk_budget_mb": {"type": "number", "minimum": 0, "required": False},
+                "memory_budget_mb": {"type": "number", "minimum": 0, "required": False},
+                "pinned": {"type": "array", "items": {"type": "string"}, "required": False},
+                "before_deploy": {"type": "boolean", "required": False},
+                "workers": {"type": "integer", "minimum": 1, "required": False}
+            }
+        },
+        "tracing": {
+            "type": "object",
+            "required": False,
+            "properties": {
+                "jsonl_path": {"type": "string", "required": False},
+                "prometheus_path": {"type": "string", "required": False},
+                "profile_dir": {"type": "string", "required": False}
+            }
+        }
+    }
+}
 
-class ConfigLoader:
+# Validation without fail-fast collects errors on the validator, fail-fast keeps it stateless
+# so one instance can be shared between threads
+SCHEMA_VALIDATOR = validictory.SchemaValidator(fail_fast=True)
+
+
+def merge_config(base, override):
+    """
+    Merges two config dicts, recursing into nested objects
+
+    :param base: (dict) Inherited config
+    :param override: (dict) Config taking precedence
+    :return: (dict) New merged config
+    """
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
 
-    def __init__(self, config_filepath, sha):
-        self.config_filepath = config_filepath
-        self.sha = sha
-        self.config = self._open()
 
-    def _load(self):
+class _ConfigFile:
+    """
+    Parsed contents of one config file, along with its resolved app configs
+    """
+
+    def __init__(self, raw, mtime_ns, size, digest):
+        self.raw = raw
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.digest = digest
+        self.resolved = {}
+
+    @property
+    def multi_app(self):
+        return "apps" in self.raw
+
+    def apps(self):
+        return sorted(self.raw["apps"]) if self.multi_app else []
+
+    def resolve(self, app):
         """
-        Loads and parses config file
+        Returns the merged, not yet validated config of an app
 
-        :param config_filepath: (str) Filepath to config file
-        :return: (dict) Parsed config
+        :param app: (str) App name, or None for single-app files
+        :return: (dict)
+        :raises: (ValueError) On unknown apps or inheritance cycles
         """
-        with open(self.config_filepath) as config_file:
-            config = json.load(config_file)
+        if not self.multi_app:
+            if app is not None:
+                raise ValueError("Config file holds a single application, cannot select app: {0}".format(app))
+            return self.raw
+
+        apps = self.raw["apps"]
+        if app is None:
+            if len(apps) != 1:
+                raise ValueError("Config file holds several applications, choose one of: {0}".format(", ".join(self.apps())))
+            app = next(iter(apps))
+
+        chain = []
+        current = app
+        while current is not None:
+            if current not in apps:
+                raise ValueError("Unknown app: {0}".format(current))
+            if current in chain:
+                raise ValueError("Config inheritance cycle: {0}".format(" -> ".join(chain + [current])))
+            chain.append(current)
+            current = apps[current].get("extends")
+
+        config = self.raw.get("defaults", {})
+        for name in reversed(chain):
+            config = merge_config(config, {key: value for key, value in apps[name].items() if key != "extends"})
         return config
 
-    def _compute_config(self, config):
+
+class ConfigStore:
+    """
+    Caches parsed and validated configs. A file is re-read only when its mtime or size changes,
+    and re-parsed only when its content hash changes. App configs are resolved and validated on
+    first request.
+    """
+
+    def __init__(self):
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def _load_file(self, config_filepath):
         """
-        Generates additional config to append to main config object
-        based on computed values
+        Returns the cached contents of a config file, refreshing them if the file changed
 
-        :return: (dict)
+        :param config_filepath: (str) Path to the config file
+        :return: (_ConfigFile)
         """
-        extra_config = {
-            "app_name": get_repository_appname(config["application_repository"]),
-            "app_sha": self.sha
-        }
+        path = os.path.abspath(config_filepath)
+        stat = os.stat(path)
+        cached = self._files.get(path)
+        if cached and (cached.mtime_ns, cached.size) == (stat.st_mtime_ns, stat.st_size):
+            return cached
 
-        return extra_config
+        with open(path, "rb") as config_file:
+            data = config_file.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if cached and cached.digest == digest:
+            # Touched but unchanged, keep the resolved configs
+            cached.mtime_ns, cached.size = stat.st_mtime_ns, stat.st_size
+            return cached
 
-    def _open(self):
+        LOGGER.debug("Parsing config file: %s", path)
+        entry = _ConfigFile(json.loads(data.decode("utf-8")), stat.st_mtime_ns, stat.st_size, digest)
+        self._files[path] = entry
+        return entry
+
+    def apps(self, config_filepath):
         """
-        Returns complete config object
+        Lists the apps defined in a config file
 
-        :return: (dict) Config object
+        :param config_filepath: (str) Path to the config file
+        :return: (list) App names, empty for single-app files
         """
-        # Read and validate config
-        original_config = self._load()
-        self.validate(original_config)
+        with self._lock:
+            return self._load_file(config_filepath).apps()
 
-        # Generate additional computed config
-        extra_config = self._compute_config(original_config)
+    def get(self, config_filepath, app=None, sha=None):
+        """
+        Returns the validated config of an app
 
-        # Stitch the dictionaries together
-        config = dict(ChainMap(extra_config, original_config))
+        :param config_filepath: (str) Path to the config file
+        :param app: (str) App to select from a multi-app file. Default: None, the file's only app
+        :param sha: (str) Commit hash recorded as app_sha. Default: None
+        :return: (dict) Config object, owned by the caller
+        :raises: (ValueError) On invalid configs, unknown apps or inheritance cycles
+        """
+        with self._lock:
+            entry = self._load_file(config_filepath)
+            if app not in entry.resolved:
+                config = entry.resolve(app)
+                ConfigLoader.validate(config)
+                entry.resolved[app] = config
+            config = deepcopy(entry.resolved[app])
 
+        # Computed values take precedence over the file, as before
+        config["app_name"] = get_repository_appname(config["application_repository"])
+        config["app_sha"] = sha
         return config
 
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+
+
+_DEFAULT_STORE = ConfigStore()
+
+
+def get_config_store():
+    """
+    Returns the process-wide config store
+
+    :return: (ConfigStore)
+    """
+    return _DEFAULT_STORE
+
+
+class ConfigLoader:
+
+    def __init__(self, config_filepath, sha, app=None, store=None):
+        self.config_filepath = config_filepath
+        self.sha = sha
+        self.app = app
+        self.store = store or get_config_store()
+        self.config = self._open()
+
+    def _open(self):
+        """
+        Returns complete config object
+
+        :return: (dict) Config object
+        """
+        return self.store.get(self.config_filepath, app=self.app, sha=self.sha)
+
     def get(self):
         """
         Returns the config
@@ -97,38 +399,8 @@ class ConfigLoader:
         :return: (dict) Validated config
         :raises: (ValueError) when invalid config is found
         """
-        schema = {
-            "type": "object",
-            "properties": {
-                "application_image": {
-                    "type": "string",
-                    "required": True
-                },
-                "application_repository": {
-                    "type": "string",
-                    "required": True
-                },
-                "application_source_mountpoint": {
-                    "type": "string",
-                    "required": True
-                },
-                "application_config": {
-                    "type": "object",
-                    "required": True,
-                },
-                "database_image": {
-                    "type": "string",
-                    "required": True
-                },
-                "database_config": {
-                    "type": "object",
-                    "required": True
-                }
-            }
-        }
-
         try:
-            validictory.validate(config, schema)
+            SCHEMA_VALIDATOR.validate(config, CONFIG_SCHEMA)
         except ValueError as e:
             LOGGER.error("Invalid config: %s", e)
             raise e
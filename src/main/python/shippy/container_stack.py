@@ -19,14 +19,67 @@ shippy.container_stack
 
 Builds docker-compose configurations for the stacks, and handles setup and teardown of container resources
 """
+import re
 import logging
-from shippy import utils
 from copy import deepcopy
 
-from shippy.utils import load_template, get_repository_appname, run_command
+from shippy.utils import load_template, get_repository_appname
 
 LOGGER = logging.getLogger(__name__)
 
+# Labels docker-compose puts on the resources it creates, so both backends can manage the same stacks
+PROJECT_LABEL = "com.docker.compose.project"
+SERVICE_LABEL = "com.docker.compose.service"
+NUMBER_LABEL = "com.docker.compose.container-number"
+ONEOFF_LABEL = "com.docker.compose.oneoff"
+CONFIG_HASH_LABEL = "com.docker.compose.config-hash"
+
+# Labels identifying the resources shippy creates, so stacks can be found with label filters
+APP_LABEL = "io.shippy.app"
+SHA_LABEL = "io.shippy.sha"
+STACK_LABEL = "io.shippy.stack"
+# Digest of the inputs a data image was built from, see Deployment.prebuilt
+INPUTS_LABEL = "io.shippy.inputs"
+
+
+def normalize_project_name(name):
+    """
+    Normalises a project name the way docker-compose does
+
+    :param name: (str) Project name
+    :return: (str)
+    """
+    return re.sub(r"[^-_a-z0-9]", "", name.lower())
+
+
+def shippy_labels(app_name, sha):
+    """
+    Returns the labels put on every image, network and container shippy creates for a stack
+
+    :param app_name: (str) Application name
+    :param sha: (str) Commit hash
+    :return: (dict)
+    """
+    stack_id = normalize_project_name("{app_name}_{sha}".format(app_name=app_name, sha=sha))
+    return {APP_LABEL: app_name, SHA_LABEL: sha, STACK_LABEL: stack_id}
+
+
+def label_filters(app_name=None, sha=None, stack=None):
+    """
+    Builds label filters matching shippy resources, all given values must match
+
+    :param app_name: (str) Application name. Default: None, any
+    :param sha: (str) Commit hash. Default: None, any
+    :param stack: (str) Stack id. Default: None, any
+    :return: (dict) Filters for the docker API
+    """
+    labels = [STACK_LABEL if stack is None else "{0}={1}".format(STACK_LABEL, stack)]
+    if app_name:
+        labels.append("{0}={1}".format(APP_LABEL, app_name))
+    if sha:
+        labels.append("{0}={1}".format(SHA_LABEL, sha))
+    return {"label": labels}
+
 
 class ContainerStack:
 
@@ -36,6 +89,7 @@ class ContainerStack:
         self.working_dir = working_dir
         self.volume_tag = volume_tag
         self.compose_filepath = None
+        self.project = normalize_project_name("{app_name}_{sha}".format(app_name=self.config["app_name"], sha=self.sha))
 
     def _generate_name(self):
         """
@@ -47,6 +101,57 @@ class ContainerStack:
         stack_name = "{repo_name}_{sha}".format(repo_name=repo_name, sha=self.sha)
         return stack_name
 
+    def container_name(self, service):
+        """
+        Returns the name of a service's container, as docker-compose names it
+
+        :param service: (str) Service name
+        :return: (str)
+        """
+        return "{project}_{service}_1".format(project=self.project, service=service)
+
+    def services(self):
+        """
+        Describes the services of the stack, mirroring templates/docker-compose.yml.j2
+
+        :return: (list) Service dicts
+        """
+        data = self._assemble_template_data()
+        app_name = data["application_name"]
+        source_data = "{app_name}_source_data".format(app_name=app_name)
+        return [
+            {
+                "name": source_data,
+                "image": data["data_volume_tag"],
+                "depends_on": []
+            },
+            {
+                "name": "db",
+                "image": data["db_image_tag"],
+                "environment": data["database_config"],
+                "restart": "always",
+                "depends_on": []
+            },
+            {
+                "name": "{app_name}_app".format(app_name=app_name),
+                "image": data["app_image_tag"],
+                "environment": data["application_config"],
+                "network_mode": "bridge",
+                "volumes_from": [source_data],
+                "restart": "always",
+                "hostname": "{app_name}_{sha}.dev.internal".format(app_name=app_name, sha=self.sha),
+                "depends_on": [source_data]
+            }
+        ]
+
+    def labels(self):
+        """
+        Returns the labels of the stack's resources
+
+        :return: (dict)
+        """
+        return shippy_labels(self.config["app_name"], self.sha)
+
     def _assemble_template_data(self):
         """
         Assembles data for use by the jinja config template
@@ -61,7 +166,8 @@ class ContainerStack:
             "application_name": get_repository_appname(self.config["application_repository"]),
             "app_image_tag": self.config["application_image"],
             "application_config": self.config["application_config"],
-            "sha": self.sha
+            "sha": self.sha,
+            "labels": self.labels()
         }
         return data
 
@@ -107,9 +213,16 @@ class ContainerStack:
 
         :return:
         """
+        import subprocess
+        from shippy import command_runner
+
         context = "{app_name}_{sha}".format(app_name=self.config["app_name"], sha=self.sha)
         cmd = "/usr/local/bin/docker-compose -p {context} up -d".format(context=context)
-        utils.execute_command(cmd, working_dir=self.working_dir)
+        try:
+            command_runner.run(cmd, cwd=self.working_dir)
+        except subprocess.SubprocessError as e:
+            LOGGER.error(e)
+            raise SystemExit(1)
 
     def stop(self):
         """
@@ -119,7 +232,7 @@ class ContainerStack:
         """
         context = "{app_name}_{sha}".format(app_name=self.config["app_name"], sha=self.sha)
         cmd = "/usr/local/bin/docker-compose -p {context} --project-directory {project_dir} stop".format(context=context, project_dir=self.working_dir)
-        run_command(cmd)
+        self._run_teardown(cmd)
 
     def terminate(self):
         """
@@ -129,11 +242,139 @@ class ContainerStack:
         """
         context = "{app_name}_{sha}".format(app_name=self.config["app_name"], sha=self.sha)
         cmd = "/usr/local/bin/docker-compose -p {context} --project-directory {project_dir} down --rmi all".format(context=context, project_dir=self.working_dir)
-        run_command(cmd)
+        self._run_teardown(cmd)
 
-    def list(self):
+    def _run_teardown(self, cmd):
         """
-        Lists the components of the stack, along with their state
+        Runs a docker-compose teardown command, logging rather than raising on failure so
+        teardown of the other stacks carries on
 
-        :return:
+        :param cmd: (str) docker-compose command
+        :return: None
+        """
+        from shippy import command_runner
+
+        result = command_runner.run(cmd, check=False)
+        if result.returncode != 0:
+            LOGGER.error("Command exited with status %d: %s", result.returncode, cmd)
+
+    def list(self, client=None):
+        """
+        Lists the containers of the stack, along with their state
+
+        :param client: (docker.APIClient|shippy.engine_api.EngineAPI) Docker client. Default: None, query the local daemon
+        :return: (list) Container dicts, see list_stacks
         """
+        if client is None:
+            from shippy.engine_api import EngineAPI
+            client = EngineAPI()
+        stacks = list_stacks(client, stack=self.project)
+        return stacks[0]["containers"] if stacks else []
+
+
+def _container_summary(container):
+    return {
+        "name": container["Names"][0].lstrip("/"),
+        "service": container["Labels"].get(SERVICE_LABEL),
+        "image": container["Image"],
+        "state": container["State"],
+        "status": container["Status"],
+        "created": container["Created"],
+        "disk_size": container.get("SizeRw")
+    }
+
+
+def _stack_entry(labels):
+    return {"stack": labels[STACK_LABEL], "app": labels.get(APP_LABEL), "sha": labels.get(SHA_LABEL),
+            "containers": [], "image_size": 0, "created": None}
+
+
+def list_stacks(client, app_name=None, sha=None, stack=None, size=False, orphans=False):
+    """
+    Lists shippy stacks. Containers and images are each fetched with a single label-filtered
+    query, so the docker daemon does the filtering however many other containers run on the host.
+
+    A stack is `running` when all its long-running containers run, `stopped` when none do and
+    `degraded` otherwise. The source data container exits once created, so it is not counted.
+    Stacks whose containers are gone but whose data image is left are `orphaned`.
+
+    :param client: (docker.APIClient|shippy.engine_api.EngineAPI) Docker client
+    :param app_name: (str) Only list stacks of this application. Default: None
+    :param sha: (str) Only list stacks of this commit hash. Default: None
+    :param stack: (str) Only list this stack id. Default: None
+    :param size: (bool) Include the disk usage of container writable layers, slower. Default: False
+    :param orphans: (bool) Include orphaned stacks. Default: False
+    :return: (list) Stack dicts with the keys stack, app, sha, state, running, created, updated,
+             image_size, disk_size and containers, ordered by stack id. created and updated are
+             the unix times the first and last resources were created.
+    """
+    filters = label_filters(app_name, sha, stack)
+    stacks = {}
+    for container in client.containers(all=True, filters=filters, size=size):
+        labels = container["Labels"]
+        entry = stacks.setdefault(labels[STACK_LABEL], _stack_entry(labels))
+        entry["containers"].append(_container_summary(container))
+
+    images = {}
+    for image in client.images(filters=filters):
+        entry = stacks.get(image["Labels"][STACK_LABEL])
+        if entry is None and orphans:
+            entry = images.setdefault(image["Labels"][STACK_LABEL], _stack_entry(image["Labels"]))
+            entry["created"] = min(entry["created"] or image["Created"], image["Created"])
+        if entry is not None:
+            entry["image_size"] += image.get("Size", 0)
+
+    for entry in images.values():
+        entry.update(state="orphaned", running=0, updated=entry["created"], disk_size=0 if size else None)
+
+    for entry in stacks.values():
+        containers = entry["containers"]
+        services = [c for c in containers if not (c["service"] or "").endswith("_source_data")]
+        entry["running"] = sum(1 for c in services if c["state"] == "running")
+        if services and entry["running"] == len(services):
+            entry["state"] = "running"
+        elif entry["running"] == 0:
+            entry["state"] = "stopped"
+        else:
+            entry["state"] = "degraded"
+        entry["created"] = min(c["created"] for c in containers)
+        entry["updated"] = max(c["created"] for c in containers)
+        entry["disk_size"] = sum(c["disk_size"] or 0 for c in containers) if size else None
+
+    stacks.update(images)
+    return [stacks[name] for name in sorted(stacks)]
+
+
+def terminate_stacks(client, app_name=None, sha=None, stack=None):
+    """
+    Removes the containers, networks and images of the matching stacks, found with label filters
+
+    :param client: (docker.APIClient|shippy.engine_api.EngineAPI) Docker client
+    :param app_name: (str) Only terminate stacks of this application. Default: None
+    :param sha: (str) Only terminate stacks of this commit hash. Default: None
+    :param stack: (str) Only terminate this stack id. Default: None
+    :return: (dict) Number of removed containers, networks and images
+    """
+    filters = label_filters(app_name, sha, stack)
+    removed = {"containers": 0, "networks": 0, "images": 0}
+
+    def remove(kind, func, ref):
+        try:
+            func(ref)
+            removed[kind] += 1
+        except Exception as e:
+            # Already gone, e.g. removed by a concurrent terminate
+            if getattr(e, "status_code", None) != 404:
+                raise
+
+    # Containers first, networks and images can't be removed while in use
+    for container in client.containers(all=True, filters=filters):
+        LOGGER.info("Removing container: %s", container["Names"][0].lstrip("/"))
+        remove("containers", lambda ref: client.remove_container(ref, v=True, force=True), container["Id"])
+    for network in client.networks(filters=filters):
+        LOGGER.info("Removing network: %s", network["Name"])
+        remove("networks", client.remove_network, network["Id"])
+    for image in client.images(filters=filters):
+        LOGGER.info("Removing image: %s", ", ".join(image.get("RepoTags") or [image["Id"]]))
+        remove("images", lambda ref: client.remove_image(ref, force=True), image["Id"])
+    return removed
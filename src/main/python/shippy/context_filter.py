@@ -0,0 +1,147 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+shippy.context_filter
+=====================
+
+Include/exclude glob rules deciding which sourcecode paths are shipped in the data image build context
+"""
+import re
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+def glob_to_regex(pattern):
+    """
+    Translates a glob into a regular expression fragment. `**` matches across directories,
+    `*` and `?` match within a single path component.
+
+    :param pattern: (str) Glob relative to the sourcecode root
+    :return: (str) Regular expression fragment
+    """
+    pattern = pattern.strip("/")
+    if pattern.startswith("./"):
+        pattern = pattern[2:]
+
+    regex = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            regex.append(".*")
+            i += 2
+            continue
+        if char == "*":
+            regex.append("[^/]*")
+        elif char == "?":
+            regex.append("[^/]")
+        elif char == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                regex.append(re.escape(char))
+            else:
+                body = pattern[i + 1:end].replace("\\", "\\\\")
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                regex.append("[{0}]".format(body))
+                i = end
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    return "".join(regex)
+
+
+def _compile(patterns):
+    """
+    Compiles a list of globs into a single regular expression which also matches
+    every path below a matched directory
+
+    :param patterns: (list) Globs
+    :return: (re.Pattern) Compiled expression, or None for an empty list
+    """
+    if not patterns:
+        return None
+    alternatives = "|".join(glob_to_regex(pattern) for pattern in patterns)
+    return re.compile("^(?:{0})(?:/.*)?$".format(alternatives))
+
+
+class PathMatcher:
+    """
+    Decides whether a path relative to the sourcecode root belongs in the build context.
+
+    A path is kept when it (or one of its parent directories) matches an include rule, or
+    there are no include rules, and it doesn't match an exclude rule. Exclude rules win.
+    """
+
+    def __init__(self, include=None, exclude=None):
+        """
+        Constructor
+
+        :param include: (list) Globs of paths to keep. Default: None, keep everything
+        :param exclude: (list) Globs of paths to drop. Default: None
+        """
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        self._include = _compile(self.include)
+        self._exclude = _compile(self.exclude)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates a matcher from the `data_volume` config section
+
+        :param config: (dict) Configuration object as parsed by shippy.config
+        :return: (PathMatcher)
+        """
+        volume_config = config.get("data_volume", {})
+        return cls(volume_config.get("include"), volume_config.get("exclude"))
+
+    def __bool__(self):
+        return bool(self.include or self.exclude)
+
+    def matches(self, path, is_dir=False):
+        """
+        Returns True if path should be in the build context
+
+        :param path: (str) Path relative to the sourcecode root
+        :param is_dir: (bool) Whether path is a directory, which is kept so its children can be included. Default: False
+        :return: (bool)
+        """
+        if self._exclude is not None and self._exclude.match(path):
+            return False
+        if self._include is None or is_dir:
+            return True
+        return self._include.match(path) is not None
+
+    def to_dockerignore(self, always_include=None):
+        """
+        Renders the rules as a .dockerignore file, for builds where docker-py assembles the context
+
+        :param always_include: (list) Paths re-included after all other rules. Default: None
+        :return: (str) .dockerignore contents
+        """
+        lines = ["# Generated by shippy"]
+        if self.include:
+            lines.append("*")
+            lines.extend("!{0}".format(pattern.strip("/")) for pattern in self.include)
+        lines.extend(pattern.strip("/") for pattern in self.exclude)
+        lines.extend("!{0}".format(path.strip("/")) for path in always_include or [])
+        return "\n".join(lines) + "\n"
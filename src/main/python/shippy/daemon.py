@@ -0,0 +1,620 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+shippy.daemon
+=============
+
+Long-running process which keeps the docker client, download sessions and templates warm,
+and accepts deploy, list and terminate requests over a local HTTP API
+"""
+import os
+import json
+import time
+import hmac
+import uuid
+import queue
+import logging
+import threading
+import ipaddress
+import contextvars
+import http.client
+import socketserver
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, urlencode
+from docker import APIClient
+
+from shippy import LOGGING_FORMAT
+from shippy.config_loader import ConfigLoader
+from shippy.container_stack import list_stacks, terminate_stacks
+from shippy.deployment import deploy_shas
+from shippy.engine_api import UnixHTTPConnection
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_SOCKET_PATH = "/tmp/shippy/shippy.sock"
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_JOBS = 1000
+# Header carrying the shared token when the daemon listens on a TCP port
+TOKEN_HEADER = "X-Shippy-Token"
+# Largest body of a rejected request read and discarded to keep the connection open
+MAX_DISCARDED_BODY = 1024 * 1024
+
+# The job whose logs records emitted by the current thread belong to
+CURRENT_JOB = contextvars.ContextVar("shippy_current_job", default=None)
+
+
+class DaemonError(Exception):
+    """
+    Raised by DaemonClient when the daemon rejects a request
+    """
+
+
+class Job:
+    """
+    A queued deploy or terminate request, along with its status and captured log lines
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+    def __init__(self, kind, params):
+        """
+        Constructor
+
+        :param kind: (str) Job kind, one of ShippyDaemon.JOB_KINDS
+        :param params: (dict) Keyword arguments for the job
+        """
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.params = dict(params)
+        self.status = Job.QUEUED
+        self.error = None
+        self.result = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._lines = []
+        self._changed = threading.Condition()
+
+    @property
+    def done(self):
+        return self.status in (Job.SUCCEEDED, Job.FAILED)
+
+    def append_log(self, line):
+        """
+        Records a log line and wakes any followers
+
+        :param line: (str) Formatted log line
+        :return: None
+        """
+        with self._changed:
+            self._lines.append(line)
+            self._changed.notify_all()
+
+    def set_status(self, status, result=None, error=None):
+        """
+        Moves the job to a new status
+
+        :param status: (str) New status
+        :param result: (object) JSON serialisable result of a finished job. Default: None
+        :param error: (str) Failure description. Default: None
+        :return: None
+        """
+        with self._changed:
+            self.status = status
+            if status == Job.RUNNING:
+                self.started = time.time()
+            elif self.done:
+                self.finished = time.time()
+                self.result = result
+                self.error = error
+            self._changed.notify_all()
+
+    def follow_logs(self, follow=True):
+        """
+        Yields the captured log lines, then, when following, new lines as they arrive until the job finishes
+
+        :param follow: (bool) Keep waiting for lines until the job is done. Default: True
+        :return: (generator) Log lines
+        """
+        offset = 0
+        while True:
+            with self._changed:
+                while follow and offset >= len(self._lines) and not self.done:
+                    self._changed.wait()
+                lines = self._lines[offset:]
+                done = self.done
+            offset += len(lines)
+            yield from lines
+            if done or not follow:
+                return
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "params": self.params,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished
+        }
+
+
+class JobLogHandler(logging.Handler):
+    """
+    Routes log records to the job running in the current context
+    """
+
+    def emit(self, record):
+        job = CURRENT_JOB.get()
+        if job is not None:
+            job.append_log(self.format(record))
+
+
+class ShippyDaemon:
+    """
+    Runs queued jobs on a fixed number of worker threads, sharing one docker client between them
+    """
+
+    JOB_KINDS = ("deploy", "terminate")
+
+    def __init__(self, workers=DEFAULT_WORKERS, docker_client=None, max_jobs=DEFAULT_MAX_JOBS):
+        """
+        Constructor
+
+        :param workers: (int) Number of jobs run at once. Default: 2
+        :param docker_client: (docker.APIClient) Docker client. Default: None, connect to the local daemon on first use
+        :param max_jobs: (int) Number of jobs kept for status queries, oldest finished jobs are dropped first. Default: 1000
+        """
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self.queue = queue.Queue()
+        self.log_handler = JobLogHandler()
+        self.log_handler.setFormatter(logging.Formatter(LOGGING_FORMAT))
+        self._docker_client = docker_client
+        self._lock = threading.Lock()
+        self._threads = []
+
+    @property
+    def docker_client(self):
+        """
+        Returns the shared docker client, connecting on first use
+
+        :return: (docker.APIClient)
+        """
+        with self._lock:
+            if self._docker_client is None:
+                self._docker_client = APIClient(base_url='unix://var/run/docker.sock')
+            return self._docker_client
+
+    def start(self):
+        """
+        Starts the worker threads and begins capturing job logs
+
+        :return: None
+        """
+        package_logger = logging.getLogger("shippy")
+        if package_logger.level == logging.NOTSET:
+            # Job logs capture progress messages even when the console is left unconfigured
+            package_logger.setLevel(logging.INFO)
+        package_logger.addHandler(self.log_handler)
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name="shippy-worker-{0}".format(index), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Stops the worker threads once their current jobs are finished
+
+        :return: None
+        """
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        logging.getLogger("shippy").removeHandler(self.log_handler)
+
+    def submit(self, kind, params):
+        """
+        Queues a job
+
+        :param kind: (str) One of JOB_KINDS
+        :param params: (dict) Job parameters
+        :return: (Job) Queued job
+        :raises: (ValueError) On an unknown kind, or missing or malformed parameters
+        """
+        if kind not in self.JOB_KINDS:
+            raise ValueError("Unknown job kind: {0}".format(kind))
+        if not isinstance(params, dict):
+            raise ValueError("Expected a JSON object of job parameters")
+        required = {"deploy": ("configpath", "appconfig", "shas"), "terminate": ("sha",)}[kind]
+        missing = [name for name in required if not params.get(name)]
+        if missing:
+            raise ValueError("Missing parameters: {0}".format(", ".join(missing)))
+        shas = params.get("shas")
+        if kind == "deploy" and not (isinstance(shas, list) and all(isinstance(sha, str) and sha for sha in shas)):
+            raise ValueError("shas must be a list of commit hashes")
+
+        job = Job(kind, params)
+        with self._lock:
+            self.jobs[job.id] = job
+            self._trim_jobs()
+        LOGGER.info("Queued %s job %s", kind, job.id)
+        self.queue.put(job)
+        return job
+
+    def _trim_jobs(self):
+        """
+        Drops the oldest finished jobs beyond max_jobs. Must be called holding the lock
+
+        :return: None
+        """
+        excess = len(self.jobs) - self.max_jobs
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.done][:max(excess, 0)]:
+            del self.jobs[job_id]
+
+    def get_job(self, job_id):
+        """
+        :param job_id: (str) Job identifier
+        :return: (Job)
+        :raises: (KeyError) If no such job is known
+        """
+        with self._lock:
+            return self.jobs[job_id]
+
+    def list_jobs(self):
+        with self._lock:
+            return list(self.jobs.values())
+
+    def list_stacks(self, app_name=None, sha=None):
+        """
+        :param app_name: (str) Only list stacks of this application. Default: None
+        :param sha: (str) Only list stacks of this commit hash. Default: None
+        :return: (list) Stacks, see shippy.container_stack.list_stacks
+        """
+        return list_stacks(self.docker_client, app_name=app_name, sha=sha)
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            self._run_job(job)
+
+    def _run_job(self, job):
+        """
+        Runs a job, capturing its logs and outcome
+
+        :param job: (Job) Job to run
+        :return: None
+        """
+        token = CURRENT_JOB.set(job)
+        job.set_status(Job.RUNNING)
+        try:
+            LOGGER.info("Starting %s job %s", job.kind, job.id)
+            result = getattr(self, "_run_" + job.kind)(**job.params)
+        except (Exception, SystemExit) as e:
+            LOGGER.error("Job %s failed: %r", job.id, e)
+            job.set_status(Job.FAILED, error="{0}: {1}".format(type(e).__name__, e))
+        else:
+            LOGGER.info("Job %s finished", job.id)
+            job.set_status(Job.SUCCEEDED, result=result)
+        finally:
+            CURRENT_JOB.reset(token)
+
+    def _run_deploy(self, configpath, appconfig, shas, parent_sha=None, app=None, resume=False, force=False):
+        config = ConfigLoader(config_filepath=configpath, sha=None, app=app).get()
+        failures = deploy_shas(config, shas, appconfig, parent_sha=parent_sha, docker_client=self.docker_client,
+                               resume=resume, force=force)
+        if failures:
+            raise RuntimeError("Failed to deploy: {0}".format(", ".join(failures)))
+        return {"deployed": shas}
+
+    def _run_terminate(self, sha, app_name=None):
+        removed = terminate_stacks(self.docker_client, app_name=app_name, sha=sha)
+        if not sum(removed.values()):
+            raise RuntimeError("No stack found for {0}".format(sha))
+        return dict(removed, terminated=sha)
+
+    def make_server(self, socket_path=DEFAULT_SOCKET_PATH, address=None, token=None):
+        """
+        Creates the HTTP server for the request API. Anyone who can reach a TCP port may deploy,
+        so listening on an address other than loopback requires a token.
+
+        :param socket_path: (str) UNIX socket to listen on. Default: /tmp/shippy/shippy.sock
+        :param address: (tuple) (host, port) to listen on instead of the socket. Default: None
+        :param token: (str) Shared token requests on the TCP port must send in the X-Shippy-Token header. Default: None
+        :return: (socketserver.BaseServer)
+        """
+        if address:
+            if not token and not is_loopback(address[0]):
+                raise ValueError("Refusing to listen on {0} without a token".format(address[0] or "all interfaces"))
+            server = ThreadingHTTPServer(address, make_handler(self, token=token))
+            server.daemon_threads = True
+            return server
+        return UnixHTTPServer(socket_path, make_handler(self))
+
+    def serve(self, socket_path=DEFAULT_SOCKET_PATH, address=None, token=None):
+        """
+        Serves requests until interrupted
+
+        :param socket_path: (str) UNIX socket to listen on. Default: /tmp/shippy/shippy.sock
+        :param address: (tuple) (host, port) to listen on instead of the socket. Default: None
+        :param token: (str) Shared token required on the TCP port. Default: None
+        :return: None
+        """
+        server = self.make_server(socket_path, address, token=token)
+        self.start()
+        LOGGER.info("Listening on %s", address or socket_path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            LOGGER.info("Shutting down, waiting for running jobs...")
+        finally:
+            server.server_close()
+            self.stop()
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    HTTP server listening on a UNIX socket, readable and writable by its owner only
+    """
+
+    daemon_threads = True
+
+    def server_bind(self):
+        os.makedirs(os.path.dirname(self.server_address), exist_ok=True)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+        os.chmod(self.server_address, 0o600)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def is_loopback(host):
+    """
+    :param host: (str) Host name or IP address, empty for every interface
+    :return: (bool) Whether the host only accepts connections from this machine
+    """
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def make_handler(daemon, token=None):
+    """
+    Builds the request handler class for a daemon
+
+    The API consists of:
+
+    * `GET /health`
+    * `GET /stacks[?app_name=...&sha=...]`: stacks with their state, age and size
+    * `GET /jobs`, `GET /jobs/<id>`: job status
+    * `GET /jobs/<id>/logs[?follow=0]`: job log lines, streamed until the job finishes
+    * `POST /deploy` with `{"configpath", "appconfig", "shas", "parent_sha", "app", "resume", "force"}`
+    * `POST /terminate` with `{"sha", "app_name"}`
+
+    Request bodies must be sent as application/json. With a token, every request must carry it
+    in the X-Shippy-Token header.
+
+    :param daemon: (ShippyDaemon) Daemon serving the requests
+    :param token: (str) Shared token to require. Default: None
+    :return: (class) BaseHTTPRequestHandler subclass
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            LOGGER.debug(format, *args)
+
+        def _send_json(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _reject(self, status, error):
+            # Reads the body so the client can finish sending it; a large one is left unread
+            # and the connection closed instead
+            length = int(self.headers.get("Content-Length") or 0)
+            if length <= MAX_DISCARDED_BODY:
+                self.rfile.read(length)
+            else:
+                self.close_connection = True
+            self._send_json(status, {"error": error})
+
+        def _authorized(self):
+            if token is None or hmac.compare_digest(self.headers.get(TOKEN_HEADER, "").encode("utf-8"), token.encode("utf-8")):
+                return True
+            self._reject(401, "Missing or invalid {0} header".format(TOKEN_HEADER))
+            return False
+
+        def _read_json(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def _stream_logs(self, job, follow):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for line in job.follow_logs(follow=follow):
+                    data = (line + "\n").encode("utf-8")
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+
+        def do_GET(self):
+            if not self._authorized():
+                return
+            url = urlsplit(self.path)
+            parts = [part for part in url.path.split("/") if part]
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            try:
+                if parts == ["health"]:
+                    self._send_json(200, {"status": "ok", "queued": daemon.queue.qsize()})
+                elif parts == ["stacks"]:
+                    self._send_json(200, daemon.list_stacks(app_name=query.get("app_name"), sha=query.get("sha")))
+                elif parts == ["jobs"]:
+                    self._send_json(200, [job.to_dict() for job in daemon.list_jobs()])
+                elif len(parts) == 2 and parts[0] == "jobs":
+                    self._send_json(200, daemon.get_job(parts[1]).to_dict())
+                elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "logs":
+                    self._stream_logs(daemon.get_job(parts[1]), follow=query.get("follow", "1") != "0")
+                else:
+                    self._send_json(404, {"error": "Not found: {0}".format(url.path)})
+            except KeyError as e:
+                self._send_json(404, {"error": "Unknown job: {0}".format(e.args[0])})
+            except Exception as e:
+                LOGGER.exception("Request failed: %s", self.path)
+                self._send_json(500, {"error": str(e)})
+
+        def do_POST(self):
+            if not self._authorized():
+                return
+            kind = urlsplit(self.path).path.strip("/")
+            if kind not in daemon.JOB_KINDS:
+                self._reject(404, "Not found: {0}".format(self.path))
+                return
+            if self.headers.get_content_type() != "application/json":
+                self._reject(415, "Expected an application/json body")
+                return
+            try:
+                job = daemon.submit(kind, self._read_json())
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+                return
+            except Exception as e:
+                LOGGER.exception("Request failed: %s", self.path)
+                self._send_json(500, {"error": str(e)})
+                return
+            self._send_json(202, job.to_dict())
+
+    return Handler
+
+
+class DaemonClient:
+    """
+    Client for the daemon request API
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, address=None, timeout=None, token=None):
+        """
+        Constructor
+
+        :param socket_path: (str) UNIX socket the daemon listens on. Default: /tmp/shippy/shippy.sock
+        :param address: (tuple) (host, port) the daemon listens on instead. Default: None
+        :param timeout: (float) Socket timeout in seconds. Default: None
+        :param token: (str) Shared token the daemon requires. Default: None
+        """
+        self.socket_path = socket_path
+        self.address = address
+        self.timeout = timeout
+        self.token = token
+
+    def _headers(self):
+        return {TOKEN_HEADER: self.token} if self.token else {}
+
+    def _connection(self):
+        if self.address:
+            return http.client.HTTPConnection(*self.address, timeout=self.timeout)
+        return UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+
+    def _request(self, method, path, body=None):
+        connection = self._connection()
+        try:
+            headers = self._headers()
+            if body is not None:
+                headers["Content-Type"] = "application/json"
+            connection.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+            response = connection.getresponse()
+            data = json.loads(response.read() or b"null")
+        finally:
+            connection.close()
+        if response.status >= 400:
+            raise DaemonError(data.get("error") if isinstance(data, dict) else response.reason)
+        return data
+
+    def deploy(self, configpath, appconfig, shas, parent_sha=None, app=None, resume=False, force=False):
+        return self._request("POST", "/deploy", {"configpath": configpath, "appconfig": appconfig, "shas": list(shas),
+                                                 "parent_sha": parent_sha, "app": app, "resume": resume, "force": force})
+
+    def terminate(self, sha, app_name=None):
+        return self._request("POST", "/terminate", {"sha": sha, "app_name": app_name})
+
+    def job(self, job_id):
+        return self._request("GET", "/jobs/{0}".format(job_id))
+
+    def jobs(self):
+        return self._request("GET", "/jobs")
+
+    def stacks(self, app_name=None, sha=None):
+        query = {key: value for key, value in (("app_name", app_name), ("sha", sha)) if value}
+        return self._request("GET", "/stacks" + ("?" + urlencode(query) if query else ""))
+
+    def logs(self, job_id, follow=True):
+        """
+        Yields the log lines of a job, waiting for new lines until it finishes when following
+
+        :param job_id: (str) Job identifier
+        :param follow: (bool) Default: True
+        :return: (generator) Log lines
+        """
+        connection = self._connection()
+        try:
+            connection.request("GET", "/jobs/{0}/logs?follow={1}".format(job_id, int(follow)), headers=self._headers())
+            response = connection.getresponse()
+            if response.status >= 400:
+                raise DaemonError(json.loads(response.read()).get("error"))
+            for line in response:
+                yield line.decode("utf-8").rstrip("\n")
+        finally:
+            connection.close()
+
+    def wait(self, job_id):
+        """
+        Blocks until a job finishes
+
+        :param job_id: (str) Job identifier
+        :return: (dict) Final job status
+        """
+        for _ in self.logs(job_id):
+            pass
+        return self.job(job_id)
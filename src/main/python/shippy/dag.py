@@ -0,0 +1,132 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+shippy.dag
+==========
+
+Runs a graph of dependent tasks concurrently on a bounded thread pool
+"""
+import logging
+import contextvars
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Task:
+    """
+    A named unit of work which runs once all of its dependencies have finished
+    """
+
+    def __init__(self, name, func, depends_on=None):
+        """
+        Constructor
+
+        :param name: (str) Unique task name
+        :param func: (callable) Called without arguments to run the task
+        :param depends_on: (list) Names of tasks which must finish first. Default: None
+        """
+        self.name = name
+        self.func = func
+        self.depends_on = list(depends_on or [])
+
+    def __repr__(self):
+        return "Task({0!r})".format(self.name)
+
+
+def validate_graph(tasks):
+    """
+    Checks that every dependency exists and that the graph has no cycles
+
+    :param tasks: (list) Tasks making up the graph
+    :return: (list) Task names in a valid execution order
+    :raises: (ValueError) On duplicate names, unknown dependencies or cycles
+    """
+    by_name = {}
+    for task in tasks:
+        if task.name in by_name:
+            raise ValueError("Duplicate task name: {0}".format(task.name))
+        by_name[task.name] = task
+
+    for task in tasks:
+        for dependency in task.depends_on:
+            if dependency not in by_name:
+                raise ValueError("Task {0} depends on unknown task: {1}".format(task.name, dependency))
+
+    order = []
+    remaining = {task.name: set(task.depends_on) for task in tasks}
+    while remaining:
+        ready = sorted(name for name, deps in remaining.items() if not deps)
+        if not ready:
+            raise ValueError("Dependency cycle between tasks: {0}".format(", ".join(sorted(remaining))))
+        for name in ready:
+            del remaining[name]
+            for deps in remaining.values():
+                deps.discard(name)
+        order.extend(ready)
+    return order
+
+
+def run_graph(tasks, max_workers=4, on_failure=None):
+    """
+    Runs tasks as soon as their dependencies have finished, at most max_workers at a time.
+
+    After the first failure no further tasks are started, on_failure is called so running
+    siblings can be cancelled, and the failure is re-raised once running tasks have returned.
+
+    :param tasks: (list) Tasks making up the graph
+    :param max_workers: (int) Maximum number of tasks running at once. Default: 4
+    :param on_failure: (callable) Called with the first exception raised by a task. Default: None
+    :return: (dict) Maps task names to the values returned by their functions
+    :raises: (ValueError) If the graph is invalid
+    """
+    validate_graph(tasks)
+    by_name = {task.name: task for task in tasks}
+    waiting = {task.name: set(task.depends_on) for task in tasks}
+    results = {}
+    running = {}
+    error = None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while waiting or running:
+            if error is None:
+                for name in sorted(name for name, deps in waiting.items() if not deps):
+                    del waiting[name]
+                    LOGGER.debug("Starting task: %s", name)
+                    running[executor.submit(contextvars.copy_context().run, by_name[name].func)] = name
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except BaseException as e:
+                    if error is None:
+                        LOGGER.error("Task %s failed, cancelling remaining tasks", name)
+                        error = e
+                        if on_failure:
+                            on_failure(e)
+                    continue
+                for deps in waiting.values():
+                    deps.discard(name)
+
+    if error is not None:
+        raise error
+    return results
@@ -20,10 +20,15 @@ shippy.data_volume
 Builds and manages a docker data volume with the provided sourcecode
 
 """
+import os
 import logging
 import docker
 from docker import APIClient
 from copy import deepcopy
+from shippy.build_context import BuildContext
+from shippy.container_stack import shippy_labels, INPUTS_LABEL
+from shippy.context_filter import PathMatcher
+from shippy.log_sink import LogSink, BuildStreamParser
 
 LOGGER = logging.getLogger(__name__)
 DOCKERFILE_TEMPLATE = """\
@@ -45,32 +50,66 @@ LABEL maintainer="Vik Bhatti (github@vikbhatti.com)"
 
 CMD ["echo", "Data container for app"]
 """
+LAYERED_DOCKERFILE_TEMPLATE = """\
+FROM busybox
+
+# Add our user and group
+RUN addgroup -S user && adduser -G user -D user
+RUN mkdir -p {mountpoint} && chown user:user {mountpoint} && chmod 777 {mountpoint}
+
+# Layers ordered from least to most frequently changing
+{copy_layers}
+
+VOLUME {mountpoint}
+USER user
+
+LABEL version={source_sha}
+LABEL maintainer="Vik Bhatti (github@vikbhatti.com)"
+
+CMD ["echo", "Data container for app"]
+"""
+COPY_LAYER_TEMPLATE = "COPY --chown=user:user {layer}/ {mountpoint}/"
+DEFAULT_VENDOR_PATHS = ["node_modules", "bower_components", "vendor"]
+LOG_FILENAME = "volume.log.gz"
+LOG_SOURCE = "docker build"
 
 
 class DataVolume:
 
-    def __init__(self, sourcecode_path, sha, config):
+    def __init__(self, sourcecode_path, sha, config, client=None, log_dir=None, inputs_digest=None):
         """
         Constructor
 
         :param sourcecode_path: (str) Path to unpacked sourcecode for the given hash
         :param sha: (str) Commit hash to work on
         :param config: (dict) Configuration object as parsed by shippy.config
+        :param client: (docker.APIClient) Docker client to reuse. Default: None, connect to the local daemon
+        :param log_dir: (str) Directory receiving the compressed build output. Default: None, keep only its tail
+        :param inputs_digest: (str) Digest of the build inputs, recorded in a label of the image. Default: None
         """
         self.sourcecode_path = sourcecode_path
+        self.log_path = os.path.join(log_dir, LOG_FILENAME) if log_dir else None
         self.sha = sha
         self.config = deepcopy(config)
-        self.cli = APIClient(base_url='unix://var/run/docker.sock')
+        self.cli = client or APIClient(base_url='unix://var/run/docker.sock')
         self.volume_name = self._generate_name()
         self.volume_image_tag = self._generate_tag()
-
-    def _generate_name(self):
+        self.labels = shippy_labels(self.config["app_name"], self.sha)
+        if inputs_digest:
+            self.labels[INPUTS_LABEL] = inputs_digest
+        self.matcher = PathMatcher.from_config(self.config)
+        volume_config = self.config.get("data_volume", {})
+        self.layered = volume_config.get("layered", False)
+        self.vendor_paths = volume_config.get("vendor_paths", DEFAULT_VENDOR_PATHS)
+
+    def _generate_name(self, sha=None):
         """
         Generates a name for the data volume
 
+        :param sha: (str) Commit hash to name the volume for. Default: None, use this volume's hash
         :return: (str) Volume name
         """
-        volume_name = "shippy_{app_name}_data_{sha}".format(app_name=self.config["app_name"], sha=self.sha)
+        volume_name = "shippy_{app_name}_data_{sha}".format(app_name=self.config["app_name"], sha=sha or self.sha)
         return volume_name
 
     def _generate_tag(self):
@@ -110,6 +149,11 @@ class DataVolume:
             "source_sha": self.sha
         }
 
+        if self.layered:
+            layers = BuildContext.layer_names(self.vendor_paths)
+            data["copy_layers"] = "\n".join(COPY_LAYER_TEMPLATE.format(layer=layer, mountpoint=data["mountpoint"]) for layer in layers)
+            return LAYERED_DOCKERFILE_TEMPLATE.format(**data)
+
         template = DOCKERFILE_TEMPLATE.format(**data)
         return template
 
@@ -130,10 +174,52 @@ class DataVolume:
                 LOGGER.error(e)
                 raise SystemExit(1)
 
-    def build(self):
+    def _write_dockerignore(self, always_include=None):
+        """
+        Writes a .dockerignore generated from the include/exclude rules into the source path
+
+        :param always_include: (list) Paths to ship regardless of the rules. Default: None
+        :return: None
+        """
+        dockerignore_path = "{sourcepath}/.dockerignore".format(sourcepath=self.sourcecode_path)
+        LOGGER.info("Writing dockerignore to: %s", dockerignore_path)
+        with open(dockerignore_path, "w") as f:
+            f.write(self.matcher.to_dockerignore(always_include))
+
+    def _find_parent_image(self, parent_sha):
+        """
+        Returns the data image built for the parent commit, if it exists locally
+
+        :param parent_sha: (str) Parent commit hash
+        :return: (str) Image name, or None
+        """
+        if not parent_sha:
+            return None
+        parent_image = self._generate_name(parent_sha)
+        try:
+            self.cli.inspect_image(parent_image)
+        except docker.errors.NotFound:
+            LOGGER.info("No local data image for parent commit %s", parent_sha)
+            return None
+        return parent_image
+
+    def build(self, archive_path=None, overlay_paths=None, parent_sha=None):
         """
         Builds a docker data volume
 
+        With `data_volume.context` set to "stream" in the config, the build context is streamed
+        to the daemon as a tar generated from the downloaded archive (when available) and the
+        overlay paths, instead of docker-py walking and re-archiving the sourcecode path.
+
+        With `data_volume.layered` set, the sourcecode is split into one layer per vendor path
+        followed by the application code, so consecutive commits share their dependency layers.
+        Layered builds always stream their context, adding the vendor paths present in the
+        sourcecode path as overlays, and reuse layers from the parent commit's image when it
+        exists locally.
+
+        :param archive_path: (str) Downloaded github tarball to re-wrap into the context. Default: None
+        :param overlay_paths: (list) Paths relative to the sourcecode path holding build outputs. Default: None
+        :param parent_sha: (str) Parent commit hash whose image may seed the build cache. Default: None
         :return: None
         """
         '''
@@ -142,22 +228,57 @@ class DataVolume:
             In order to facilitate lookup for cleanup, we need to
             be able to search based on standard naming convention (or image label)
         '''
-        # Write dockerfile
-        self._write_dockerfile()
+        volume_config = self.config.get("data_volume", {})
         LOGGER.info("Creating docker data volume")
 
         try:
-            response = self.cli.build(path=self.sourcecode_path, rm=True, tag=self.volume_name)
+            if self.layered or volume_config.get("context", "directory") == "stream":
+                overlays = list(volume_config.get("overlay_paths", [])) + list(overlay_paths or [])
+                if self.layered:
+                    # Dependencies installed by the build commands are not in the downloaded archive
+                    overlays += [path for path in self.vendor_paths
+                                 if path not in overlays and os.path.lexists(os.path.join(self.sourcecode_path, path))]
+                context = BuildContext(self.sourcecode_path, self._render_template(),
+                                       archive_path=archive_path, overlay_paths=overlays, matcher=self.matcher,
+                                       vendor_paths=self.vendor_paths if self.layered else None)
+                build_args = {"labels": self.labels}
+                parent_image = self._find_parent_image(parent_sha) if self.layered else None
+                if parent_image:
+                    LOGGER.info("Reusing layers from parent image: %s", parent_image)
+                    build_args["cache_from"] = [parent_image]
+                response = self.cli.build(fileobj=iter(context), custom_context=True, rm=True, tag=self.volume_name, **build_args)
+            else:
+                # Write dockerfile
+                self._write_dockerfile()
+                if self.matcher:
+                    self._write_dockerignore(overlay_paths)
+                response = self.cli.build(path=self.sourcecode_path, rm=True, tag=self.volume_name, labels=self.labels)
         except docker.errors.BuildError as e:
             LOGGER.error("Problem building docker image")
             LOGGER.error(e)
             raise SystemExit(1)
 
-        for line in response:
-            decoded = line.decode("utf-8")
-            if "error" in decoded:
-                LOGGER.error(decoded)
-                raise docker.errors.BuildError
+        self._follow_build(response)
+
+    def _follow_build(self, response):
+        """
+        Consumes the build stream, writing the build output to the log and logging each Dockerfile step
+
+        :param response: (generator) Raw chunks of the build response
+        :return: None
+        :raises: (SystemExit) If the build reports an error
+        """
+        parser = BuildStreamParser()
+        with LogSink(self.log_path) as sink:
+            for chunk in response:
+                for event in parser.feed(chunk):
+                    if event.kind in ("output", "step"):
+                        sink.write(LOG_SOURCE, event.message.encode("utf-8"))
+                    if event.kind == "step":
+                        LOGGER.info("Building %s: step %d/%d", self.volume_name, event.step, event.total)
+                    elif event.kind == "error":
+                        LOGGER.error("Problem building docker image: %s\n%s", event.message, sink.tail(LOG_SOURCE))
+                        raise SystemExit(1)
 
     def remove(self):
         """
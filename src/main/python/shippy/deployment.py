@@ -0,0 +1,526 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+shippy.deployment
+=================
+
+The steps deploying an application stack for a single commit hash
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+
+from functools import partial
+from shippy.repository_archive import RepositoryArchive
+from shippy.data_volume import DataVolume
+from shippy.container_stack import ContainerStack, INPUTS_LABEL, SHA_LABEL
+from shippy.cache import ArchiveCache, BuildCache, file_digest
+from shippy.journal import DeployJournal, DEFAULT_WORKSPACE, JOURNAL_FILENAME, tree_digest
+from shippy.garbage_collector import GarbageCollector, GCPolicy, DEFAULT_GC_WORKERS
+from shippy.build_runner import BuildRunner
+from shippy.dag import Task, run_graph
+from shippy.image_puller import ImagePuller, ImagePullError
+from shippy.pipeline import Pipeline
+from shippy.tracing import Tracer
+from shippy import utils, tracing, command_runner
+
+LOGGER = logging.getLogger(__name__)
+
+# Files later stages write into the sourcecode tree, left out of its digest
+GENERATED_FILES = ("Dockerfile", ".dockerignore", "docker-compose.yml")
+# Config keys that shape the data image, digested into its inputs label
+IMAGE_INPUT_KEYS = ("application_repository", "application_image", "application_source_mountpoint",
+                    "application_build_cmds", "data_volume", "application_config")
+
+
+class Deployment:
+    """
+    Deploys the stack for one commit hash. Each stage is a separate method so a pipeline can
+    run the stages of several deployments side by side.
+    """
+
+    STAGES = ("fetch", "unpack", "build", "volume", "compose", "start")
+    # Stages whose outputs outlive the process. Starting is always repeated, the containers
+    # may have gone since.
+    RESUMABLE_STAGES = ("fetch", "unpack", "build", "volume", "compose")
+    # Stages skipped when the data image was already built from the same inputs
+    PREBUILT_STAGES = ("fetch", "unpack", "build", "volume")
+
+    def __init__(self, config, sha, appconfig, parent_sha=None, workspace=DEFAULT_WORKSPACE, docker_client=None,
+                 resume=False, journal=None, image_puller=None, tracer=None, force=False):
+        """
+        Constructor
+
+        :param config: (dict) Configuration object as parsed by shippy.config
+        :param sha: (str) Commit hash to deploy
+        :param appconfig: (str) Path to the application config file
+        :param parent_sha: (str) Parent commit hash whose data image layers may be reused. Default: None
+        :param workspace: (str) Directory holding the working directories of deployments. Default: /tmp/shippy/archives
+        :param docker_client: (docker.APIClient) Shared docker client. Default: None, create one per deployment
+        :param resume: (bool) Skip the stages a previous run completed, if their outputs are intact. Default: False
+        :param journal: (shippy.journal.DeployJournal) Journal recording the stages. Default: None, use the workspace's
+        :param image_puller: (shippy.image_puller.ImagePuller) Puller of the service images shared with other
+                             deployments. Default: None, pull them when the deployment runs
+        :param tracer: (shippy.tracing.Tracer) Tracer timing the stages. Default: None, keep the spans to this deployment
+        :param force: (bool) Rebuild even when the data image was built from the same inputs. Default: False
+        """
+        self.config = dict(config, app_sha=sha)
+        self.sha = sha
+        self.appconfig = appconfig
+        self.parent_sha = parent_sha
+        self.docker_client = docker_client
+        self.workdir = os.path.join(workspace, "{app_name}_{sha}".format(app_name=self.config["app_name"], sha=sha))
+        self.repo = RepositoryArchive(self.config["application_repository"])
+        self.download_path = None
+        self.output_dir = None
+        self.data_volume = None
+        self.container_stack = None
+        self.ready_times = None
+        self.deploy_id = os.path.basename(self.workdir)
+        self.resume = resume
+        self.journal = journal
+        self.workspace = workspace
+        self.skipped_stages = None
+        self.image_puller = image_puller
+        self.tracer = tracer or Tracer()
+        self.force = force
+        self.inputs_digest = None
+
+    def run(self):
+        """
+        Runs the stages as a graph: the service images are pulled in the background while the
+        sourcecode is fetched and built, and the stack starts once both are done
+
+        :return: None
+        """
+        tasks = [Task("pull", self._traced_pull)]
+        for index, stage in enumerate(self.STAGES):
+            depends_on = [self.STAGES[index - 1]] if index else []
+            if stage == "start":
+                depends_on.append("pull")
+            tasks.append(Task(stage, partial(self.run_stage, stage), depends_on))
+
+        def cancel_pulls(error):
+            if self.image_puller is not None:
+                self.image_puller.cancel()
+
+        run_graph(tasks, max_workers=2, on_failure=cancel_pulls)
+
+    def service_images(self):
+        """
+        :return: (list) Images the stack's services run, which are pulled rather than built
+        """
+        return [self.config["application_image"], self.config["database_image"]]
+
+    def _traced_pull(self):
+        with self.tracer.span("pull", app=self.config["app_name"], sha=self.sha):
+            self.pull()
+
+    def pull(self):
+        """
+        Pulls the service images missing locally, or waits for the shared puller to finish
+
+        :return: None
+        :raises: (SystemExit) If an image can't be pulled
+        """
+        if self.image_puller is None:
+            self.image_puller = ImagePuller(self._docker(), self.service_images())
+        try:
+            self.image_puller.wait()
+        except ImagePullError as e:
+            LOGGER.error("Could not pull images for %s: %s", self.sha, e)
+            raise SystemExit(1)
+
+    def _docker(self):
+        if self.docker_client is None:
+            from docker import APIClient
+            self.docker_client = APIClient(base_url='unix://var/run/docker.sock')
+        return self.docker_client
+
+    def _inputs_digest(self):
+        """
+        Digests what the data image depends on: the config keys that shape it and the application config file
+
+        :return: (str) Hex digest
+        """
+        return self._digest({key: self.config.get(key) for key in IMAGE_INPUT_KEYS})
+
+    def _config_digest(self):
+        """
+        Digests what the journalled stages' outputs depend on: the whole config and the application config file
+
+        :return: (str) Hex digest
+        """
+        return self._digest(self.config)
+
+    def _digest(self, config):
+        digest = hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode("utf-8"))
+        digest.update(file_digest(self.appconfig).encode("utf-8") if os.path.isfile(self.appconfig) else b"")
+        return digest.hexdigest()
+
+    def _artifact_digest(self, kind, ref):
+        """
+        Computes the current digest of a stage output
+
+        :param kind: (str) One of file, tree or image
+        :param ref: (str) Path, or image name
+        :return: (str) Digest, None if the output is missing
+        """
+        if kind == "file":
+            return file_digest(ref) if os.path.isfile(ref) else None
+        if kind == "tree":
+            return tree_digest(ref, exclude=GENERATED_FILES)
+        import docker.errors
+        try:
+            return self._docker().inspect_image(ref)["Id"]
+        except docker.errors.NotFound:
+            return None
+
+    def _stage_outputs(self, stage):
+        """
+        Describes what a completed stage produced
+
+        :param stage: (str) Stage name
+        :return: (tuple) Attributes to restore when skipping the stage, and the artifacts to check
+        """
+        if stage == "fetch":
+            if self.download_path:
+                return {"download_path": self.download_path}, [("file", self.download_path)]
+            return {"output_dir": self.output_dir}, [("tree", self.output_dir)]
+        if stage in ("unpack", "build"):
+            return {"output_dir": self.output_dir}, [("tree", self.output_dir)]
+        if stage == "volume":
+            return {"volume_name": self.data_volume.get_name()}, [("image", self.data_volume.get_name())]
+        if stage == "compose":
+            return {"compose_filepath": self.container_stack.compose_filepath}, [("file", self.container_stack.compose_filepath)]
+        return {}, []
+
+    def _restore(self, stage, state):
+        """
+        Restores the attributes a skipped stage would have set
+
+        :param stage: (str) Stage name
+        :param state: (dict) State recorded when the stage completed
+        :return: None
+        """
+        if stage in ("fetch", "unpack", "build"):
+            for name, value in state.items():
+                setattr(self, name, value)
+        elif stage == "volume":
+            self.data_volume = DataVolume(self.output_dir, self.sha, self.config, client=self._docker())
+        elif stage == "compose":
+            self.container_stack = self._make_stack(self.output_dir, self.data_volume.get_name())
+            self.container_stack.compose_filepath = state["compose_filepath"]
+
+    def prebuilt(self):
+        """
+        Checks whether the data image of this commit exists and was built from the current
+        inputs, in which case fetching, building and the image build can all be skipped
+
+        :return: (bool)
+        """
+        import docker.errors
+        import requests.exceptions
+
+        try:
+            volume = DataVolume(os.path.join(self.workdir, self.config["app_name"]), self.sha, self.config,
+                                client=self._docker())
+            image = self._docker().inspect_image(volume.get_name())
+        except docker.errors.NotFound:
+            return False
+        except (docker.errors.DockerException, requests.exceptions.RequestException) as e:
+            LOGGER.warning("Could not look for a data image of %s, building it: %s", self.sha, e)
+            return False
+        labels = (image.get("Config") or {}).get("Labels") or {}
+        if labels.get(SHA_LABEL) != self.sha or labels.get(INPUTS_LABEL) != self.inputs_digest:
+            LOGGER.info("Data image %s was built from different inputs, rebuilding", volume.get_name())
+            return False
+        self.data_volume = volume
+        return True
+
+    def _plan(self):
+        """
+        Opens this deployment in the journal and works out which stages can be skipped: those
+        before compose when the data image is up to date, else those a resumed run completed
+
+        :return: (list) Names of the stages to skip
+        """
+        if self.journal is None:
+            self.journal = DeployJournal(os.path.join(self.workspace, JOURNAL_FILENAME))
+        self.inputs_digest = self._inputs_digest()
+        kept = self.journal.begin(self.deploy_id, self._config_digest(), resume=self.resume)
+        if not self.force and self.prebuilt():
+            LOGGER.info("Data image for %s is up to date, skipping to compose", self.sha)
+            # The compose file is written next to where the sourcecode would be
+            self.output_dir = self.data_volume.sourcecode_path
+            utils.create_directory(self.output_dir)
+            return list(self.PREBUILT_STAGES)
+        if not kept:
+            return []
+        records = self.journal.resumable_stages(self.deploy_id, self.RESUMABLE_STAGES, self._artifact_digest)
+        for record in records:
+            self._restore(record["stage"], record["state"])
+        if records:
+            LOGGER.info("Resuming %s after stage %s", self.sha, records[-1]["stage"])
+        return [record["stage"] for record in records]
+
+    def run_stage(self, stage):
+        """
+        Runs one stage in a span and records its outcome in the journal, or skips it when resuming
+        and a previous run completed it
+
+        :param stage: (str) Stage name
+        :return: None
+        """
+        if self.skipped_stages is None:
+            self.skipped_stages = self._plan()
+        if stage in self.skipped_stages:
+            LOGGER.info("Skipping stage %s for %s", stage, self.sha)
+            return
+
+        self.journal.stage_started(self.deploy_id, stage)
+        try:
+            with self.tracer.span(stage, profile=True, app=self.config["app_name"], sha=self.sha):
+                getattr(self, stage)()
+        except (Exception, SystemExit) as e:
+            self.journal.stage_failed(self.deploy_id, stage, "{0}: {1}".format(type(e).__name__, e))
+            raise
+        state, artifacts = self._stage_outputs(stage)
+        self.journal.stage_completed(self.deploy_id, stage, state=state, artifacts=[
+            {"kind": kind, "ref": ref, "digest": self._artifact_digest(kind, ref)} for kind, ref in artifacts
+        ])
+
+    def fetch(self):
+        """
+        Fetches the application sourcecode archive, or streams it straight into the sourcecode
+        directory when `archive_stream` is enabled
+
+        :return: None
+        """
+        # Create work directory
+        utils.create_directory(self.workdir)
+
+        # 2. Fetch application sourcecode archive
+        LOGGER.info("About to fetch repo archive for %s...", self.sha)
+        cache = ArchiveCache.from_config(self.config)
+        if self.config.get("archive_stream", False):
+            # 2 + 3. Stream the archive straight into the unpacked source directory
+            self.output_dir = self.repo.fetch_extract(self.sha, os.path.join(self.workdir, self.config["app_name"]), cache=cache)
+            LOGGER.info("Streamed archive into: %s", self.output_dir)
+        else:
+            self.download_path = self.repo.fetch(self.sha, download_path=self.workdir, cache=cache)
+            LOGGER.info("Downloaded archive to: %s", self.download_path)
+
+    def unpack(self):
+        """
+        Unpacks the downloaded archive, unless it was already streamed into place
+
+        :return: None
+        """
+        if self.output_dir is not None:
+            return
+
+        # 3. Unpack sourcecode archive
+        LOGGER.info("Unpacking archive")
+        self.output_dir = utils.unpack_archive(self.download_path, self.config["app_name"], working_dir=self.workdir)
+        LOGGER.info("Unpacked archive into: %s", self.output_dir)
+
+    def build(self):
+        """
+        Runs the build commands and copies the application config file into the sourcecode
+
+        :return: None
+        """
+        # 4. Run build commands
+        with tracing.span("commands"):
+            BuildRunner(self.config, self.output_dir, cache=BuildCache.from_config(self.config),
+                        log_dir=os.path.join(self.workdir, "logs")).run()
+
+        # 5. Copy application config file into sourcecode path root
+        LOGGER.info("Copying application config file into: %s", self.output_dir)
+        with tracing.span("copy_config"):
+            utils.copy_file(self.appconfig, self.output_dir)
+
+    def volume(self):
+        """
+        Builds the docker sourcecode data volume
+
+        :return: None
+        """
+        # 6. Build docker sourcecode data volume
+        self.data_volume = DataVolume(self.output_dir, self.sha, self.config, client=self.docker_client,
+                                      log_dir=os.path.join(self.workdir, "logs"), inputs_digest=self.inputs_digest)
+        parent_sha = None
+        if self.data_volume.layered:
+            parent_sha = self.parent_sha or self.repo.get_parent_sha(self.sha)
+        self.data_volume.build(archive_path=self.download_path, overlay_paths=[os.path.basename(self.appconfig)], parent_sha=parent_sha)
+
+    def _make_stack(self, working_dir, volume_tag):
+        """
+        Creates the stack backend selected by `stack_backend`
+
+        :param working_dir: (str) Sourcecode directory of the stack
+        :param volume_tag: (str) Image tag of the data volume
+        :return: (shippy.container_stack.ContainerStack)
+        """
+        if self.config.get("stack_backend", "compose") == "engine":
+            from shippy.engine_stack import EngineStack
+            return EngineStack(self.config, self.sha, working_dir, volume_tag, client=self.docker_client)
+        return ContainerStack(self.config, self.sha, working_dir, volume_tag)
+
+    def compose(self):
+        """
+        Builds and writes the docker-compose stack configuration
+
+        :return: None
+        """
+        # 7. Build and write docker-compose stack configuration
+        self.container_stack = self._make_stack(self.output_dir, self.data_volume.get_name())
+        self.container_stack.write_compose_file()
+
+    def start(self):
+        """
+        Starts the docker-compose stack
+
+        :return: None
+        """
+        # 8. Start docker-compose stack, once the service images are pulled
+        if self.image_puller is not None:
+            with tracing.span("wait_for_pull"):
+                self.pull()
+        LOGGER.info("Starting container stack for %s", self.sha)
+        started_at = time.time()
+        with tracing.span("up"):
+            self.container_stack.start()
+
+        # 9. Wait until the services are serving
+        readiness_config = self.config.get("readiness")
+        if readiness_config:
+            with tracing.span("readiness"):
+                self.ready_times = self._wait_until_ready(readiness_config, since=int(started_at))
+        LOGGER.info("Stack for %s is ready, have a nice day!", self.sha)
+
+    def _wait_until_ready(self, readiness_config, since):
+        """
+        Waits for the readiness checks of every service, then sends the optional warm-up burst
+
+        :param readiness_config: (dict) The `readiness` config
+        :param since: (int) Unix time the stack was started at
+        :return: (dict) Maps service names to seconds until ready
+        :raises: (SystemExit) If the stack doesn't become ready
+        """
+        from shippy.readiness import ReadinessMonitor, ReadinessError, resolve_service, warm_up
+
+        try:
+            monitor = ReadinessMonitor.from_config(self.container_stack, readiness_config, client=self.docker_client)
+            ready_times = monitor.wait(since=since)
+        except (ReadinessError, ValueError) as e:
+            LOGGER.error("Stack for %s did not become ready: %s", self.sha, e)
+            raise SystemExit(1)
+        LOGGER.info("Time to ready for %s: %s", self.sha,
+                    ", ".join("{0} {1:.2f}s".format(service, seconds) for service, seconds in sorted(ready_times.items())))
+
+        warmup_config = readiness_config.get("warmup")
+        if warmup_config:
+            service = resolve_service(self.container_stack, warmup_config.get("service", "app"))
+            host = warmup_config.get("host")
+            if not host:
+                host = monitor.container_address(monitor.client.inspect_container(self.container_stack.container_name(service)))
+            warm_up(host, warmup_config["port"], path=warmup_config.get("path", "/"),
+                    requests=warmup_config.get("requests", 20), concurrency=warmup_config.get("concurrency", 4))
+        return ready_times
+
+    def terminate(self):
+        """
+        Terminates the stack previously deployed from this commit hash
+
+        :return: None
+        """
+        LOGGER.info("Terminating container stack for %s", self.sha)
+        self.container_stack = self._make_stack(os.path.join(self.workdir, self.config["app_name"]), None)
+        self.container_stack.terminate()
+
+
+def deploy_shas(config, shas, appconfig, parent_sha=None, docker_client=None, resume=False, profile_dir=None,
+                workspace=DEFAULT_WORKSPACE, force=False):
+    """
+    Deploys a stack for each commit hash. A single hash runs its stage graph directly, several
+    are pushed through a Pipeline so their stages overlap. Either way the service images are
+    pulled in the background from the start.
+
+    :param config: (dict) Configuration object as parsed by shippy.config
+    :param shas: (list) Commit hashes to deploy
+    :param appconfig: (str) Path to the application config file
+    :param parent_sha: (str) Parent commit hash whose data image layers may be reused. Default: None
+    :param docker_client: (docker.APIClient) Shared docker client. Default: None
+    :param resume: (bool) Skip the stages previous runs completed. Default: False
+    :param profile_dir: (str) Directory receiving a cProfile dump per stage. Default: None, see `tracing.profile_dir`
+    :param workspace: (str) Directory holding the working directories and journal. Default: /tmp/shippy/archives
+    :param force: (bool) Rebuild data images even when they were built from the same inputs. Default: False
+    :return: (dict) Maps the commit hashes which failed to the exception they raised
+    """
+    command_runner.configure(config)
+    journal = DeployJournal(os.path.join(workspace, JOURNAL_FILENAME))
+    gc_config = config.get("gc", {})
+    if gc_config.get("before_deploy", False):
+        from shippy.engine_api import EngineAPI
+        collector = GarbageCollector(docker_client or EngineAPI(), GCPolicy.from_config(config), journal=journal,
+                                     workspace=workspace, workers=gc_config.get("workers", DEFAULT_GC_WORKERS))
+        try:
+            collector.make_room(config["app_name"], shas)
+        except Exception as e:
+            LOGGER.warning("Garbage collection before deploying failed: %s", e)
+
+    tracer = Tracer.from_config(config, profile_dir=profile_dir)
+    deployments = {
+        sha: Deployment(config, sha, appconfig, parent_sha=parent_sha, workspace=workspace, docker_client=docker_client,
+                        resume=resume, journal=journal, tracer=tracer, force=force)
+        for sha in shas
+    }
+    try:
+        return _run_deployments(config, shas, deployments)
+    finally:
+        LOGGER.info("Stage timings: %s", ", ".join("{0} {1:.2f}s".format(path, seconds) for path, seconds in tracer.summary()))
+        tracer.export()
+
+
+def _run_deployments(config, shas, deployments):
+    """
+    Runs a single deployment directly, or several through a Pipeline sharing an image puller
+
+    :param config: (dict) Configuration object as parsed by shippy.config
+    :param shas: (list) Commit hashes to deploy, in order
+    :param deployments: (dict) Maps the commit hashes to their Deployment
+    :return: (dict) Maps the commit hashes which failed to the exception they raised
+    """
+    if len(deployments) == 1:
+        deployments[shas[0]].run()
+        return {}
+
+    # The stacks share their service images, pull them once for all
+    puller = ImagePuller(deployments[shas[0]]._docker(), deployments[shas[0]].service_images()).start()
+    for deployment in deployments.values():
+        deployment.docker_client = deployment.docker_client or puller.client
+        deployment.image_puller = puller
+
+    LOGGER.info("Deploying %d stacks...", len(deployments))
+    pipeline = Pipeline(Deployment.STAGES, concurrency=config.get("pipeline_concurrency"))
+    try:
+        return pipeline.run(deployments)
+    finally:
+        puller.cancel()
@@ -0,0 +1,458 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+shippy.downloader
+=================
+
+Resumable HTTP downloads over a pooled session
+"""
+import io
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import requests
+
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from tqdm import tqdm
+from shippy import tracing
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 256 * 1024
+DEFAULT_TIMEOUT = (10, 60)
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 0.5
+# Longest Retry-After honoured, in seconds
+MAX_RETRY_AFTER = 300
+
+
+class RetryableStatusError(requests.exceptions.HTTPError):
+    """
+    Raised for responses worth retrying: rate limiting (429) and server errors (5xx)
+    """
+
+    def __init__(self, *args, retry_after=None, **kwargs):
+        """
+        Constructor
+
+        :param retry_after: (float) Seconds the server asked to wait before retrying. Default: None
+        """
+        super().__init__(*args, **kwargs)
+        self.retry_after = retry_after
+
+
+TRANSIENT_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+    RetryableStatusError,
+)
+
+
+class DownloadError(Exception):
+    """
+    Raised when a download cannot be completed after all retries
+    """
+
+
+def parse_retry_after(value):
+    """
+    Parses a Retry-After header, given either in seconds or as an HTTP date
+
+    :param value: (str) Header value
+    :return: (float) Seconds to wait, None if the header is missing or invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def raise_for_status(response):
+    """
+    Raises for error responses, with a RetryableStatusError for the ones worth retrying
+
+    :param response: (requests.Response) Response to check
+    :return: None
+    :raises: (RetryableStatusError) On a 429 or 5xx response
+    :raises: (requests.exceptions.HTTPError) On other error responses
+    """
+    if response.status_code == 429 or response.status_code >= 500:
+        response.close()
+        raise RetryableStatusError("{0} {1} for {2}".format(response.status_code, response.reason, response.url),
+                                   response=response, retry_after=parse_retry_after(response.headers.get("Retry-After")))
+    response.raise_for_status()
+
+
+def retry_delay(error, backoff, attempt):
+    """
+    Returns how long to wait before retrying: exponential backoff, or longer when the server asked
+
+    :param error: (Exception) The failure being retried
+    :param backoff: (float) Base delay in seconds
+    :param attempt: (int) Number of earlier retries
+    :return: (float) Seconds
+    """
+    delay = backoff * (2 ** attempt)
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, MAX_RETRY_AFTER))
+    return delay
+
+
+class Downloader:
+    """
+    Downloads files through a shared connection pool, resuming interrupted transfers
+    from a `.part` file with HTTP Range requests and revalidating finished downloads
+    with the ETag recorded alongside them.
+    """
+
+    def __init__(self, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, timeout=DEFAULT_TIMEOUT,
+                 buffer_size=DEFAULT_BUFFER_SIZE, pool_size=10, progress=True):
+        """
+        Constructor
+
+        :param retries: (int) Number of times to retry a failed transfer
+        :param backoff: (float) Base delay in seconds, doubled after every failed attempt
+        :param timeout: (tuple) Connect and read timeouts in seconds
+        :param buffer_size: (int) Size of the reusable read buffer in bytes
+        :param pool_size: (int) Number of connections kept alive per host
+        :param progress: (bool) Display a progress bar while downloading
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.buffer_size = buffer_size
+        self.progress = progress
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._local = threading.local()
+
+    def _get_buffer(self):
+        """
+        Returns the read buffer for the calling thread, allocating it once
+
+        :return: (memoryview) View over the reusable buffer
+        """
+        view = getattr(self._local, "buffer", None)
+        if view is None:
+            view = memoryview(bytearray(self.buffer_size))
+            self._local.buffer = view
+        return view
+
+    @staticmethod
+    def _read_metadata(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _write_metadata(path, metadata):
+        with open(path, "w") as f:
+            json.dump(metadata, f)
+
+    @staticmethod
+    def _hash_existing(path, digest):
+        """
+        Feeds the contents of an existing file into digest
+
+        :param path: (str) File to hash
+        :param digest: (hashlib hash) Digest to update
+        :return: (int) Number of bytes hashed
+        """
+        size = 0
+        if not os.path.exists(path):
+            return size
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(DEFAULT_BUFFER_SIZE), b""):
+                digest.update(chunk)
+                size += len(chunk)
+        return size
+
+    def download(self, url, destination):
+        """
+        Downloads url to destination, retrying with exponential backoff and resuming from
+        any partially downloaded data
+
+        :param url: (str) URL to download
+        :param destination: (str) Path to write the file to
+        :return: (str) sha256 hex digest of the downloaded file
+        :raises: (DownloadError) When the download cannot be completed
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return self._attempt(url, destination)
+            except TRANSIENT_ERRORS as e:
+                if attempt == self.retries:
+                    raise DownloadError("Giving up on {0} after {1} attempts: {2}".format(url, attempt + 1, e))
+                delay = retry_delay(e, self.backoff, attempt)
+                LOGGER.warning("Download of %s interrupted (%s), retrying in %.1fs", url, e, delay)
+                time.sleep(delay)
+
+    def _attempt(self, url, destination, restarted=False):
+        """
+        Makes a single download attempt
+
+        :param url: (str) URL to download
+        :param destination: (str) Path to write the file to
+        :param restarted: (bool) Whether the attempt already started over after a rejected resume. Default: False
+        :return: (str) sha256 hex digest of the downloaded file
+        """
+        part_path = "{0}.part".format(destination)
+        metadata_path = "{0}.meta".format(destination)
+        metadata = self._read_metadata(metadata_path)
+        if metadata.get("url") != url:
+            metadata = {}
+
+        headers = {"Accept-Encoding": "identity"}
+        digest = hashlib.sha256()
+        offset = 0
+        if os.path.exists(destination) and metadata.get("etag") and metadata.get("complete"):
+            headers["If-None-Match"] = metadata["etag"]
+        elif os.path.exists(part_path) and metadata.get("etag"):
+            offset = self._hash_existing(part_path, digest)
+            headers["Range"] = "bytes={0}-".format(offset)
+            headers["If-Range"] = metadata["etag"]
+
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 304:
+                LOGGER.info("%s is unchanged since the last download", destination)
+                return self._finish_existing(destination)
+
+            if response.status_code == 416 and not restarted:
+                # The partial file is no longer a prefix of the resource, start over once. A
+                # second 416 is raised as a client error below.
+                LOGGER.warning("Server rejected resume of %s, restarting download", destination)
+                # Forget the ETag too, so the next request is a plain download
+                for path in (part_path, metadata_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                return self._attempt(url, destination, restarted=True)
+
+            raise_for_status(response)
+            if response.status_code != 206 and offset:
+                LOGGER.info("Server ignored range request, restarting download of %s", destination)
+                digest = hashlib.sha256()
+                offset = 0
+            elif offset:
+                LOGGER.info("Resuming download of %s at byte %d", destination, offset)
+
+            etag = response.headers.get("ETag")
+            self._write_metadata(metadata_path, {"url": url, "etag": etag, "complete": False})
+
+            length = response.headers.get("Content-Length")
+            total_size = offset + int(length) if length else None
+            written = self._write_body(response, part_path, offset, total_size, digest)
+
+        if total_size is not None and written != total_size:
+            raise requests.exceptions.ChunkedEncodingError(
+                "Received {0} of {1} bytes".format(written, total_size))
+
+        os.replace(part_path, destination)
+        self._write_metadata(metadata_path, {"url": url, "etag": etag, "complete": True, "digest": digest.hexdigest()})
+        return digest.hexdigest()
+
+    def _write_body(self, response, part_path, offset, total_size, digest):
+        """
+        Streams the response body into part_path through the reusable buffer
+
+        :return: (int) Total number of bytes in part_path
+        """
+        view = self._get_buffer()
+        mode = "ab" if offset else "wb"
+        written = offset
+        with open(part_path, mode) as f, tqdm(total=total_size, initial=offset, unit="B", unit_scale=True,
+                                              disable=not self.progress) as progress:
+            while True:
+                try:
+                    count = response.raw.readinto(view)
+                except (ProtocolError, ReadTimeoutError, OSError) as e:
+                    raise requests.exceptions.ChunkedEncodingError(e)
+                if not count:
+                    break
+                chunk = view[:count]
+                f.write(chunk)
+                digest.update(chunk)
+                written += count
+                progress.update(count)
+        tracing.count(bytes_downloaded=written - offset)
+        return written
+
+    def open_stream(self, url, sink=None):
+        """
+        Opens url as a readable file object which transparently resumes with Range
+        requests when the connection drops
+
+        :param url: (str) URL to stream
+        :param sink: (file) Optional writable file receiving a copy of every byte read. Default: None
+        :return: (ResumableStream)
+        """
+        return ResumableStream(self, url, sink=sink)
+
+    def _finish_existing(self, destination):
+        """
+        Returns the digest for a download that did not need transferring again
+
+        :param destination: (str) Path to the existing file
+        :return: (str) sha256 hex digest
+        """
+        metadata = self._read_metadata("{0}.meta".format(destination))
+        if metadata.get("digest"):
+            return metadata["digest"]
+        digest = hashlib.sha256()
+        self._hash_existing(destination, digest)
+        return digest.hexdigest()
+
+
+class ResumableStream(io.RawIOBase):
+    """
+    Read-only file object over an HTTP response body. Transient failures reconnect at
+    the current offset, so consumers such as tarfile never see the interruption.
+    """
+
+    def __init__(self, downloader, url, sink=None):
+        """
+        Constructor
+
+        :param downloader: (Downloader) Downloader providing the session and retry policy
+        :param url: (str) URL to stream
+        :param sink: (file) Optional writable file receiving a copy of every byte read
+        """
+        super().__init__()
+        self.downloader = downloader
+        self.url = url
+        self.sink = sink
+        self.offset = 0
+        self.total_size = None
+        self.etag = None
+        self.digest = hashlib.sha256()
+        self._response = None
+        self._progress = tqdm(unit="B", unit_scale=True, disable=not downloader.progress)
+        # The stream may be read on another thread, count the bytes against the opening span
+        self._span = tracing.current_span()
+        self._connect()
+
+    def _connect(self):
+        """
+        Issues the request for the remainder of the body
+
+        :return: None
+        """
+        headers = {"Accept-Encoding": "identity"}
+        if self.offset:
+            headers["Range"] = "bytes={0}-".format(self.offset)
+            if self.etag:
+                headers["If-Range"] = self.etag
+
+        response = self.downloader.session.get(self.url, headers=headers, stream=True, timeout=self.downloader.timeout)
+        raise_for_status(response)
+        if self.offset and response.status_code != 206:
+            response.close()
+            raise DownloadError("Server cannot resume {0} at byte {1}".format(self.url, self.offset))
+
+        if not self.offset:
+            self.etag = response.headers.get("ETag")
+            length = response.headers.get("Content-Length")
+            self.total_size = int(length) if length else None
+            self._progress.total = self.total_size
+        self._response = response
+
+    def _reconnect(self, error, attempt):
+        """
+        Backs off and reconnects after a transient failure
+
+        :param error: (Exception) The failure being recovered from
+        :param attempt: (int) Number of consecutive failures so far
+        :return: None
+        """
+        if attempt > self.downloader.retries:
+            raise DownloadError("Giving up on {0} at byte {1}: {2}".format(self.url, self.offset, error))
+        delay = retry_delay(error, self.downloader.backoff, attempt - 1)
+        LOGGER.warning("Stream of %s interrupted at byte %d (%s), resuming in %.1fs", self.url, self.offset, error, delay)
+        self._response.close()
+        time.sleep(delay)
+        try:
+            self._connect()
+        except TRANSIENT_ERRORS as e:
+            self._reconnect(e, attempt + 1)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        attempt = 0
+        while True:
+            try:
+                count = self._response.raw.readinto(buffer)
+            except (ProtocolError, ReadTimeoutError, OSError) as e:
+                attempt += 1
+                self._reconnect(e, attempt)
+                continue
+
+            if not count and self.total_size is not None and self.offset < self.total_size:
+                attempt += 1
+                self._reconnect("received {0} of {1} bytes".format(self.offset, self.total_size), attempt)
+                continue
+            break
+
+        if count:
+            chunk = memoryview(buffer)[:count]
+            self.digest.update(chunk)
+            if self.sink is not None:
+                self.sink.write(chunk)
+            self.offset += count
+            self._progress.update(count)
+        return count
+
+    def close(self):
+        if not self.closed and self._span is not None:
+            self._span.count(bytes_downloaded=self.offset)
+        if self._response is not None:
+            self._response.close()
+        self._progress.close()
+        super().close()
+
+
+_DEFAULT_DOWNLOADER = None
+_DEFAULT_DOWNLOADER_LOCK = threading.Lock()
+
+
+def get_downloader():
+    """
+    Returns the process-wide downloader so connections are pooled across fetches
+
+    :return: (Downloader)
+    """
+    global _DEFAULT_DOWNLOADER
+    with _DEFAULT_DOWNLOADER_LOCK:
+        if _DEFAULT_DOWNLOADER is None:
+            _DEFAULT_DOWNLOADER = Downloader()
+        return _DEFAULT_DOWNLOADER
@@ -0,0 +1,203 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+shippy.engine_api
+=================
+
+Minimal Docker Engine API client over a UNIX socket, for quick queries which don't warrant
+importing docker-py
+"""
+import json
+import socket
+import logging
+import http.client
+
+from urllib.parse import urlencode, quote
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_DOCKER_SOCKET = "/var/run/docker.sock"
+
+
+class EngineAPIError(Exception):
+    """
+    Raised when the docker daemon answers with an error status
+    """
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection over a UNIX socket
+    """
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class EngineAPI:
+    """
+    Subset of the Engine API used to list and remove stacks. Method signatures and return values
+    follow docker.APIClient, so either can be passed to functions which only need these calls.
+    """
+
+    def __init__(self, socket_path=DEFAULT_DOCKER_SOCKET, timeout=30):
+        """
+        Constructor
+
+        :param socket_path: (str) Docker daemon socket. Default: /var/run/docker.sock
+        :param timeout: (float) Socket timeout in seconds. Default: 30
+        """
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def _request(self, method, path, **params):
+        """
+        Sends a request and decodes the JSON response
+
+        :param method: (str) HTTP method
+        :param path: (str) API path, e.g. /containers/json
+        :param params: Query parameters
+        :return: (object) Decoded response, None if empty
+        :raises: (EngineAPIError) On an error status
+        """
+        if params:
+            path = "{0}?{1}".format(path, urlencode(params))
+        connection = UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+        try:
+            connection.request(method, path)
+            response = connection.getresponse()
+            body = response.read()
+        finally:
+            connection.close()
+        if response.status >= 400:
+            raise EngineAPIError("{0} {1}: {2}".format(response.status, path, body.decode("utf-8", errors="replace")),
+                                 status_code=response.status)
+        return json.loads(body) if body else None
+
+    def get(self, path, **params):
+        """
+        Sends a GET request and decodes the JSON response
+
+        :param path: (str) API path, e.g. /containers/json
+        :param params: Query parameters
+        :return: (object) Decoded response
+        :raises: (EngineAPIError) On an error status
+        """
+        return self._request("GET", path, **params)
+
+    def delete(self, path, **params):
+        """
+        Sends a DELETE request
+
+        :param path: (str) API path, e.g. /containers/<id>
+        :param params: Query parameters
+        :return: (object) Decoded response, None if empty
+        :raises: (EngineAPIError) On an error status
+        """
+        return self._request("DELETE", path, **params)
+
+    @staticmethod
+    def _filters(filters):
+        return json.dumps({key: value if isinstance(value, list) else [value] for key, value in filters.items()})
+
+    def containers(self, all=False, filters=None, size=False):
+        """
+        Lists containers
+
+        :param all: (bool) Include stopped containers. Default: False
+        :param filters: (dict) Filters, values may be strings or lists. Default: None
+        :param size: (bool) Include the size of the writable layers. Default: False
+        :return: (list) Container dicts as returned by the API
+        """
+        params = {"all": int(all), "size": int(size)}
+        if filters:
+            params["filters"] = self._filters(filters)
+        return self.get("/containers/json", **params)
+
+    def stats(self, container, stream=False):
+        """
+        Returns a single resource usage sample of a container
+
+        :param container: (str) Container id or name
+        :param stream: (bool) Must be False, only single samples are supported. Default: False
+        :return: (dict) Stats as returned by the API
+        """
+        if stream:
+            raise ValueError("Streaming stats is not supported")
+        return self.get("/containers/{0}/stats".format(quote(container)), stream=0)
+
+    def images(self, filters=None):
+        """
+        Lists images
+
+        :param filters: (dict) Filters, values may be strings or lists. Default: None
+        :return: (list) Image dicts as returned by the API
+        """
+        return self.get("/images/json", **({"filters": self._filters(filters)} if filters else {}))
+
+    def networks(self, names=None, filters=None):
+        """
+        Lists networks
+
+        :param names: (list) Only networks with these names. Default: None
+        :param filters: (dict) Filters, values may be strings or lists. Default: None
+        :return: (list) Network dicts as returned by the API
+        """
+        filters = dict(filters or {})
+        if names:
+            filters["name"] = names
+        return self.get("/networks", **({"filters": self._filters(filters)} if filters else {}))
+
+    def remove_container(self, container, v=False, force=False):
+        """
+        Removes a container
+
+        :param container: (str) Container id or name
+        :param v: (bool) Remove its anonymous volumes. Default: False
+        :param force: (bool) Kill it if running. Default: False
+        :return: None
+        """
+        self.delete("/containers/{0}".format(quote(container)), v=int(v), force=int(force))
+
+    def remove_network(self, net_id):
+        """
+        Removes a network
+
+        :param net_id: (str) Network id or name
+        :return: None
+        """
+        self.delete("/networks/{0}".format(quote(net_id)))
+
+    def remove_image(self, image, force=False):
+        """
+        Removes an image
+
+        :param image: (str) Image id or name
+        :param force: (bool) Remove it even if tagged several times. Default: False
+        :return: None
+        """
+        self.delete("/images/{0}".format(quote(image, safe="/:")), force=int(force))
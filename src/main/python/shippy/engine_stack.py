@@ -0,0 +1,245 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+shippy.engine_stack
+===================
+
+Sets up and tears down stacks directly through the Docker Engine API, instead of running docker-compose
+"""
+import json
+import hashlib
+import logging
+
+from functools import partial
+from docker import APIClient
+from docker.errors import APIError, NotFound
+
+from shippy.container_stack import ContainerStack, PROJECT_LABEL, SERVICE_LABEL, NUMBER_LABEL, ONEOFF_LABEL, \
+    CONFIG_HASH_LABEL
+from shippy.dag import Task, run_graph
+from shippy.image_puller import split_image_name
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_STACK_WORKERS = 4
+
+
+class EngineStack(ContainerStack):
+    """
+    Stack backend talking to the Docker API. It creates the same network, containers and
+    volumes_from wiring as the docker-compose template, and uses the same names and labels.
+
+    Services are created as a graph: containers whose volumes_from sources are ready are created
+    and started concurrently. Like `docker-compose up`, a redeploy keeps a container whose image
+    and config are unchanged, so the database keeps its volumes. The compose file is still written by write_compose_file, for
+    humans, but it is not read back.
+    """
+
+    def __init__(self, config, sha, working_dir, volume_tag, client=None, workers=DEFAULT_STACK_WORKERS):
+        """
+        Constructor
+
+        :param config: (dict) Configuration object as parsed by shippy.config
+        :param sha: (str) Commit hash of the stack
+        :param working_dir: (str) Sourcecode directory, receives the compose file
+        :param volume_tag: (str) Image tag of the data volume
+        :param client: (docker.APIClient) Docker client to reuse. Default: None, connect to the local daemon
+        :param workers: (int) Maximum concurrent API operations. Default: 4
+        """
+        super().__init__(config, sha, working_dir, volume_tag)
+        self.cli = client or APIClient(base_url='unix://var/run/docker.sock')
+        self.workers = workers
+        self.network_name = "{project}_default".format(project=self.project)
+        self._container_ids = {}
+
+    def _labels(self, service=None):
+        labels = dict(self.labels(), **{PROJECT_LABEL: self.project})
+        if service:
+            labels.update({SERVICE_LABEL: service, NUMBER_LABEL: "1", ONEOFF_LABEL: "False"})
+        return labels
+
+    def _project_containers(self):
+        return self.cli.containers(all=True, filters={"label": "{0}={1}".format(PROJECT_LABEL, self.project)})
+
+    def _ensure_network(self):
+        """
+        Creates the project network unless it exists
+
+        :return: None
+        """
+        if self.cli.networks(names=[self.network_name]):
+            return
+        LOGGER.info("Creating network: %s", self.network_name)
+        try:
+            self.cli.create_network(self.network_name, driver="bridge", labels=self._labels())
+        except APIError as e:
+            # Another deployment of the same stack created it first
+            if e.status_code != 409:
+                raise
+
+    def _ensure_image(self, image):
+        """
+        Pulls an image unless it is present locally
+
+        :param image: (str) Image name
+        :return: (str) Image id
+        """
+        try:
+            return self.cli.inspect_image(image)["Id"]
+        except NotFound:
+            LOGGER.info("Pulling image: %s", image)
+            repository, tag = split_image_name(image)
+            self.cli.pull(repository, tag=tag)
+            return self.cli.inspect_image(image)["Id"]
+
+    def _config_hash(self, service):
+        """
+        Digests a service description, together with the containers it takes volumes from
+
+        :param service: (dict) Service description, see services()
+        :return: (str) Hex digest
+        """
+        config = dict(service, volumes_from=[self._container_ids.get(source) for source in service.get("volumes_from", [])])
+        return hashlib.sha256(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _reuse_existing(self, name, image_id, config_hash):
+        """
+        Keeps a container left by a previous deployment of the stack if it was created from the
+        same image and config, else removes it. Its volumes are kept either way, they are only
+        removed when the stack is terminated.
+
+        :param name: (str) Container name
+        :param image_id: (str) Id of the service's image
+        :param config_hash: (str) Digest of the service's config
+        :return: (str) Id of the kept container, None if there is none
+        """
+        try:
+            container = self.cli.inspect_container(name)
+        except NotFound:
+            return None
+        labels = container["Config"].get("Labels") or {}
+        if container["Image"] == image_id and labels.get(CONFIG_HASH_LABEL) == config_hash:
+            if not container["State"]["Running"]:
+                self.cli.start(container["Id"])
+            LOGGER.info("Container is up to date: %s", name)
+            return container["Id"]
+        try:
+            self.cli.remove_container(container["Id"], force=True)
+            LOGGER.info("Removed outdated container: %s", name)
+        except NotFound:
+            pass
+        return None
+
+    def _create_service(self, service):
+        """
+        Creates and starts the container of one service, unless an up to date one exists
+
+        :param service: (dict) Service description, see services()
+        :return: (str) Container id
+        """
+        name = self.container_name(service["name"])
+        image_id = self._ensure_image(service["image"])
+        config_hash = self._config_hash(service)
+        container_id = self._reuse_existing(name, image_id, config_hash)
+        if container_id:
+            self._container_ids[service["name"]] = container_id
+            return container_id
+
+        host_config_args = {}
+        networking_config = None
+        if service.get("restart"):
+            host_config_args["restart_policy"] = {"Name": service["restart"]}
+        if service.get("volumes_from"):
+            host_config_args["volumes_from"] = [self.container_name(source) for source in service["volumes_from"]]
+        if service.get("network_mode"):
+            host_config_args["network_mode"] = service["network_mode"]
+        else:
+            host_config_args["network_mode"] = self.network_name
+            networking_config = self.cli.create_networking_config({
+                self.network_name: self.cli.create_endpoint_config(aliases=[service["name"]])
+            })
+
+        environment = ["{0}={1}".format(key, value) for key, value in service.get("environment", {}).items()]
+        LOGGER.info("Creating container: %s", name)
+        container = self.cli.create_container(
+            service["image"],
+            name=name,
+            environment=environment or None,
+            hostname=service.get("hostname"),
+            labels=dict(self._labels(service["name"]), **{CONFIG_HASH_LABEL: config_hash}),
+            host_config=self.cli.create_host_config(**host_config_args),
+            networking_config=networking_config
+        )
+        self.cli.start(container["Id"])
+        self._container_ids[service["name"]] = container["Id"]
+        return container["Id"]
+
+    def _run_on_containers(self, func):
+        """
+        Applies a function to every container of the stack concurrently
+
+        :param func: (callable) Called with each container dict
+        :return: (list) Containers of the stack
+        """
+        containers = self._project_containers()
+        tasks = [Task(container["Id"], partial(func, container)) for container in containers]
+        run_graph(tasks, max_workers=self.workers)
+        return containers
+
+    def start(self):
+        """
+        Creates the network and containers of the stack and starts them
+
+        :return: (dict) Maps service names to container ids
+        """
+        LOGGER.info("Starting stack %s through the docker API", self.project)
+        self._ensure_network()
+        tasks = [Task(service["name"], partial(self._create_service, service), service["depends_on"])
+                 for service in self.services()]
+        return run_graph(tasks, max_workers=self.workers)
+
+    def stop(self):
+        """
+        Stops the containers of the stack
+
+        :return: None
+        """
+        self._run_on_containers(lambda container: self.cli.stop(container["Id"]))
+
+    def terminate(self):
+        """
+        Removes the containers, network and data volume image of the stack. The application and
+        database images are shared with other stacks, so unlike `down --rmi all` they are kept.
+
+        :return: None
+        """
+        containers = self._run_on_containers(lambda container: self.cli.remove_container(container["Id"], force=True, v=True))
+        LOGGER.info("Removed %d containers of stack %s", len(containers), self.project)
+
+        for network in self.cli.networks(names=[self.network_name]):
+            self.cli.remove_network(network["Id"])
+
+        # Without a known tag, the data image is the one the source data container was created from
+        source_data = self.services()[0]["name"]
+        volume_tag = self.volume_tag or next((container["Image"] for container in containers
+                                              if container["Labels"].get(SERVICE_LABEL) == source_data), None)
+        if volume_tag:
+            try:
+                self.cli.remove_image(volume_tag)
+            except NotFound:
+                pass
+            except APIError as e:
+                LOGGER.warning("Could not remove data image %s: %s", volume_tag, e)
@@ -0,0 +1,308 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+shippy.extractor
+================
+
+In-process extraction of repository tarballs, from files or from streams still being downloaded
+"""
+import os
+import stat
+import shutil
+import logging
+import tarfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from shippy import tracing
+
+LOGGER = logging.getLogger(__name__)
+
+COPY_BUFFER_SIZE = 256 * 1024
+# Files are always created anew, so a path left behind as a symlink is never written through
+CREATE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_NOFOLLOW", 0)
+DEFAULT_WORKERS = 8
+# Members up to this size are read into memory and written by the worker pool,
+# larger ones are copied straight from the archive on the reading thread
+PARALLEL_WRITE_THRESHOLD = 1024 * 1024
+
+
+class UnsafeArchiveError(Exception):
+    """
+    Raised when an archive member would be written outside the destination directory
+    """
+
+
+class ArchiveExtractor:
+    """
+    Extracts tar archives below a destination directory, removing leading path components
+    like `tar --strip-components` does.
+
+    The archive is read strictly sequentially, so it works on non-seekable streams such as an
+    HTTP response body. Small files are handed to a thread pool for writing, so per-file
+    open/write/chmod latency overlaps with reading and decompressing the rest of the archive.
+    """
+
+    def __init__(self, destination, strip_components=1, workers=DEFAULT_WORKERS):
+        """
+        Constructor
+
+        :param destination: (str) Directory to extract into
+        :param strip_components: (int) Number of leading path components to remove. Default: 1
+        :param workers: (int) Number of file writer threads, 0 writes on the reading thread. Default: 8
+        """
+        self.destination = os.path.realpath(destination)
+        self.strip_components = strip_components
+        self.workers = workers
+        self.files_extracted = 0
+        self.bytes_extracted = 0
+        self._symlinks = set()
+        self._directories = set()
+        self._directory_modes = {}
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(workers, 1) * 4)
+        self._pool = None
+        self._error = None
+
+    def _target_path(self, name):
+        """
+        Maps an archive member name to its path below the destination
+
+        :param name: (str) Member name
+        :return: (str) Destination path, or None if the member is stripped away entirely
+        :raises: (UnsafeArchiveError) If the member escapes the destination
+        """
+        parts = [part for part in name.split("/") if part and part != "."]
+        parts = parts[self.strip_components:]
+        if not parts:
+            return None
+        if ".." in parts:
+            raise UnsafeArchiveError("Refusing to extract member with parent reference: {0}".format(name))
+        for depth in range(1, len(parts)):
+            if os.path.join(*parts[:depth]) in self._symlinks:
+                raise UnsafeArchiveError("Refusing to extract member through a symlink: {0}".format(name))
+        return os.path.join(self.destination, *parts)
+
+    def _inside(self, path):
+        return os.path.commonpath([self.destination, path]) == self.destination
+
+    def _check_link(self, path, linkname):
+        """
+        Ensures a symlink created at path resolves inside the destination. The target is resolved
+        against the extracted tree, as the OS would, so symlinks extracted earlier are followed.
+
+        :param path: (str) Path the link will be created at
+        :param linkname: (str) Link target as stored in the archive
+        :return: None
+        :raises: (UnsafeArchiveError) If the link points outside the destination
+        """
+        if os.path.isabs(linkname):
+            raise UnsafeArchiveError("Refusing to create absolute symlink: {0} -> {1}".format(path, linkname))
+        if not self._inside(os.path.realpath(os.path.join(os.path.dirname(path), linkname))):
+            raise UnsafeArchiveError("Refusing to create symlink outside destination: {0} -> {1}".format(path, linkname))
+
+    def _clear(self, path):
+        """
+        Removes a non-directory an earlier member left at path, so the new member replaces it
+        rather than being written through it
+
+        :param path: (str) Path a file or link is about to be created at
+        :return: None
+        :raises: (UnsafeArchiveError) If path is a directory
+        """
+        try:
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            return
+        if stat.S_ISDIR(mode):
+            raise UnsafeArchiveError("Refusing to replace a directory with a file: {0}".format(path))
+        os.unlink(path)
+        self._symlinks.discard(os.path.relpath(path, self.destination))
+
+    def extract(self, fileobj, mode="r|gz"):
+        """
+        Extracts every member of the archive read from fileobj
+
+        :param fileobj: (file) Readable binary file object
+        :param mode: (str) tarfile open mode. Default: r|gz
+        :return: (str) Destination directory
+        """
+        self._makedirs(self.destination)
+        self._pool = ThreadPoolExecutor(max_workers=self.workers) if self.workers else None
+        try:
+            with tarfile.open(fileobj=fileobj, mode=mode) as archive:
+                for member in archive:
+                    self._extract_member(archive, member)
+            self._wait_pending()
+        finally:
+            if self._pool:
+                self._pool.shutdown(wait=True)
+                self._pool = None
+
+        # Directory modes are applied last, in case one removes write permission
+        for path, dir_mode in self._directory_modes.items():
+            os.chmod(path, dir_mode)
+        LOGGER.info("Extracted %d files (%d bytes) into: %s", self.files_extracted, self.bytes_extracted, self.destination)
+        tracing.count(files_extracted=self.files_extracted, bytes_extracted=self.bytes_extracted)
+        return self.destination
+
+    def extract_file(self, archive_path):
+        """
+        Extracts the archive stored at archive_path
+
+        :param archive_path: (str) Path to a gzipped tarball
+        :return: (str) Destination directory
+        """
+        with open(archive_path, "rb") as f:
+            return self.extract(f)
+
+    def _extract_member(self, archive, member):
+        """
+        Extracts a single member
+
+        :param archive: (tarfile.TarFile) Open archive
+        :param member: (tarfile.TarInfo) Member to extract
+        :return: None
+        """
+        path = self._target_path(member.name)
+        if path is None:
+            return
+
+        if member.isdir():
+            if os.path.islink(path):
+                raise UnsafeArchiveError("Refusing to create directory over a symlink: {0}".format(member.name))
+            self._makedirs(path)
+            self._directory_modes[path] = member.mode & 0o777 | 0o700
+        elif member.isfile():
+            self._makedirs(os.path.dirname(path))
+            self._wait_pending(path)
+            self._clear(path)
+            source = archive.extractfile(member)
+            if self._pool and member.size <= PARALLEL_WRITE_THRESHOLD:
+                self._submit_write(path, source.read(), member.mode)
+            else:
+                self._write_file(source, path, member.mode)
+            self.files_extracted += 1
+            self.bytes_extracted += member.size
+        elif member.issym():
+            self._makedirs(os.path.dirname(path))
+            self._wait_pending(path)
+            self._clear(path)
+            self._check_link(path, member.linkname)
+            os.symlink(member.linkname, path)
+            self._symlinks.add(os.path.relpath(path, self.destination))
+        elif member.islnk():
+            source = self._target_path(member.linkname)
+            if source is None:
+                raise UnsafeArchiveError("Hardlink target stripped away: {0}".format(member.linkname))
+            self._makedirs(os.path.dirname(path))
+            self._wait_pending(source)
+            self._wait_pending(path)
+            self._clear(path)
+            os.link(source, path, follow_symlinks=False)
+        else:
+            LOGGER.debug("Skipping unsupported archive member: %s", member.name)
+
+    def _makedirs(self, path):
+        """
+        Creates a directory and its parents, skipping the syscall for directories
+        this extraction already created
+
+        :param path: (str) Directory path
+        :return: None
+        """
+        if path in self._directories:
+            return
+        os.makedirs(path, exist_ok=True)
+        if not self._inside(os.path.realpath(path)):
+            raise UnsafeArchiveError("Refusing to extract into a directory outside destination: {0}".format(path))
+        while path not in self._directories and path != self.destination:
+            self._directories.add(path)
+            path = os.path.dirname(path)
+
+    def _submit_write(self, path, data, mode):
+        """
+        Queues a file write on the worker pool, blocking while too many writes are in flight
+        so memory use stays bounded
+
+        :param path: (str) Destination path
+        :param data: (bytes) File contents
+        :param mode: (int) Permission bits from the archive
+        :return: None
+        """
+        if self._error is not None:
+            raise self._error
+        self._slots.acquire()
+        future = self._pool.submit(self._write_bytes, path, data, mode)
+        with self._pending_lock:
+            self._pending[path] = future
+        future.add_done_callback(lambda f: self._write_done(path, f))
+
+    def _write_done(self, path, future):
+        self._slots.release()
+        error = future.exception()
+        with self._pending_lock:
+            if error is not None:
+                self._error = self._error or error
+            elif self._pending.get(path) is future:
+                del self._pending[path]
+
+    def _wait_pending(self, path=None):
+        """
+        Waits for queued writes to finish, re-raising the first failure
+
+        :param path: (str) Only wait for the write to this path. Default: None, wait for all writes
+        :return: None
+        """
+        with self._pending_lock:
+            if path is None:
+                futures = list(self._pending.values())
+            else:
+                futures = [self._pending[path]] if path in self._pending else []
+        for future in futures:
+            future.result()
+
+    @staticmethod
+    def _create(path, mode):
+        """
+        Creates a new file, failing rather than following a symlink at path
+
+        :param path: (str) Destination path
+        :param mode: (int) Permission bits from the archive
+        :return: (file) Writable binary file object
+        """
+        fd = os.open(path, CREATE_FLAGS, 0o600)
+        os.fchmod(fd, mode & 0o777)
+        return os.fdopen(fd, "wb")
+
+    @classmethod
+    def _write_bytes(cls, path, data, mode):
+        with cls._create(path, mode) as f:
+            f.write(data)
+
+    @classmethod
+    def _write_file(cls, source, path, mode):
+        """
+        Copies a member's contents to path and applies its permission bits
+
+        :param source: (file) Member file object
+        :param path: (str) Destination path
+        :param mode: (int) Permission bits from the archive
+        :return: None
+        """
+        with cls._create(path, mode) as f:
+            shutil.copyfileobj(source, f, COPY_BUFFER_SIZE)
@@ -0,0 +1,259 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+shippy.garbage_collector
+========================
+
+Reclaims the containers, networks, data images and workspaces of old stacks according to
+count, age, disk and memory policies
+"""
+import os
+import time
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from shippy.cache import remove_path
+from shippy.container_stack import list_stacks, terminate_stacks, normalize_project_name
+from shippy.dag import Task, run_graph
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_GC_WORKERS = 4
+MB = 1024 * 1024
+
+
+class GCPolicy:
+    """
+    Limits on the stacks kept on a host. Unset limits are not enforced.
+    """
+
+    def __init__(self, max_stacks_per_app=None, max_age_hours=None, disk_budget_mb=None, memory_budget_mb=None,
+                 pinned=None):
+        """
+        Constructor
+
+        :param max_stacks_per_app: (int) Stacks kept per application. Default: None
+        :param max_age_hours: (float) Hours since a stack was last deployed before it is removed. Default: None
+        :param disk_budget_mb: (float) Disk space shippy's containers and data images may use. Default: None
+        :param memory_budget_mb: (float) Memory shippy's running containers may use. Default: None
+        :param pinned: (list) Commit hashes or stack ids never removed. Default: None
+        """
+        self.max_stacks_per_app = max_stacks_per_app
+        self.max_age_hours = max_age_hours
+        self.disk_budget_mb = disk_budget_mb
+        self.memory_budget_mb = memory_budget_mb
+        self.pinned = set(pinned or [])
+
+    @classmethod
+    def from_config(cls, config, **overrides):
+        """
+        Creates a policy from the optional `gc` config section
+
+        :param config: (dict) Configuration object as parsed by shippy.config
+        :param overrides: Policy arguments replacing the config values, unless None
+        :return: (GCPolicy)
+        """
+        gc_config = dict(config.get("gc", {}))
+        gc_config.update({key: value for key, value in overrides.items() if value is not None})
+        return cls(**{key: gc_config.get(key) for key in
+                      ("max_stacks_per_app", "max_age_hours", "disk_budget_mb", "memory_budget_mb", "pinned")})
+
+    @property
+    def enabled(self):
+        return any(limit is not None for limit in
+                   (self.max_stacks_per_app, self.max_age_hours, self.disk_budget_mb, self.memory_budget_mb))
+
+
+class GarbageCollector:
+    """
+    Removes stacks breaking a GCPolicy, least recently deployed first. A stack was last used
+    when it was last deployed according to the journal, or when its newest container was
+    created. Pinned stacks are never removed, but still count towards the limits.
+    """
+
+    def __init__(self, client, policy, journal=None, workspace=None, workers=DEFAULT_GC_WORKERS):
+        """
+        Constructor
+
+        :param client: (docker.APIClient|shippy.engine_api.EngineAPI) Docker client
+        :param policy: (GCPolicy) Limits to enforce
+        :param journal: (shippy.journal.DeployJournal) Journal holding pins and deploy times. Default: None
+        :param workspace: (str) Directory holding the deployments' working directories, removed along
+                          with their stacks. Default: None, leave them
+        :param workers: (int) Stacks removed at once. Default: 4
+        """
+        self.client = client
+        self.policy = policy
+        self.journal = journal
+        self.workspace = workspace
+        self.workers = workers
+
+    def _memory_usage(self, stack):
+        """
+        Samples the memory used by the running containers of a stack
+
+        :param stack: (dict) Stack, see shippy.container_stack.list_stacks
+        :return: (int) Bytes
+        """
+        usage = 0
+        for container in stack["containers"]:
+            if container["state"] == "running":
+                usage += self.client.stats(container["name"], stream=False).get("memory_stats", {}).get("usage", 0)
+        return usage
+
+    def _is_pinned(self, stack, pins):
+        """
+        :param stack: (dict) Stack, see shippy.container_stack.list_stacks
+        :param pins: (list) Pins recorded in the journal, see shippy.journal.DeployJournal.pins
+        :return: (bool) Whether the policy or the journal pins the stack
+        """
+        if stack["sha"] in self.policy.pinned or stack["stack"] in self.policy.pinned:
+            return True
+        return any(sha == stack["sha"] and app in (None, stack["app"]) for app, sha in pins)
+
+    def collect(self):
+        """
+        Lists the stacks on the host along with what they use
+
+        :return: (list) Stacks, see shippy.container_stack.list_stacks, with the added keys
+                 last_used, disk_usage, memory_usage and pinned
+        """
+        measure_disk = self.policy.disk_budget_mb is not None
+        stacks = list_stacks(self.client, size=measure_disk, orphans=True)
+        deploy_times = self.journal.deploy_times() if self.journal else {}
+        pins = self.journal.pins() if self.journal else []
+
+        for stack in stacks:
+            deploy_id = "{0}_{1}".format(stack["app"], stack["sha"])
+            stack["last_used"] = max(stack["updated"], deploy_times.get(deploy_id, 0))
+            stack["disk_usage"] = stack["image_size"] + (stack["disk_size"] or 0) if measure_disk else None
+            stack["pinned"] = self._is_pinned(stack, pins)
+
+        if self.policy.memory_budget_mb is not None:
+            # One stats request per container, each of which can take a second or two
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="gc-stats") as executor:
+                usages = executor.map(self._memory_usage, stacks)
+            for stack, usage in zip(stacks, usages):
+                stack["memory_usage"] = usage
+        else:
+            for stack in stacks:
+                stack["memory_usage"] = None
+        return stacks
+
+    def plan(self, stacks, now=None, protect=(), reserve=None):
+        """
+        Chooses the stacks to remove
+
+        :param stacks: (list) Stacks as returned by collect()
+        :param now: (float) Current unix time. Default: None, the current time
+        :param protect: (set) Stack ids to keep, such as those being deployed. Default: ()
+        :param reserve: (dict) Maps application names to the number of new stacks about to be
+                        deployed, which max_stacks_per_app makes room for. Default: None
+        :return: (list) (stack, reason) tuples, least recently used first
+        """
+        now = time.time() if now is None else now
+        reserve = reserve or {}
+        by_age = sorted(stacks, key=lambda stack: stack["last_used"])
+        evicted = {}
+
+        def evictable(stack):
+            return not stack["pinned"] and stack["stack"] not in protect and stack["stack"] not in evicted
+
+        if self.policy.max_age_hours is not None:
+            cutoff = now - self.policy.max_age_hours * 3600
+            for stack in by_age:
+                if stack["last_used"] < cutoff and evictable(stack):
+                    evicted[stack["stack"]] = "unused for over {0} hours".format(self.policy.max_age_hours)
+
+        if self.policy.max_stacks_per_app is not None:
+            for app in sorted({stack["app"] for stack in stacks}):
+                kept = [stack for stack in by_age if stack["app"] == app and stack["stack"] not in evicted]
+                excess = len(kept) + reserve.get(app, 0) - self.policy.max_stacks_per_app
+                for stack in [stack for stack in kept if evictable(stack)][:max(excess, 0)]:
+                    evicted[stack["stack"]] = "more than {0} stacks of {1}".format(self.policy.max_stacks_per_app, app)
+
+        for key, budget_mb, label in (("disk_usage", self.policy.disk_budget_mb, "disk"),
+                                      ("memory_usage", self.policy.memory_budget_mb, "memory")):
+            if budget_mb is None:
+                continue
+            total = sum(stack[key] for stack in stacks if stack["stack"] not in evicted)
+            for stack in by_age:
+                if total <= budget_mb * MB:
+                    break
+                if evictable(stack):
+                    evicted[stack["stack"]] = "over the {0}MB {1} budget".format(budget_mb, label)
+                    total -= stack[key]
+
+        return [(stack, evicted[stack["stack"]]) for stack in by_age if stack["stack"] in evicted]
+
+    def _evict(self, stack):
+        """
+        Removes one stack and its working directory
+
+        :param stack: (dict) Stack to remove
+        :return: (dict) Removed resource counts, see shippy.container_stack.terminate_stacks
+        """
+        removed = terminate_stacks(self.client, stack=stack["stack"])
+        deploy_id = "{0}_{1}".format(stack["app"], stack["sha"])
+        if self.workspace and stack["app"] and stack["sha"]:
+            remove_path(os.path.join(self.workspace, deploy_id))
+        if self.journal:
+            self.journal.forget(deploy_id)
+        return removed
+
+    def run(self, dry_run=False, protect=(), reserve=None, stacks=None):
+        """
+        Removes the stacks breaking the policy, several at once
+
+        :param dry_run: (bool) Only report what would be removed. Default: False
+        :param protect: (set) Stack ids to keep. Default: ()
+        :param reserve: (dict) New stacks about to be deployed per application, see plan(). Default: None
+        :param stacks: (list) Stacks as returned by collect(). Default: None, collect them
+        :return: (list) (stack, reason) tuples of the stacks removed, or to remove on a dry run
+        """
+        evictions = self.plan(self.collect() if stacks is None else stacks, protect=protect, reserve=reserve)
+        for stack, reason in evictions:
+            LOGGER.info("%s stack %s: %s", "Would remove" if dry_run else "Removing", stack["stack"], reason)
+        if dry_run or not evictions:
+            return evictions
+
+        def evict(stack):
+            try:
+                return self._evict(stack)
+            except Exception as e:
+                LOGGER.error("Could not remove stack %s: %s", stack["stack"], e)
+                return None
+
+        results = run_graph([Task(stack["stack"], partial(evict, stack)) for stack, _ in evictions],
+                            max_workers=self.workers)
+        return [(stack, reason) for stack, reason in evictions if results[stack["stack"]] is not None]
+
+    def make_room(self, app_name, shas, dry_run=False):
+        """
+        Collects garbage before deploying, keeping the stacks being deployed and making room
+        for the new ones under max_stacks_per_app
+
+        :param app_name: (str) Application being deployed
+        :param shas: (list) Commit hashes being deployed
+        :param dry_run: (bool) Only report what would be removed. Default: False
+        :return: (list) (stack, reason) tuples, see run()
+        """
+        stacks = self.collect()
+        targets = {normalize_project_name("{0}_{1}".format(app_name, sha)) for sha in shas}
+        existing = {stack["stack"] for stack in stacks if stack["app"] == app_name}
+        return self.run(dry_run=dry_run, protect=targets, reserve={app_name: len(targets - existing)}, stacks=stacks)
@@ -0,0 +1,236 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+shippy.image_puller
+===================
+
+Pulls the service images of a stack in the background, reporting layer-level progress, so
+the pulls overlap with fetching and building the sourcecode
+"""
+import time
+import logging
+import threading
+import contextvars
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_PROGRESS_INTERVAL = 5.0
+COMPLETE_STATUSES = ("Pull complete", "Already exists")
+
+
+class ImagePullError(Exception):
+    """
+    Raised when an image can't be pulled
+    """
+
+
+def split_image_name(image):
+    """
+    Splits an image name into repository and tag, the tag defaults to latest
+
+    :param image: (str) Image name, e.g. mysql/mysql-server:8.0
+    :return: (tuple) Repository and tag
+    """
+    if ":" in image.rsplit("/", 1)[-1]:
+        repository, _, tag = image.rpartition(":")
+        return repository, tag
+    return image, "latest"
+
+
+class PullProgress:
+    """
+    Progress of one image pull, folded from the daemon's JSON progress messages
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self.layers = {}
+        self.status = "waiting"
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+
+    def update(self, message):
+        """
+        Records a progress message
+
+        :param message: (dict) Decoded message from the pull stream
+        :return: None
+        :raises: (ImagePullError) On an error message
+        """
+        if "error" in message:
+            raise ImagePullError("{0}: {1}".format(self.image, message["error"]))
+        layer = message.get("id")
+        status = message.get("status", "")
+        # Messages without a layer id, or with the tag as id, describe the whole pull
+        if not layer or status.startswith(("Pulling from", "Digest:", "Status:")):
+            return
+        entry = self.layers.setdefault(layer, {"status": status, "current": 0, "total": 0})
+        entry["status"] = status
+        detail = message.get("progressDetail") or {}
+        if status == "Downloading" and detail.get("total"):
+            entry["current"] = detail.get("current", 0)
+            entry["total"] = detail["total"]
+        elif status in ("Download complete", "Extracting") or status in COMPLETE_STATUSES:
+            entry["current"] = entry["total"]
+
+    def summary(self):
+        """
+        :return: (dict) Layer counts and byte totals, with the keys image, status, layers,
+                 complete, downloaded and size
+        """
+        layers = list(self.layers.values())
+        return {
+            "image": self.image,
+            "status": self.status,
+            "layers": len(layers),
+            "complete": sum(1 for layer in layers if layer["status"] in COMPLETE_STATUSES),
+            "downloaded": sum(layer["current"] for layer in layers),
+            "size": sum(layer["total"] for layer in layers),
+        }
+
+    def describe(self):
+        summary = self.summary()
+        return "{image}: {complete}/{layers} layers, {downloaded_mb:.1f} of {size_mb:.1f}MB downloaded".format(
+            downloaded_mb=summary["downloaded"] / 1048576.0, size_mb=summary["size"] / 1048576.0, **summary)
+
+
+class ImagePuller:
+    """
+    Pulls images missing locally on one background thread each. Images already present are
+    not pulled again, as with `docker-compose up`.
+    """
+
+    def __init__(self, client, images, progress_interval=DEFAULT_PROGRESS_INTERVAL):
+        """
+        Constructor
+
+        :param client: (docker.APIClient) Docker client
+        :param images: (list) Image names to pull, duplicates are pulled once
+        :param progress_interval: (float) Seconds between progress log lines. Default: 5
+        """
+        self.client = client
+        self.images = list(dict.fromkeys(images))
+        self.progress_interval = progress_interval
+        self.progress = {image: PullProgress(image) for image in self.images}
+        self._started = False
+        self._threads = []
+        self._errors = {}
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._done = threading.Event()
+
+    def start(self):
+        """
+        Starts pulling in the background, subsequent calls do nothing
+
+        :return: (ImagePuller) self
+        """
+        with self._lock:
+            if self._started:
+                return self
+            self._started = True
+            for image in self.images:
+                thread = threading.Thread(target=contextvars.copy_context().run, args=(self._pull, image),
+                                          name="pull-{0}".format(image), daemon=True)
+                self._threads.append(thread)
+            reporter = threading.Thread(target=contextvars.copy_context().run, args=(self._report,),
+                                        name="pull-progress", daemon=True)
+        for thread in self._threads:
+            thread.start()
+        reporter.start()
+        return self
+
+    def _present(self, image):
+        import docker.errors
+        try:
+            self.client.inspect_image(image)
+            return True
+        except docker.errors.NotFound:
+            return False
+
+    def _pull(self, image):
+        """
+        Pulls one image, recording its progress
+
+        :param image: (str) Image name
+        :return: None
+        """
+        progress = self.progress[image]
+        progress.started_at = time.monotonic()
+        try:
+            if self._present(image):
+                progress.status = "present"
+                return
+            progress.status = "pulling"
+            LOGGER.info("Pulling image: %s", image)
+            repository, tag = split_image_name(image)
+            for message in self.client.pull(repository, tag=tag, stream=True, decode=True):
+                progress.update(message)
+                if self._cancelled.is_set():
+                    progress.status = "cancelled"
+                    return
+            progress.status = "pulled"
+        except Exception as e:
+            progress.status = "failed"
+            progress.error = str(e)
+            with self._lock:
+                self._errors[image] = e if isinstance(e, ImagePullError) else ImagePullError("{0}: {1}".format(image, e))
+        finally:
+            progress.finished_at = time.monotonic()
+            if progress.status == "pulled":
+                LOGGER.info("Pulled %s in %.1fs", progress.describe(), progress.finished_at - progress.started_at)
+
+    def _report(self):
+        """
+        Logs the progress of running pulls every progress_interval seconds until they finish
+
+        :return: None
+        """
+        while True:
+            deadline = time.monotonic() + self.progress_interval
+            for thread in self._threads:
+                thread.join(timeout=max(deadline - time.monotonic(), 0))
+            if not any(thread.is_alive() for thread in self._threads):
+                break
+            for progress in self.progress.values():
+                if progress.status == "pulling":
+                    LOGGER.info("Pulling %s", progress.describe())
+        self._done.set()
+
+    def cancel(self):
+        """
+        Stops reading the pull streams. The docker daemon may still finish the pulls.
+
+        :return: None
+        """
+        self._cancelled.set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until every pull finished, starting them if needed
+
+        :param timeout: (float) Seconds to wait. Default: None, no limit
+        :return: (dict) Maps image names to their progress summaries
+        :raises: (ImagePullError) If a pull failed or the timeout expired
+        """
+        self.start()
+        if not self._done.wait(timeout):
+            raise ImagePullError("Timed out pulling: {0}".format(", ".join(
+                image for image, progress in self.progress.items() if progress.finished_at is None)))
+        if self._errors:
+            raise ImagePullError("; ".join(str(e) for e in self._errors.values()))
+        return {image: progress.summary() for image, progress in self.progress.items()}
@@ -0,0 +1,276 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+shippy.journal
+==============
+
+Records the progress of deployments in SQLite, so an interrupted deployment can resume after
+the last stage whose outputs are still intact. The same database holds the stacks pinned
+against garbage collection.
+"""
+import os
+import json
+import time
+import stat
+import sqlite3
+import hashlib
+import logging
+
+from contextlib import contextmanager
+from shippy.utils import create_directory
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_WORKSPACE = "/tmp/shippy/archives"
+JOURNAL_FILENAME = "journal.sqlite"
+
+STARTED = "started"
+COMPLETED = "completed"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS deploys (
+    deploy_id TEXT PRIMARY KEY,
+    inputs_digest TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stages (
+    deploy_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    state TEXT,
+    artifacts TEXT,
+    error TEXT,
+    PRIMARY KEY (deploy_id, stage)
+);
+CREATE TABLE IF NOT EXISTS pins (
+    app TEXT NOT NULL,
+    sha TEXT NOT NULL,
+    pinned_at REAL NOT NULL,
+    PRIMARY KEY (app, sha)
+);
+"""
+
+
+def tree_digest(path, exclude=()):
+    """
+    Fingerprints a directory tree from the paths, sizes and modification times of its entries,
+    without reading file contents
+
+    :param path: (str) Directory
+    :param exclude: (tuple) Names of top-level files to leave out. Default: ()
+    :return: (str) Hex digest, None if the directory doesn't exist
+    """
+    if not os.path.isdir(path):
+        return None
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if root == path and name in exclude:
+                continue
+            filepath = os.path.join(root, name)
+            info = os.lstat(filepath)
+            relpath = os.path.relpath(filepath, path)
+            entry = "{0}\0{1}\0{2}\0{3}\n".format(relpath, stat.S_IFMT(info.st_mode), info.st_size, info.st_mtime_ns)
+            digest.update(entry.encode("utf-8", errors="surrogateescape"))
+    return digest.hexdigest()
+
+
+class DeployJournal:
+    """
+    Journal of deployment stages, kept in one SQLite database per workspace. Each completed stage
+    stores the attributes later stages need (`state`) and digests of the files, trees and images
+    it produced (`artifacts`), so it can be skipped on a later run while those are unchanged.
+
+    Connections are opened per operation, so concurrent deployments in threads or processes
+    can share the journal.
+    """
+
+    def __init__(self, path):
+        """
+        Constructor
+
+        :param path: (str) Path to the SQLite database, created if missing
+        """
+        self.path = path
+        create_directory(os.path.dirname(path) or ".")
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def begin(self, deploy_id, inputs_digest, resume=True):
+        """
+        Starts recording a deployment. Stages recorded by a previous run are forgotten unless
+        resuming with the same inputs.
+
+        :param deploy_id: (str) Deployment identifier
+        :param inputs_digest: (str) Digest of the config and files the deployment was started with
+        :param resume: (bool) Keep the stages of a previous run. Default: True
+        :return: (bool) Whether previous stages were kept
+        """
+        with self._connect() as connection:
+            row = connection.execute("SELECT inputs_digest FROM deploys WHERE deploy_id = ?", (deploy_id,)).fetchone()
+            kept = resume and row is not None and row[0] == inputs_digest
+            if row is not None and not kept:
+                if resume:
+                    LOGGER.info("Inputs of %s changed since the last run, starting over", deploy_id)
+                connection.execute("DELETE FROM stages WHERE deploy_id = ?", (deploy_id,))
+            connection.execute("INSERT OR REPLACE INTO deploys (deploy_id, inputs_digest, updated_at) VALUES (?, ?, ?)",
+                               (deploy_id, inputs_digest, time.time()))
+        return kept
+
+    def stage_started(self, deploy_id, stage):
+        """
+        :param deploy_id: (str) Deployment identifier
+        :param stage: (str) Stage name
+        :return: None
+        """
+        with self._connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO stages (deploy_id, stage, status, started_at) VALUES (?, ?, ?, ?)",
+                               (deploy_id, stage, STARTED, time.time()))
+
+    def stage_completed(self, deploy_id, stage, state=None, artifacts=None):
+        """
+        :param deploy_id: (str) Deployment identifier
+        :param stage: (str) Stage name
+        :param state: (dict) Attributes to restore when the stage is skipped. Default: None
+        :param artifacts: (list) Artifact dicts with the keys kind, ref and digest. Default: None
+        :return: None
+        """
+        with self._connect() as connection:
+            connection.execute("UPDATE stages SET status = ?, finished_at = ?, state = ?, artifacts = ?, error = NULL "
+                               "WHERE deploy_id = ? AND stage = ?",
+                               (COMPLETED, time.time(), json.dumps(state or {}), json.dumps(artifacts or []), deploy_id, stage))
+
+    def stage_failed(self, deploy_id, stage, error):
+        """
+        :param deploy_id: (str) Deployment identifier
+        :param stage: (str) Stage name
+        :param error: (str) Description of the failure
+        :return: None
+        """
+        with self._connect() as connection:
+            connection.execute("UPDATE stages SET status = ?, finished_at = ?, error = ? WHERE deploy_id = ? AND stage = ?",
+                               (FAILED, time.time(), error, deploy_id, stage))
+
+    def stages(self, deploy_id):
+        """
+        :param deploy_id: (str) Deployment identifier
+        :return: (dict) Maps stage names to records with the keys stage, status, started_at,
+                 finished_at, state, artifacts and error
+        """
+        with self._connect() as connection:
+            rows = connection.execute("SELECT stage, status, started_at, finished_at, state, artifacts, error "
+                                      "FROM stages WHERE deploy_id = ?", (deploy_id,)).fetchall()
+        return {
+            row[0]: {"stage": row[0], "status": row[1], "started_at": row[2], "finished_at": row[3],
+                     "state": json.loads(row[4] or "{}"), "artifacts": json.loads(row[5] or "[]"), "error": row[6]}
+            for row in rows
+        }
+
+    def resumable_stages(self, deploy_id, stages, current_digest):
+        """
+        Returns the leading stages which completed and whose artifacts are unchanged. Stages may
+        modify the artifacts of earlier ones, the build writing into the unpacked tree for
+        instance, so every artifact is compared with the digest recorded for it last.
+
+        :param deploy_id: (str) Deployment identifier
+        :param stages: (list) Stage names in the order they run
+        :param current_digest: (callable) Called with an artifact's kind and ref, returns its current digest
+        :return: (list) Records of the stages which can be skipped, see stages()
+        """
+        records = self.stages(deploy_id)
+        completed = []
+        for stage in stages:
+            record = records.get(stage)
+            if record is None or record["status"] != COMPLETED:
+                break
+            completed.append(record)
+
+        expected = {}
+        for record in completed:
+            for artifact in record["artifacts"]:
+                expected[(artifact["kind"], artifact["ref"])] = artifact["digest"]
+        valid = {key: current_digest(*key) == digest for key, digest in expected.items()}
+
+        resumable = []
+        for record in completed:
+            changed = [artifact["ref"] for artifact in record["artifacts"] if not valid[(artifact["kind"], artifact["ref"])]]
+            if changed:
+                LOGGER.info("Outputs of stage %s changed: %s", record["stage"], ", ".join(changed))
+                break
+            resumable.append(record)
+        return resumable
+
+    def deploy_times(self):
+        """
+        :return: (dict) Maps deployment identifiers to the unix time they last started
+        """
+        with self._connect() as connection:
+            return dict(connection.execute("SELECT deploy_id, updated_at FROM deploys").fetchall())
+
+    def forget(self, deploy_id):
+        """
+        Drops every record of a deployment
+
+        :param deploy_id: (str) Deployment identifier
+        :return: None
+        """
+        with self._connect() as connection:
+            connection.execute("DELETE FROM stages WHERE deploy_id = ?", (deploy_id,))
+            connection.execute("DELETE FROM deploys WHERE deploy_id = ?", (deploy_id,))
+
+    def pin(self, sha, app_name=None):
+        """
+        Protects the stacks of a commit hash from garbage collection
+
+        :param sha: (str) Commit hash
+        :param app_name: (str) Only pin the stack of this application. Default: None, any application
+        :return: None
+        """
+        with self._connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO pins (app, sha, pinned_at) VALUES (?, ?, ?)",
+                               (app_name or "", sha, time.time()))
+
+    def unpin(self, sha, app_name=None):
+        """
+        :param sha: (str) Commit hash
+        :param app_name: (str) Application the pin was made for. Default: None
+        :return: (bool) Whether the pin existed
+        """
+        with self._connect() as connection:
+            cursor = connection.execute("DELETE FROM pins WHERE app = ? AND sha = ?", (app_name or "", sha))
+        return cursor.rowcount > 0
+
+    def pins(self):
+        """
+        :return: (list) (application name, commit hash) tuples, the name is None for pins on every application
+        """
+        with self._connect() as connection:
+            rows = connection.execute("SELECT app, sha FROM pins ORDER BY pinned_at").fetchall()
+        return [(app or None, sha) for app, sha in rows]
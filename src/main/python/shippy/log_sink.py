@@ -0,0 +1,253 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+shippy.log_sink
+===============
+
+Captures the raw output of build commands and docker builds without logging it line by line.
+
+Output is written unparsed to one gzip file per deployment stage, and only a bounded tail of
+each source is kept in memory for error reports. The JSON stream docker sends while building
+an image is parsed incrementally into progress and error events.
+"""
+import os
+import re
+import gzip
+import json
+import codecs
+import logging
+import threading
+
+from collections import deque
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_TAIL_BYTES = 8192
+# Output is compressed on the path of every chunk, so favour speed over ratio
+COMPRESS_LEVEL = 1
+# A source's unfinished line is written anyway once it grows this long, e.g. progress bars
+MAX_PARTIAL_LINE = 64 * 1024
+STEP_PATTERN = re.compile(r"Step (\d+)/(\d+) : (.*)")
+
+
+class LogTail:
+    """
+    The last max_bytes of a byte stream
+    """
+
+    def __init__(self, max_bytes=DEFAULT_TAIL_BYTES):
+        """
+        Constructor
+
+        :param max_bytes: (int) Bytes to keep. Default: 8KB
+        """
+        self.max_bytes = max_bytes
+        self._chunks = deque()
+        self._size = 0
+
+    def append(self, data):
+        """
+        Adds data, dropping whole chunks from the front once they fall out of the tail
+
+        :param data: (bytes) Output
+        :return: None
+        """
+        if len(data) >= self.max_bytes:
+            self._chunks.clear()
+            data = data[-self.max_bytes:]
+            self._size = 0
+        self._chunks.append(data)
+        self._size += len(data)
+        while self._size - len(self._chunks[0]) >= self.max_bytes:
+            self._size -= len(self._chunks.popleft())
+
+    def text(self):
+        """
+        :return: (str) The tail, decoded leniently
+        """
+        return b"".join(self._chunks)[-self.max_bytes:].decode("utf-8", errors="replace")
+
+
+class LogSink:
+    """
+    Compressed log of one deployment stage, shared by the sources writing to it such as the
+    stdout and stderr of each build command. Sources are interleaved at line boundaries, and a
+    `==> source <==` header marks where the writing source changes.
+    """
+
+    def __init__(self, path=None, tail_bytes=DEFAULT_TAIL_BYTES):
+        """
+        Constructor
+
+        :param path: (str) gzip file to append to, created on the first write. Default: None, keep tails only
+        :param tail_bytes: (int) Bytes of each source kept in memory. Default: 8KB
+        """
+        self.path = path
+        self.tail_bytes = tail_bytes
+        self.bytes_written = 0
+        self._tails = {}
+        self._partial = {}
+        self._current = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def write(self, source, data):
+        """
+        Appends raw output of a source. A trailing unfinished line is held back until the
+        source completes it, so lines of different sources are never mixed.
+
+        :param source: (str) Name of the output source, e.g. "npm install (stderr)"
+        :param data: (bytes) Output
+        :return: None
+        """
+        with self._lock:
+            tail = self._tails.get(source)
+            if tail is None:
+                tail = self._tails[source] = LogTail(self.tail_bytes)
+            tail.append(data)
+            if self.path is None:
+                return
+
+            data = self._partial.pop(source, b"") + data
+            end = data.rfind(b"\n") + 1
+            if len(data) - end >= MAX_PARTIAL_LINE:
+                end = len(data)
+            if end < len(data):
+                self._partial[source] = data[end:]
+            if end:
+                self._write(source, data[:end])
+
+    def _write(self, source, data):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = gzip.open(self.path, "ab", compresslevel=COMPRESS_LEVEL)
+        if source != self._current:
+            self._file.write("==> {0} <==\n".format(source).encode("utf-8"))
+            self._current = source
+        self._file.write(data)
+        self.bytes_written += len(data)
+
+    def tail(self, source):
+        """
+        :param source: (str) Name of the output source
+        :return: (str) The last output of the source, empty if it wrote nothing
+        """
+        with self._lock:
+            tail = self._tails.get(source)
+            return tail.text() if tail else ""
+
+    def close(self):
+        """
+        Writes the held back unfinished lines and closes the file
+
+        :return: None
+        """
+        with self._lock:
+            for source, data in self._partial.items():
+                self._write(source, data + b"\n")
+            self._partial.clear()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BuildEvent:
+    """
+    A message of the docker build stream
+    """
+
+    def __init__(self, kind, message="", step=None, total=None, detail=None):
+        """
+        Constructor
+
+        :param kind: (str) One of "output", "step", "progress", "aux" or "error"
+        :param message: (str) Output text, step instruction, status or error message
+        :param step: (int) Dockerfile step number of a "step" event. Default: None
+        :param total: (int) Number of Dockerfile steps of a "step" event. Default: None
+        :param detail: (dict) The decoded message. Default: None
+        """
+        self.kind = kind
+        self.message = message
+        self.step = step
+        self.total = total
+        self.detail = detail
+
+    def __repr__(self):
+        return "BuildEvent({0!r}, {1!r})".format(self.kind, self.message)
+
+
+class BuildStreamParser:
+    """
+    Incrementally parses the JSON messages docker sends while building an image. A chunk may
+    hold several messages, or only part of one.
+    """
+
+    def __init__(self):
+        self.image_id = None
+        self._buffer = ""
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def feed(self, chunk):
+        """
+        Parses the complete messages received so far
+
+        :param chunk: (bytes) Data from the build response
+        :return: (list) BuildEvent instances
+        """
+        buffer = self._buffer + self._text.decode(chunk)
+        events = []
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position == len(buffer):
+                break
+            try:
+                message, position = self._decoder.raw_decode(buffer, position)
+            except ValueError:
+                newline = buffer.find("\n", position)
+                if newline < 0:
+                    # An incomplete message, wait for the rest
+                    break
+                LOGGER.warning("Skipping malformed build message: %s", buffer[position:newline][:200])
+                position = newline + 1
+                continue
+            if isinstance(message, dict):
+                events.append(self._event(message))
+        self._buffer = buffer[position:]
+        return events
+
+    def _event(self, message):
+        if "error" in message or "errorDetail" in message:
+            detail = message.get("errorDetail") or {}
+            return BuildEvent("error", detail.get("message") or message.get("error", ""), detail=message)
+        if "stream" in message:
+            text = message["stream"]
+            match = STEP_PATTERN.match(text)
+            if match:
+                return BuildEvent("step", text, step=int(match.group(1)), total=int(match.group(2)), detail=message)
+            return BuildEvent("output", text, detail=message)
+        if "aux" in message:
+            self.image_id = (message["aux"] or {}).get("ID", self.image_id)
+            return BuildEvent("aux", self.image_id or "", detail=message)
+        return BuildEvent("progress", message.get("status", ""), detail=message)
@@ -0,0 +1,97 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+shippy.pipeline
+===============
+
+Runs the stages of many deployments side by side, with bounded concurrency per stage
+"""
+import logging
+import contextvars
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_STAGE_CONCURRENCY = {
+    "fetch": 4,
+    "unpack": 2,
+    "build": 2,
+    "volume": 1,
+    "compose": 4,
+    "start": 2,
+}
+
+
+class Pipeline:
+    """
+    Pushes jobs through a fixed sequence of stages. Every job runs its stages in order, but
+    while one job builds another can be fetching, so network, CPU and docker daemon work
+    overlap. A semaphore per stage bounds how many jobs are in that stage at once.
+    """
+
+    def __init__(self, stages, concurrency=None):
+        """
+        Constructor
+
+        :param stages: (list) Stage names, run on each job in order
+        :param concurrency: (dict) Maximum jobs per stage. Default: None, use DEFAULT_STAGE_CONCURRENCY
+        """
+        limits = dict(DEFAULT_STAGE_CONCURRENCY, **(concurrency or {}))
+        self.stages = list(stages)
+        self.limits = {stage: limits.get(stage, 1) for stage in self.stages}
+        self.semaphores = {stage: threading.BoundedSemaphore(limit) for stage, limit in self.limits.items()}
+
+    def _run_job(self, name, job):
+        """
+        Runs every stage of a single job
+
+        :param name: (str) Job name used in log messages
+        :param job: (object) Object with one method per stage, or a run_stage(stage) method
+        :return: None
+        """
+        for stage in self.stages:
+            with self.semaphores[stage]:
+                LOGGER.info("[%s] Entering stage: %s", name, stage)
+                run_stage = getattr(job, "run_stage", None)
+                if run_stage is not None:
+                    run_stage(stage)
+                else:
+                    getattr(job, stage)()
+
+    def run(self, jobs):
+        """
+        Runs all jobs through the pipeline. A failing job stops at the failed stage without
+        affecting the others.
+
+        :param jobs: (dict) Maps job names to jobs
+        :return: (dict) Maps the names of failed jobs to the exception they raised
+        """
+        # Enough threads for every job to occupy a stage slot, but no more
+        max_workers = max(min(len(jobs), sum(self.limits.values())), 1)
+        failures = {}
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pipeline") as executor:
+            # Run each job in a copy of the caller's context, so context variables such as the
+            # daemon's current job follow the work onto the pool threads
+            futures = {executor.submit(contextvars.copy_context().run, self._run_job, name, job): name for name, job in jobs.items()}
+            for future, name in futures.items():
+                try:
+                    future.result()
+                except (Exception, SystemExit) as e:
+                    LOGGER.error("[%s] Deployment failed: %r", name, e)
+                    failures[name] = e
+        return failures
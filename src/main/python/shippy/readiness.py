@@ -0,0 +1,392 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+shippy.readiness
+================
+
+Waits until the services of a started stack are actually serving, driven by the docker events
+stream and container healthchecks rather than sleeps
+"""
+import re
+import time
+import socket
+import logging
+import threading
+import http.client
+
+from concurrent.futures import ThreadPoolExecutor
+from docker import APIClient
+
+from shippy.container_stack import PROJECT_LABEL
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 300
+DEFAULT_PROBE_INTERVAL = 0.5
+DEFAULT_WARMUP_REQUESTS = 20
+DEFAULT_WARMUP_CONCURRENCY = 4
+
+
+class ReadinessError(Exception):
+    """
+    Raised when services fail, or don't become ready in time
+    """
+
+
+def resolve_service(stack, name):
+    """
+    Maps a service name from the config to the stack's service, accepting `app` and
+    `source_data` as short names for the application and source data services
+
+    :param stack: (shippy.container_stack.ContainerStack) Stack
+    :param name: (str) Configured service name
+    :return: (str) Service name
+    :raises: (ValueError) If the stack has no such service
+    """
+    services = [service["name"] for service in stack.services()]
+    for service in services:
+        if service == name or service.endswith("_" + name) and name in ("app", "source_data"):
+            return service
+    raise ValueError("Unknown service: {0}, expected one of: {1}".format(name, ", ".join(services)))
+
+
+class ServiceCheck:
+    """
+    Readiness criteria of one service. Every service must have started, and have passed its
+    container healthcheck if the image defines one. Optionally it must also:
+
+    * `tcp`: accept connections on a port, given as a number or `{"port", "host"}`
+    * `http`: answer `{"port", "path", "host", "status"}` with an accepted status, 2xx or 3xx by default
+    * `log`: print a line matching a regular expression
+    """
+
+    def __init__(self, service, container_name, tcp=None, http=None, log=None):
+        """
+        Constructor
+
+        :param service: (str) Service name
+        :param container_name: (str) Name of the service's container
+        :param tcp: (int|dict) Port to connect to. Default: None
+        :param http: (dict) HTTP request to make. Default: None
+        :param log: (str) Regular expression to find in the container's logs. Default: None
+        """
+        self.service = service
+        self.container_name = container_name
+        self.tcp = {"port": tcp} if isinstance(tcp, int) else tcp
+        self.http = dict({"path": "/"}, **http) if http else None
+        self.log = re.compile(log) if log else None
+
+    def __repr__(self):
+        return "ServiceCheck({0!r})".format(self.service)
+
+
+class _ServiceState:
+    """
+    What the events stream has told us about a container
+    """
+
+    def __init__(self):
+        self.started = False
+        self.healthy = False
+        self.exit_code = None
+        self.changed = threading.Condition()
+
+    def update(self, **fields):
+        with self.changed:
+            for key, value in fields.items():
+                setattr(self, key, value)
+            self.changed.notify_all()
+
+
+class ReadinessMonitor:
+    """
+    Watches the containers of a stack until every service is ready, and measures how long each took
+    """
+
+    def __init__(self, client, project, checks, timeout=DEFAULT_TIMEOUT, probe_interval=DEFAULT_PROBE_INTERVAL):
+        """
+        Constructor
+
+        :param client: (docker.APIClient) Docker client
+        :param project: (str) Compose project name of the stack
+        :param checks: (list) ServiceCheck for each service to wait for
+        :param timeout: (float) Seconds to wait for the whole stack. Default: 300
+        :param probe_interval: (float) Seconds between TCP or HTTP connection attempts. Default: 0.5
+        """
+        self.client = client
+        self.project = project
+        self.checks = list(checks)
+        self.timeout = timeout
+        self.probe_interval = probe_interval
+        self._states = {check.container_name: _ServiceState() for check in self.checks}
+
+    @classmethod
+    def from_config(cls, stack, readiness_config, client=None):
+        """
+        Builds a monitor for a stack from the `readiness` config. Services are named as in the
+        compose file, with `app` and `source_data` accepted as short names.
+
+        :param stack: (shippy.container_stack.ContainerStack) Started stack
+        :param readiness_config: (dict) The `readiness` config
+        :param client: (docker.APIClient) Docker client. Default: None, connect to the local daemon
+        :return: (ReadinessMonitor)
+        """
+        services = [service["name"] for service in stack.services()]
+        configured = {resolve_service(stack, name): entry for name, entry in readiness_config.get("services", {}).items()}
+        checks = [ServiceCheck(name, stack.container_name(name), **configured.get(name, {})) for name in services]
+        return cls(client or APIClient(base_url='unix://var/run/docker.sock'), stack.project, checks,
+                   timeout=readiness_config.get("timeout", DEFAULT_TIMEOUT))
+
+    def _handle_event(self, event):
+        """
+        Records container state changes reported by the events stream
+
+        :param event: (dict) Decoded docker event
+        :return: None
+        """
+        attributes = event.get("Actor", {}).get("Attributes", {})
+        state = self._states.get(attributes.get("name"))
+        action = event.get("Action") or event.get("status") or ""
+        if state is None:
+            return
+        if action == "start":
+            state.update(started=True, exit_code=None)
+        elif action == "die":
+            state.update(exit_code=int(attributes.get("exitCode", -1)))
+        elif action.startswith("health_status"):
+            state.update(healthy=action.endswith("healthy") and not action.endswith("unhealthy"))
+
+    def _watch_events(self, events):
+        try:
+            for event in events:
+                self._handle_event(event)
+        except Exception as e:
+            # Closing the stream from wait() interrupts the read
+            LOGGER.debug("Events stream closed: %r", e)
+
+    def _inspect(self, check):
+        return self.client.inspect_container(check.container_name)
+
+    def _sync_state(self, check):
+        """
+        Seeds the state from an inspect, covering anything that happened before the events subscription
+
+        :param check: (ServiceCheck) Service to inspect
+        :return: (dict) Inspect output
+        """
+        info = self._inspect(check)
+        state = info.get("State", {})
+        health = state.get("Health") or {}
+        fields = {}
+        if state.get("Running") or state.get("StartedAt", "0001").startswith(("1", "2")):
+            fields["started"] = True
+        if health.get("Status") == "healthy":
+            fields["healthy"] = True
+        if state.get("Status") == "exited":
+            fields["exit_code"] = state.get("ExitCode", -1)
+        self._states[check.container_name].update(**fields)
+        return info
+
+    def _wait_for(self, state, predicate, deadline, what, fail_on_exit=False):
+        with state.changed:
+            while not predicate():
+                if fail_on_exit and state.exit_code is not None:
+                    raise ReadinessError("Container exited with code {0} while waiting for {1}".format(state.exit_code, what))
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ReadinessError("Timed out waiting for {0}".format(what))
+                state.changed.wait(remaining)
+
+    @staticmethod
+    def container_address(info):
+        """
+        Returns the address a container can be reached at from the host
+
+        :param info: (dict) Inspect output of the container
+        :return: (str)
+        """
+        networks = info.get("NetworkSettings", {}).get("Networks") or {}
+        for network in networks.values():
+            if network.get("IPAddress"):
+                return network["IPAddress"]
+        return info.get("NetworkSettings", {}).get("IPAddress") or "127.0.0.1"
+
+    def _probe_tcp(self, host, port):
+        with socket.create_connection((host, port), timeout=self.probe_interval * 4):
+            return True
+
+    def _probe_http(self, host, spec):
+        connection = http.client.HTTPConnection(host, spec["port"], timeout=self.probe_interval * 4)
+        try:
+            connection.request("GET", spec["path"])
+            status = connection.getresponse().status
+        finally:
+            connection.close()
+        accepted = spec.get("status")
+        return status in accepted if accepted else 200 <= status < 400
+
+    def _wait_for_probe(self, state, probe, deadline, what, fail_on_exit=False):
+        """
+        Retries a connection probe until it succeeds. Only used once the container runs, so the
+        attempts are bounded by how long the service takes to open its port.
+        """
+        while True:
+            try:
+                if probe():
+                    return
+            except OSError:
+                pass
+            if fail_on_exit and state.exit_code is not None:
+                raise ReadinessError("Container exited with code {0} while waiting for {1}".format(state.exit_code, what))
+            if time.monotonic() + self.probe_interval > deadline:
+                raise ReadinessError("Timed out waiting for {0}".format(what))
+            time.sleep(self.probe_interval)
+
+    def _wait_for_log(self, check, deadline):
+        """
+        Follows the container's logs until a line matches
+
+        :param check: (ServiceCheck) Service to follow
+        :param deadline: (float) time.monotonic() deadline
+        :return: None
+        """
+        logs = self.client.logs(check.container_name, stream=True, follow=True)
+        timer = threading.Timer(max(deadline - time.monotonic(), 0), logs.close)
+        timer.start()
+        buffer = b""
+        try:
+            for chunk in logs:
+                buffer += chunk
+                *lines, buffer = buffer.split(b"\n")
+                if any(check.log.search(line.decode("utf-8", errors="replace")) for line in lines):
+                    return
+        except Exception as e:
+            LOGGER.debug("Log stream of %s closed: %r", check.container_name, e)
+        finally:
+            timer.cancel()
+            logs.close()
+        if check.log.search(buffer.decode("utf-8", errors="replace")):
+            return
+        raise ReadinessError("Timed out waiting for log line /{0}/".format(check.log.pattern))
+
+    def _wait_service(self, check, started, deadline):
+        """
+        Waits until one service is ready
+
+        :param check: (ServiceCheck) Service to wait for
+        :param started: (float) time.monotonic() when waiting began
+        :param deadline: (float) time.monotonic() deadline
+        :return: (float) Seconds until the service was ready
+        """
+        state = self._states[check.container_name]
+        self._wait_for(state, lambda: state.started, deadline, "{0} to start".format(check.service))
+
+        info = self._sync_state(check)
+        # Without a restart policy a container which exits will never become ready
+        fail_on_exit = (info.get("HostConfig", {}).get("RestartPolicy") or {}).get("Name", "no") in ("", "no")
+        healthcheck = (info.get("Config", {}).get("Healthcheck") or {}).get("Test")
+        if healthcheck and healthcheck != ["NONE"]:
+            self._wait_for(state, lambda: state.healthy, deadline, "{0} to become healthy".format(check.service), fail_on_exit)
+
+        host = self.container_address(info)
+        if check.tcp:
+            address = (check.tcp.get("host", host), check.tcp["port"])
+            self._wait_for_probe(state, lambda: self._probe_tcp(*address), deadline,
+                                 "{0} to accept connections on {1}:{2}".format(check.service, *address), fail_on_exit)
+        if check.http:
+            target = check.http.get("host", host)
+            self._wait_for_probe(state, lambda: self._probe_http(target, check.http), deadline,
+                                 "{0} to answer http://{1}:{2}{3}".format(check.service, target, check.http["port"], check.http["path"]), fail_on_exit)
+        if check.log:
+            self._wait_for_log(check, deadline)
+
+        return time.monotonic() - started
+
+    def wait(self, since=None):
+        """
+        Blocks until every service is ready
+
+        :param since: (int) Unix time the stack was started at, events from then on are replayed. Default: None
+        :return: (dict) Maps service names to seconds until ready
+        :raises: (ReadinessError) If a service failed or the timeout expired
+        """
+        started = time.monotonic()
+        deadline = started + self.timeout
+        events = self.client.events(since=since, decode=True,
+                                    filters={"type": "container", "label": "{0}={1}".format(PROJECT_LABEL, self.project)})
+        watcher = threading.Thread(target=self._watch_events, args=(events,), name="readiness-events", daemon=True)
+        watcher.start()
+
+        ready_times = {}
+        failures = {}
+        try:
+            for check in self.checks:
+                self._sync_state(check)
+            with ThreadPoolExecutor(max_workers=max(len(self.checks), 1), thread_name_prefix="readiness") as executor:
+                futures = {check.service: executor.submit(self._wait_service, check, started, deadline) for check in self.checks}
+                for service, future in futures.items():
+                    try:
+                        ready_times[service] = future.result()
+                        LOGGER.info("Service %s ready after %.2fs", service, ready_times[service])
+                    except Exception as e:
+                        failures[service] = e
+        finally:
+            events.close()
+
+        if failures:
+            raise ReadinessError("; ".join("{0}: {1}".format(service, e) for service, e in failures.items()))
+        return ready_times
+
+
+def warm_up(host, port, path="/", requests=DEFAULT_WARMUP_REQUESTS, concurrency=DEFAULT_WARMUP_CONCURRENCY, timeout=30):
+    """
+    Sends a burst of requests to a freshly started service, so caches and lazy initialisation
+    are paid for before real traffic arrives
+
+    :param host: (str) Host to send requests to
+    :param port: (int) Port to send requests to
+    :param path: (str) Request path. Default: /
+    :param requests: (int) Number of requests. Default: 20
+    :param concurrency: (int) Requests in flight at once. Default: 4
+    :param timeout: (float) Seconds per request. Default: 30
+    :return: (list) Request latencies in seconds, in submission order, failed requests omitted
+    """
+    def request(_):
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        started = time.monotonic()
+        try:
+            connection.request("GET", path)
+            connection.getresponse().read()
+            return time.monotonic() - started
+        except OSError as e:
+            LOGGER.debug("Warm-up request failed: %r", e)
+            return None
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="warmup") as executor:
+        results = list(executor.map(request, range(requests)))
+    latencies = [latency for latency in results if latency is not None]
+
+    if latencies:
+        ordered = sorted(latencies)
+        # The first request submitted is the one most likely to pay for a cold start
+        first = "{0:.3f}s".format(results[0]) if results[0] is not None else "failed"
+        LOGGER.info("Warm-up: %d/%d requests, first request %s, median %.3fs, max %.3fs",
+                    len(latencies), requests, first, ordered[len(ordered) // 2], ordered[-1])
+    else:
+        LOGGER.warning("Warm-up: all %d requests failed", requests)
+    return latencies
@@ -20,10 +20,12 @@ shippy.repository_archive
 Parses and downloads archive file for a given github repository
 """
 import os
-import requests
 import logging
+import requests
 
-from tqdm import tqdm
+from shippy import tracing
+from shippy.downloader import get_downloader
+from shippy.extractor import ArchiveExtractor
 from shippy.utils import get_repository_username, get_repository_appname
 
 
@@ -33,8 +35,9 @@ LOGGER = logging.getLogger(__name__)
 
 class RepositoryArchive:
 
-    def __init__(self, url):
+    def __init__(self, url, downloader=None):
         self.url = url
+        self.downloader = downloader or get_downloader()
         self.username = get_repository_username(url)
         self.repo_name = get_repository_appname(url)
 
@@ -54,26 +57,89 @@ class RepositoryArchive:
         archive_url = url_pattern.format(api_base=GITHUB_API_BASEURL, user=self.username, reponame=self.repo_name, format=format, ref=sha)
         return archive_url
 
-    def fetch(self, sha, download_path="/tmp"):
+    def get_parent_sha(self, sha):
+        """
+        Looks up the first parent of the given commit through the github API
+
+        :param sha: (str) Commit hash
+        :return: (str) Parent commit hash, or None if it can't be determined
+        """
+        url = "{api_base}/repos/{user}/{reponame}/commits/{ref}".format(api_base=GITHUB_API_BASEURL, user=self.username, reponame=self.repo_name, ref=sha)
+        try:
+            response = self.downloader.session.get(url, timeout=self.downloader.timeout)
+            response.raise_for_status()
+            parents = response.json().get("parents", [])
+        except (requests.exceptions.RequestException, ValueError) as e:
+            LOGGER.warning("Could not look up parent of %s: %s", sha, e)
+            return None
+        return parents[0]["sha"] if parents else None
+
+    def fetch(self, sha, download_path="/tmp", cache=None):
         """
         Downloads the archive for the given commit hash
 
         :param sha: (str) Commit hash to download
         :param download_path: (str) Filesystem path to download archive to. Default: /tmp
+        :param cache: (shippy.cache.ArchiveCache) Archive cache to consult before downloading. Default: None
         :return: (str) Full path to the downloaded archive
         """
         filename = "{0}.tar.gz".format(self.repo_name)
         local_filename = os.path.join(download_path, filename)
         download_url = self.get_archive_url(sha)
 
-        LOGGER.info("Downloading to: %s", local_filename)
-        r = requests.get(download_url, stream=True)
+        if cache and cache.get(self.url, sha, "tarball", local_filename):
+            tracing.annotate(cache="hit")
+            return local_filename
 
-        # Get the total size in bytes
-        total_size = int(r.headers.get("content-length", 0))
+        LOGGER.info("Downloading to: %s", local_filename)
+        digest = self.downloader.download(download_url, local_filename)
 
-        with open(local_filename, 'wb') as f:
-            for chunk in tqdm(r.iter_content(32 * 1024), total=total_size, unit="B", unit_scale=True):
-                if chunk:
-                    f.write(chunk)
+        if cache:
+            cache.put(self.url, sha, "tarball", local_filename, digest)
         return local_filename
+
+    def fetch_extract(self, sha, output_dir, cache=None):
+        """
+        Streams the archive for the given commit hash straight into output_dir, stripping the
+        top-level directory github adds. Files are written while the download is in flight and
+        no intermediate tarball is written to the working directory.
+
+        When a cache is given, a cached archive is extracted instead of downloading, and a fresh
+        download is copied into the cache as it streams past.
+
+        :param sha: (str) Commit hash to download
+        :param output_dir: (str) Directory to extract the sourcecode into
+        :param cache: (shippy.cache.ArchiveCache) Archive cache to consult before downloading. Default: None
+        :return: (str) output_dir
+        """
+        extractor = ArchiveExtractor(output_dir, strip_components=1)
+        if cache:
+            cached_path = cache.entry_path(cache.make_key(self.url, sha, "tarball"))
+            local_filename = "{0}.{1}.stream".format(cached_path, os.getpid())
+            if cache.get(self.url, sha, "tarball", local_filename):
+                tracing.annotate(cache="hit")
+                try:
+                    return extractor.extract_file(local_filename)
+                finally:
+                    if os.path.exists(local_filename):
+                        os.remove(local_filename)
+
+        download_url = self.get_archive_url(sha)
+        LOGGER.info("Streaming %s into: %s", download_url, output_dir)
+        if not cache:
+            with self.downloader.open_stream(download_url) as stream:
+                return extractor.extract(stream)
+
+        try:
+            with open(local_filename, "wb") as sink:
+                with self.downloader.open_stream(download_url, sink=sink) as stream:
+                    extractor.extract(stream)
+                    # Drain any trailing padding so the cached copy is complete
+                    while stream.read(64 * 1024):
+                        pass
+                    digest = stream.digest.hexdigest()
+            cache.put(self.url, sha, "tarball", local_filename, digest)
+        finally:
+            if os.path.exists(local_filename):
+                os.remove(local_filename)
+        return output_dir
@@ -0,0 +1,339 @@
+#  shippy
+#  Copyright 2017 Vik Bhatti
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+shippy.tracing
+==============
+
+Timed spans around the deployment stages and their sub-operations, exported as JSON lines
+and as a Prometheus textfile, with optional cProfile output per stage.
+
+Code deep inside a stage records into the span of the current context through the module
+level span(), count() and annotate() functions, which do nothing when no tracer is active.
+"""
+import os
+import re
+import json
+import time
+import logging
+import threading
+import contextvars
+
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(__name__)
+
+METRIC_PREFIX = "shippy_span"
+
+# Innermost span of the current thread or task
+_CURRENT_SPAN = contextvars.ContextVar("shippy_current_span", default=None)
+
+
+class Span:
+    """
+    A timed operation. Numeric attributes are measurements, such as bytes downloaded, other
+    attributes describe the operation and are inherited by child spans as labels.
+    """
+
+    def __init__(self, tracer, name, parent=None, attributes=None):
+        """
+        Constructor
+
+        :param tracer: (Tracer) Tracer collecting the span
+        :param name: (str) Operation name
+        :param parent: (Span) Enclosing span. Default: None
+        :param attributes: (dict) Initial attributes. Default: None
+        """
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.id = os.urandom(8).hex()
+        self.trace_id = parent.trace_id if parent else self.id
+        self.path = "{0}.{1}".format(parent.path, name) if parent else name
+        self.attributes = dict(attributes or {})
+        self.started_at = time.time()
+        self.duration = None
+        self.status = "ok"
+        self.error = None
+        self._lock = threading.Lock()
+
+    def annotate(self, **attributes):
+        """
+        Sets attributes of the span
+
+        :return: None
+        """
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def count(self, **amounts):
+        """
+        Adds to numeric attributes of the span, starting from 0
+
+        :return: None
+        """
+        with self._lock:
+            for key, amount in amounts.items():
+                self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def labels(self):
+        """
+        :return: (dict) String attributes of the span and its parents, the innermost winning
+        """
+        labels = self.parent.labels() if self.parent else {}
+        labels.update((key, value) for key, value in self.attributes.items() if isinstance(value, str))
+        return labels
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.id,
+            "parent_id": self.parent.id if self.parent else None,
+            "name": self.name,
+            "path": self.path,
+            "started_at": self.started_at,
+            "duration": self.duration,
+            "status": self.status,
+            "error": self.error,
+            "attributes": dict(self.attributes),
+        }
+
+
+class Tracer:
+    """
+    Collects the spans of one or more deployments
+    """
+
+    def __init__(self, jsonl_path=None, prometheus_path=None, profile_dir=None):
+        """
+        Constructor
+
+        :param jsonl_path: (str) File the spans are appended to as JSON lines. Default: None
+        :param prometheus_path: (str) Prometheus textfile replaced with the span metrics. Default: None
+        :param profile_dir: (str) Directory receiving a pstats file per profiled span. Default: None
+        """
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.profile_dir = profile_dir
+        self.spans = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, profile_dir=None):
+        """
+        Creates a tracer from the optional `tracing` config section
+
+        :param config: (dict) Configuration object as parsed by shippy.config
+        :param profile_dir: (str) Overrides `tracing.profile_dir`. Default: None
+        :return: (Tracer)
+        """
+        tracing_config = config.get("tracing", {})
+        return cls(jsonl_path=tracing_config.get("jsonl_path"), prometheus_path=tracing_config.get("prometheus_path"),
+                   profile_dir=profile_dir or tracing_config.get("profile_dir"))
+
+    @contextmanager
+    def span(self, name, profile=False, **attributes):
+        """
+        Times the enclosed block as a child of the current span
+
+        :param name: (str) Operation name
+        :param profile: (bool) Also profile the block, if the tracer has a profile_dir. Default: False
+        :param attributes: Initial attributes
+        :return: (Span) The span, current until the block exits
+        """
+        parent = _CURRENT_SPAN.get()
+        span = Span(self, name, parent=parent if parent and parent.tracer is self else None, attributes=attributes)
+        token = _CURRENT_SPAN.set(span)
+        profiler = self._start_profiler(span) if profile and self.profile_dir else None
+        began = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.status = "error"
+            span.error = "{0}: {1}".format(type(e).__name__, e)
+            raise
+        finally:
+            span.duration = time.perf_counter() - began
+            if profiler is not None:
+                self._stop_profiler(span, profiler)
+            _CURRENT_SPAN.reset(token)
+            with self._lock:
+                self.spans.append(span)
+
+    def _start_profiler(self, span):
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Python 3.12 allows one active profiler per interpreter
+            LOGGER.warning("Not profiling %s: %s", span.path, e)
+            return None
+        return profiler
+
+    def _stop_profiler(self, span, profiler):
+        """
+        Writes the profile of a span to <profile_dir>/<labels>.<span path>.pstats
+
+        :param span: (Span) Profiled span
+        :param profiler: (cProfile.Profile) Running profiler
+        :return: None
+        """
+        profiler.disable()
+        os.makedirs(self.profile_dir, exist_ok=True)
+        prefix = "_".join(value for key, value in sorted(span.labels().items()) if key in ("app", "sha"))
+        filename = "{0}.{1}.pstats".format(prefix, span.path) if prefix else "{0}.pstats".format(span.path)
+        path = os.path.join(self.profile_dir, re.sub(r"[^\w.-]", "_", filename))
+        profiler.dump_stats(path)
+        LOGGER.info("Wrote profile of %s to: %s", span.path, path)
+
+    def summary(self):
+        """
+        :return: (list) (path, total seconds) tuples of the top-level spans, in the order they finished
+        """
+        totals = {}
+        with self._lock:
+            for span in self.spans:
+                if span.parent is None:
+                    totals[span.path] = totals.get(span.path, 0) + span.duration
+        return list(totals.items())
+
+    def write_jsonl(self, path):
+        """
+        Appends the finished spans to a JSON lines file, one span per line
+
+        :param path: (str) File path
+        :return: None
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._lock:
+            records = [span.to_dict() for span in self.spans]
+        with open(path, "a") as f:
+            for record in records:
+                f.write(json.dumps(record, default=str) + "\n")
+
+    def prometheus_metrics(self):
+        """
+        Formats the spans as Prometheus metrics. Durations are summed over spans with the same
+        path and labels, numeric attributes become a metric each.
+
+        :return: (str) Metrics in the Prometheus text exposition format
+        """
+        values = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            labels = dict(span.labels(), span=span.path, status=span.status)
+            key = tuple(sorted(labels.items()))
+            metrics = [("duration_seconds", span.duration)]
+            metrics.extend((_metric_name(name), value) for name, value in sorted(span.attributes.items())
+                           if isinstance(value, (int, float)) and not isinstance(value, bool))
+            for metric, value in metrics:
+                values[(metric, key)] = values.get((metric, key), 0) + value
+
+        lines = []
+        for metric in sorted({metric for metric, _ in values}):
+            name = "{0}_{1}".format(METRIC_PREFIX, metric)
+            lines.append("# TYPE {0} gauge".format(name))
+            for (other, key), value in sorted(values.items()):
+                if other == metric:
+                    lines.append("{0}{{{1}}} {2}".format(name, _format_labels(key), _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """
+        Replaces a Prometheus textfile, e.g. for the node exporter's textfile collector
+
+        :param path: (str) File path, conventionally ending in .prom
+        :return: None
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = "{0}.tmp".format(path)
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus_metrics())
+        os.replace(tmp_path, path)
+
+    def export(self):
+        """
+        Writes the spans to the configured JSON lines file and Prometheus textfile
+
+        :return: None
+        """
+        for path, write in ((self.jsonl_path, self.write_jsonl), (self.prometheus_path, self.write_prometheus)):
+            if not path:
+                continue
+            try:
+                write(path)
+            except OSError as e:
+                LOGGER.warning("Could not write spans to %s: %s", path, e)
+
+
+def _metric_name(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _format_labels(labels):
+    return ",".join('{0}="{1}"'.format(_metric_name(key), value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+                    for key, value in labels)
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def current_span():
+    """
+    :return: (Span) Innermost span of the current context, None outside any span
+    """
+    return _CURRENT_SPAN.get()
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Times the enclosed block as a child of the current span, if there is one
+
+    :param name: (str) Operation name
+    :param attributes: Initial attributes
+    :return: (Span) The span, None outside any span
+    """
+    parent = _CURRENT_SPAN.get()
+    if parent is None:
+        yield None
+        return
+    with parent.tracer.span(name, **attributes) as child:
+        yield child
+
+
+def count(**amounts):
+    """
+    Adds to numeric attributes of the current span, if there is one
+
+    :return: None
+    """
+    current = _CURRENT_SPAN.get()
+    if current is not None:
+        current.count(**amounts)
+
+
+def annotate(**attributes):
+    """
+    Sets attributes of the current span, if there is one
+
+    :return: None
+    """
+    current = _CURRENT_SPAN.get()
+    if current is not None:
+        current.annotate(**attributes)
@@ -23,9 +23,9 @@ import os
 import shutil
 import errno
 import logging
-import asyncio
-from jinja2 import Environment, FileSystemLoader, TemplateNotFound
-from subprocess import CalledProcessError, check_call
+from functools import lru_cache
+from tarfile import TarError
+from shippy.extractor import ArchiveExtractor, UnsafeArchiveError
 
 LOGGER = logging.getLogger(__name__)
 
@@ -48,6 +48,21 @@ def get_template_filepath(filename, basepath="templates"):
         raise SystemExit(f"Could not find template files in: {path}, bailing...")
 
 
+@lru_cache(maxsize=None)
+def _get_template_environment(template_path):
+    """
+    Returns the jinja environment for a template directory, created once per process so
+    compiled templates are reused
+
+    :param template_path: (str) Directory holding templates
+    :return: (jinja2.Environment)
+    """
+    from jinja2 import Environment, FileSystemLoader
+
+    template_loader = FileSystemLoader(template_path)
+    return Environment(loader=template_loader, autoescape=False)
+
+
 def load_template(name):
     """
     Loads the given jinja template file
@@ -55,9 +70,10 @@ def load_template(name):
     :param name: (str) Name of the template file
     :return: (object) Instance of jinja2 template
     """
+    from jinja2 import TemplateNotFound
+
     template_path = get_template_filepath(name)
-    template_loader = FileSystemLoader(template_path)
-    template_env = Environment(loader=template_loader, autoescape=False, extensions=["jinja2.ext.autoescape"])
+    template_env = _get_template_environment(template_path)
 
     try:
         template = template_env.get_template(name)
@@ -107,50 +123,30 @@ def get_repository_appname(repo_url):
     return repo_path[1]
 
 
-def execute_command(cmd, working_dir=None):
-    """
-    Executes command in the working directory if specified
-    :param cmd:
-    :param working_dir:
-    :return:
-    """
-    if working_dir:
-        command = "cd {dir} && {cmd}".format(dir=working_dir, cmd=cmd)
-    else:
-        command = cmd
-
-    LOGGER.info("Executing command: %s", command)
-    try:
-        check_call(command, shell=True)
-    except CalledProcessError as e:
-        LOGGER.error(e)
-        raise SystemExit(1)
-
-
-def unpack_archive(archive_path, app_name, working_dir=None):
+def unpack_archive(archive_path, app_name, working_dir=None, workers=None):
     """
     Unpacks the github tarball at the specified path.
 
     The tarball has a top-level directory named after the project and hash, so when unpacking this
     gets removed
 
-    :param archive_path:
-    :param app_name:
-    :param working_dir:
-    :return:
+    :param archive_path: (str) Path to the downloaded tarball
+    :param app_name: (str) Name of the directory to unpack into
+    :param working_dir: (str) Directory to create the app_name directory in
+    :param workers: (int) Number of file writer threads. Default: None, use the extractor default
+    :return: (str) Path to the unpacked sourcecode
+    :raises: (SystemExit) If the archive can't be unpacked
     """
-    # /tmp/ghost-sha
+    output_dir = "{working_dir}/{app_name}".format(working_dir=working_dir, app_name=app_name)
     LOGGER.info("About to unpack archive: %s", archive_path)
-    cmd = "mkdir -p {working_dir}/{app_name} && tar xvfz {archive_path} -C {working_dir}/{app_name} --strip-components 1".format(app_name=app_name, archive_path=archive_path, working_dir=working_dir)
 
-    LOGGER.info("Running command: %s", cmd)
+    extractor_args = {} if workers is None else {"workers": workers}
     try:
-        check_call(cmd, shell=True)
-    except CalledProcessError as e:
-        LOGGER.error(e)
+        ArchiveExtractor(output_dir, strip_components=1, **extractor_args).extract_file(archive_path)
+    except (TarError, OSError, UnsafeArchiveError) as e:
+        LOGGER.error("Could not unpack archive %s: %s", archive_path, e)
         raise SystemExit(1)
 
-    output_dir = "{working_dir}/{app_name}".format(working_dir=working_dir, app_name=app_name)
     return output_dir
 
 
@@ -181,77 +177,3 @@ def copy_file(source_file, dest_dir):
     """
     LOGGER.info("Copying file: %s to destination: %s", source_file, dest_dir)
     shutil.copy2(source_file, dest_dir)
-
-
-def run_command(cmd, dir=None):
-    """
-    Runs the given command inside the specified directory, async streams stdout
-
-    :param cmd: (str) Command to execute
-    :param dir: (str) path to run the command inside
-    :return:
-    """
-    if dir:
-        command = "cd {dir} && {cmd}".format(dir=dir, cmd=cmd)
-    else:
-        command = cmd
-
-    print(execute(
-        [command],
-        lambda x: LOGGER.info("STDOUT: %s" % x),
-        lambda x: LOGGER.error("STDERR: %s" % x),
-    ))
-
-
-async def _read_stream(stream, cb):
-    """
-    Stream/pipe to process, executing the given callback function on each line
-
-    :param stream:
-    :param cb:
-    :return:
-    """
-    while True:
-        line = await stream.readline()
-        if line:
-            cb(line)
-        else:
-            break
-
-
-async def _stream_subprocess(cmd, stdout_cb, stderr_cb):
-    """
-
-    :param cmd:
-    :param stdout_cb:
-    :param stderr_cb:
-    :return:
-    """
-    process = await asyncio.create_subprocess_exec(*cmd,
-                                                   stdout=asyncio.subprocess.PIPE,
-                                                   stderr=asyncio.subprocess.PIPE)
-
-    await asyncio.wait([
-        _read_stream(process.stdout, stdout_cb),
-        _read_stream(process.stderr, stderr_cb)
-    ])
-    return await process.wait()
-
-
-def execute(cmd, stdout_cb, stderr_cb):
-    """
-
-    :param cmd:
-    :param stdout_cb:
-    :param stderr_cb:
-    :return:
-    """
-    loop = asyncio.get_event_loop()
-    rc = loop.run_until_complete(
-        _stream_subprocess(
-            cmd,
-            stdout_cb,
-            stderr_cb,
-        ))
-    loop.close()
-    return rc
@@ -0,0 +1,86 @@
+import unittest
+import io
+import os
+import tarfile
+import tempfile
+import shutil
+from shippy.build_context import BuildContext
+from shippy.context_filter import PathMatcher
+from extractor_tests import make_tarball
+
+
+class TestBuildContext(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sourcecode_path = os.path.join(self.tmpdir, "shippy")
+        os.makedirs(os.path.join(self.sourcecode_path, "node_modules", "left-pad"))
+        with open(os.path.join(self.sourcecode_path, "node_modules", "left-pad", "index.js"), "w") as f:
+            f.write("module.exports = 1")
+        with open(os.path.join(self.sourcecode_path, "config.js"), "w") as f:
+            f.write("config")
+        with open(os.path.join(self.sourcecode_path, "index.js"), "w") as f:
+            f.write("index")
+
+        self.archive_path = os.path.join(self.tmpdir, "shippy.tar.gz")
+        with open(self.archive_path, "wb") as f:
+            f.write(make_tarball([
+                ("codesplicer-shippy-1234abcd/", "dir", None, 0o755),
+                ("codesplicer-shippy-1234abcd/index.js", "file", b"index", 0o644),
+                ("codesplicer-shippy-1234abcd/Dockerfile", "file", b"FROM repo", 0o644),
+                ("codesplicer-shippy-1234abcd/node_modules/stale.js", "file", b"stale", 0o644),
+            ]).getvalue())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _read_context(self, context):
+        data = b"".join(context)
+        archive = tarfile.open(fileobj=io.BytesIO(data))
+        return {member.name: archive.extractfile(member).read() if member.isfile() else None for member in archive}
+
+    def test_rewraps_archive_with_overlays(self):
+        context = BuildContext(self.sourcecode_path, "FROM busybox", archive_path=self.archive_path,
+                               overlay_paths=["node_modules", "config.js"])
+        members = self._read_context(context)
+
+        assert members["Dockerfile"] == b"FROM busybox"
+        assert members["index.js"] == b"index"
+        assert members["config.js"] == b"config"
+        assert members["node_modules/left-pad/index.js"] == b"module.exports = 1"
+        assert "node_modules/stale.js" not in members
+        assert context.bytes_sent > 0
+
+    def test_walks_sourcecode_without_archive(self):
+        members = self._read_context(BuildContext(self.sourcecode_path, "FROM busybox"))
+
+        assert members["Dockerfile"] == b"FROM busybox"
+        assert members["index.js"] == b"index"
+        assert members["node_modules/left-pad/index.js"] == b"module.exports = 1"
+
+    def test_consumer_can_stop_early(self):
+        iterator = iter(BuildContext(self.sourcecode_path, "FROM busybox", archive_path=self.archive_path))
+        next(iterator)
+        iterator.close()
+
+    def test_prunes_archive_and_overlays(self):
+        matcher = PathMatcher(exclude=["index.js", "**/left-pad"])
+        context = BuildContext(self.sourcecode_path, "FROM busybox", archive_path=self.archive_path,
+                               overlay_paths=["node_modules", "config.js"], matcher=matcher)
+        members = self._read_context(context)
+
+        assert "index.js" not in members
+        assert "node_modules/left-pad/index.js" not in members
+        assert members["config.js"] == b"config"
+        assert b"!config.js" in members[".dockerignore"]
+
+    def test_layered_layout(self):
+        context = BuildContext(self.sourcecode_path, "FROM busybox", archive_path=self.archive_path,
+                               overlay_paths=["node_modules", "config.js"], vendor_paths=["node_modules", "vendor"])
+        members = self._read_context(context)
+
+        assert BuildContext.layer_names(["node_modules", "vendor"]) == ["layers/0", "layers/1", "layers/app"]
+        assert "layers/1" in members
+        assert members["layers/app/index.js"] == b"index"
+        assert members["layers/app/config.js"] == b"config"
+        assert members["layers/0/node_modules/left-pad/index.js"] == b"module.exports = 1"
@@ -0,0 +1,129 @@
+import unittest
+import os
+import gzip
+import time
+import tempfile
+import shutil
+from unittest import mock
+from shippy.build_runner import BuildRunner, BuildCommand
+from shippy.cache import BuildCache
+
+
+class TestBuildRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sourcecode_path = os.path.join(self.tmpdir, "src")
+        os.makedirs(self.sourcecode_path)
+        with open(os.path.join(self.sourcecode_path, "package.json"), "w") as f:
+            f.write('{"dependencies": {}}')
+        self.cache = BuildCache(os.path.join(self.tmpdir, "cache"), max_size=10 * 1024 * 1024)
+        self.config = {
+            "application_build_cmds": [
+                "echo plain",
+                {
+                    "cmd": "mkdir -p node_modules/dep && echo built > node_modules/dep/index.js",
+                    "inputs": ["package.json", "*.lock"],
+                    "outputs": ["node_modules"]
+                }
+            ]
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parses_commands(self):
+        commands = BuildRunner(self.config, self.sourcecode_path).commands
+        assert not commands[0].cacheable
+        assert commands[1].cacheable
+        assert commands[1].outputs == ["node_modules"]
+
+    def test_runs_without_cache(self):
+        BuildRunner(self.config, self.sourcecode_path).run()
+        assert os.path.exists(os.path.join(self.sourcecode_path, "node_modules/dep/index.js"))
+
+    def test_restores_cached_outputs(self):
+        BuildRunner(self.config, self.sourcecode_path, cache=self.cache).run()
+        shutil.rmtree(os.path.join(self.sourcecode_path, "node_modules"))
+
+        runner = BuildRunner(self.config, self.sourcecode_path, cache=self.cache)
+        with mock.patch.object(runner, "_execute") as execute:
+            runner.run()
+
+        execute.assert_called_once_with(runner.commands[0])
+        with open(os.path.join(self.sourcecode_path, "node_modules/dep/index.js")) as f:
+            assert f.read() == "built\n"
+
+    def test_cache_failures_do_not_fail_the_build(self):
+        runner = BuildRunner(self.config, self.sourcecode_path, cache=self.cache)
+        with mock.patch.object(self.cache, "save", side_effect=shutil.Error("disk full")):
+            runner.run()
+        with mock.patch.object(self.cache, "restore", side_effect=OSError("evicted")):
+            runner.run()
+        assert os.path.exists(os.path.join(self.sourcecode_path, "node_modules/dep/index.js"))
+
+    def test_changed_inputs_miss(self):
+        command = BuildCommand.from_config(self.config["application_build_cmds"][1])
+        key = BuildCache.make_key(command.cmd, command.inputs, self.sourcecode_path)
+        with open(os.path.join(self.sourcecode_path, "yarn.lock"), "w") as f:
+            f.write("lock")
+        assert BuildCache.make_key(command.cmd, command.inputs, self.sourcecode_path) != key
+
+    def test_failing_command_exits(self):
+        config = {"application_build_cmds": ["exit 3"]}
+        with self.assertRaises(SystemExit):
+            BuildRunner(config, self.sourcecode_path, cache=self.cache).run()
+
+    def test_graph_runs_independent_commands_concurrently(self):
+        config = {
+            "application_build_workers": 2,
+            "application_build_cmds": [
+                {"name": "assets", "cmd": "sleep 0.5 && echo assets > assets.txt"},
+                {"name": "deps", "cmd": "sleep 0.5 && echo $DEPS_ENV | tee deps.txt", "env": {"DEPS_ENV": "deps"}},
+                {"name": "bundle", "cmd": "cat ../assets.txt ../deps.txt > bundle.txt", "cwd": "out", "depends_on": ["assets", "deps"]},
+            ]
+        }
+        os.makedirs(os.path.join(self.sourcecode_path, "out"))
+        log_dir = os.path.join(self.tmpdir, "logs")
+        started = time.time()
+        BuildRunner(config, self.sourcecode_path, log_dir=log_dir).run()
+
+        assert time.time() - started < 1.0
+        with open(os.path.join(self.sourcecode_path, "out", "bundle.txt")) as f:
+            assert f.read() == "assets\ndeps\n"
+        with gzip.open(os.path.join(log_dir, "build.log.gz"), "rt") as f:
+            log = f.read()
+        assert "==> deps (stdout) <==\ndeps\n" in log
+
+    def test_failure_cancels_siblings(self):
+        config = {
+            "application_build_cmds": [
+                {"name": "slow", "cmd": "sleep 5 && touch slow.txt", "depends_on": []},
+                {"name": "broken", "cmd": "sleep 0.2 && exit 1", "depends_on": []},
+                {"name": "after", "cmd": "touch after.txt", "depends_on": ["slow"]},
+            ]
+        }
+        started = time.time()
+        with self.assertRaises(SystemExit):
+            BuildRunner(config, self.sourcecode_path, log_dir=os.path.join(self.tmpdir, "logs")).run()
+
+        assert time.time() - started < 3
+        assert not os.path.exists(os.path.join(self.sourcecode_path, "slow.txt"))
+        assert not os.path.exists(os.path.join(self.sourcecode_path, "after.txt"))
+
+    def test_failure_logs_the_output_tail(self):
+        config = {"application_build_cmds": [{"name": "noisy", "cmd": "seq 1 5000; echo broken >&2; exit 2"}]}
+        runner = BuildRunner(config, self.sourcecode_path, log_dir=os.path.join(self.tmpdir, "logs"))
+        with self.assertLogs("shippy.build_runner", level="ERROR") as logs, self.assertRaises(SystemExit):
+            runner.run()
+
+        assert "broken" in logs.output[0]
+        assert runner.log_sink.tail("noisy (stdout)").endswith("4999\n5000\n")
+        assert len(runner.log_sink.tail("noisy (stdout)")) <= 4096
+        with gzip.open(runner.log_sink.path, "rt") as f:
+            assert f.read().count("\n") == 5000 + 1 + 2
+
+    def test_invalid_graph_exits(self):
+        config = {"application_build_cmds": [{"name": "a", "cmd": "true", "depends_on": ["missing"]}]}
+        with self.assertRaises(SystemExit):
+            BuildRunner(config, self.sourcecode_path).run()
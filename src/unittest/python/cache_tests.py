@@ -0,0 +1,132 @@
+import unittest
+import os
+import tempfile
+import shutil
+import errno
+import threading
+from unittest import mock
+from shippy.cache import ArchiveCache, BuildCache, FICLONE, file_digest, reflink_or_copy
+
+
+class TestArchiveCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = ArchiveCache(os.path.join(self.tmpdir, "cache"), max_size=100)
+        self.repo_url = "https://github.com/codesplicer/shippy"
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _make_archive(self, name, size):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        return path
+
+    def test_miss(self):
+        destination = os.path.join(self.tmpdir, "out.tar.gz")
+        assert not self.cache.get(self.repo_url, "1234abcd", "tarball", destination)
+        assert not os.path.exists(destination)
+
+    def test_hit(self):
+        archive = self._make_archive("a.tar.gz", 40)
+        self.cache.put(self.repo_url, "1234abcd", "tarball", archive, file_digest(archive))
+        destination = os.path.join(self.tmpdir, "out.tar.gz")
+        assert self.cache.get(self.repo_url, "1234abcd", "tarball", destination)
+        assert file_digest(destination) == file_digest(archive)
+
+    def test_corrupt_entry_is_discarded(self):
+        archive = self._make_archive("a.tar.gz", 40)
+        cached = self.cache.put(self.repo_url, "1234abcd", "tarball", archive, "0" * 64)
+        destination = os.path.join(self.tmpdir, "out.tar.gz")
+        assert not self.cache.get(self.repo_url, "1234abcd", "tarball", destination)
+        assert not os.path.exists(cached)
+
+    def test_evicts_least_recently_used(self):
+        first = self._make_archive("first.tar.gz", 40)
+        second = self._make_archive("second.tar.gz", 40)
+        third = self._make_archive("third.tar.gz", 40)
+        self.cache.put(self.repo_url, "first", "tarball", first, file_digest(first))
+        self.cache.put(self.repo_url, "second", "tarball", second, file_digest(second))
+
+        # Touch the first entry so the second becomes the eviction candidate
+        self.cache.get(self.repo_url, "first", "tarball", os.path.join(self.tmpdir, "out.tar.gz"))
+        self.cache.put(self.repo_url, "third", "tarball", third, file_digest(third))
+
+        assert self.cache.lookup(ArchiveCache.make_key(self.repo_url, "first", "tarball"))
+        assert self.cache.lookup(ArchiveCache.make_key(self.repo_url, "second", "tarball")) is None
+        assert self.cache.lookup(ArchiveCache.make_key(self.repo_url, "third", "tarball"))
+
+    def test_from_config_disabled(self):
+        assert ArchiveCache.from_config({"archive_cache": {"enabled": False}}) is None
+
+
+class TestBuildCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = BuildCache(os.path.join(self.tmpdir, "cache"), max_size=100 * 1024 * 1024)
+        self.sourcecode_path = os.path.join(self.tmpdir, "src")
+        for index in range(300):
+            path = os.path.join(self.sourcecode_path, "node_modules", "dep{0}".format(index % 30), "{0}.js".format(index))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write("module {0}".format(index))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_concurrent_saves_of_one_key(self):
+        errors = []
+
+        def save():
+            try:
+                self.cache.save("samekey", ["node_modules"], self.sourcecode_path)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=save) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        cached = os.path.join(self.cache.entry_path("samekey"), "node_modules")
+        assert sum(len(files) for _, _, files in os.walk(cached)) == 300
+        assert [name for name in os.listdir(self.cache.root) if name.startswith(".staging-")] == []
+
+    def test_cache_shares_no_inodes_with_the_tree(self):
+        self.cache.save("key", ["node_modules"], self.sourcecode_path)
+        source = os.path.join(self.sourcecode_path, "node_modules", "dep0", "0.js")
+        with open(source, "w") as f:
+            f.write("modified after saving")
+
+        restore_path = os.path.join(self.tmpdir, "restored")
+        assert self.cache.restore("key", ["node_modules"], restore_path)
+        restored = os.path.join(restore_path, "node_modules", "dep0", "0.js")
+        with open(restored) as f:
+            assert f.read() == "module 0"
+        with open(restored, "w") as f:
+            f.write("modified after restoring")
+        with open(os.path.join(self.cache.entry_path("key"), "node_modules", "dep0", "0.js")) as f:
+            assert f.read() == "module 0"
+
+    def test_reflink_falls_back_to_copy(self):
+        source = os.path.join(self.sourcecode_path, "node_modules", "dep0", "0.js")
+        destination = os.path.join(self.tmpdir, "0.js")
+        with mock.patch("shippy.cache.fcntl.ioctl", side_effect=OSError(errno.EOPNOTSUPP, "not supported")) as ioctl:
+            reflink_or_copy(source, destination)
+
+        assert ioctl.call_args[0][1] == FICLONE
+        with open(destination) as f:
+            assert f.read() == "module 0"
+        assert os.stat(destination).st_ino != os.stat(source).st_ino
+
+    def test_reflink_skips_the_copy(self):
+        source = os.path.join(self.sourcecode_path, "node_modules", "dep0", "0.js")
+        with mock.patch("shippy.cache.fcntl.ioctl") as ioctl, mock.patch("shippy.cache.shutil.copy2") as copy2:
+            reflink_or_copy(source, os.path.join(self.tmpdir, "0.js"))
+        assert ioctl.called
+        assert not copy2.called
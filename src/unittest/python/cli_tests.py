@@ -0,0 +1,133 @@
+import io
+import os
+import sys
+import json
+import tempfile
+import threading
+import unittest
+import subprocess
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from shippy import cli
+from shippy.daemon import UnixHTTPServer
+from shippy.engine_api import EngineAPI, EngineAPIError
+
+HEAVY_MODULES = ("docker", "requests", "jinja2", "tqdm", "validictory")
+
+CONTAINERS = [
+    {"Id": "c1", "Names": ["/ghost_abc_app_1"], "Image": "ghost", "State": "running", "Status": "Up 2 minutes",
+     "Created": 0, "Labels": {"io.shippy.stack": "ghost_abc", "io.shippy.app": "ghost", "io.shippy.sha": "abc"}},
+    {"Id": "c2", "Names": ["/ghost_def_app_1"], "Image": "ghost", "State": "exited", "Status": "Exited (0)",
+     "Created": 0, "Labels": {"io.shippy.stack": "ghost_def", "io.shippy.app": "ghost", "io.shippy.sha": "def"}}
+]
+
+IMAGES = [
+    {"Id": "i1", "RepoTags": ["shippy_ghost_data_def:latest"], "Size": 3 * 1024 * 1024,
+     "Labels": {"io.shippy.stack": "ghost_def", "io.shippy.app": "ghost", "io.shippy.sha": "def"}}
+]
+
+
+def loaded_modules(statement):
+    source_path = os.path.dirname(os.path.dirname(os.path.abspath(cli.__file__)))
+    code = "import sys; {0}; print(','.join(sorted(sys.modules)))".format(statement)
+    output = subprocess.check_output([sys.executable, "-c", code], env=dict(os.environ, PYTHONPATH=source_path))
+    return {name.split(".")[0] for name in output.decode().strip().split(",")}
+
+
+class FakeEngine:
+
+    def __init__(self, socket_path):
+        self.requests = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                fake.requests.append(("GET", url.path, parse_qs(url.query)))
+                # Serves every item whatever the filters, which are checked from the recorded requests
+                status, body = {"/containers/json": (200, CONTAINERS), "/images/json": (200, IMAGES),
+                                "/networks": (200, [])}.get(url.path, (404, {"message": "not found"}))
+                self._send(status, body)
+
+            def do_DELETE(self):
+                url = urlsplit(self.path)
+                fake.requests.append(("DELETE", url.path, parse_qs(url.query)))
+                self._send(204, None)
+
+            def _send(self, status, body):
+                data = json.dumps(body).encode() if body is not None else b""
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = UnixHTTPServer(socket_path, Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestCli(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.tmpdir.name, "docker.sock")
+        self.engine = FakeEngine(self.socket_path)
+
+    def tearDown(self):
+        self.engine.stop()
+        self.tmpdir.cleanup()
+
+    def test_quick_commands_skip_heavy_imports(self):
+        for statement in ("import shippy.cli", "import shippy.engine_api, shippy.container_stack"):
+            assert not loaded_modules(statement) & set(HEAVY_MODULES), statement
+
+    def test_importing_package_installs_no_console_handler(self):
+        code = "import logging, shippy; print(any(not isinstance(h, logging.NullHandler) for h in logging.getLogger('shippy').handlers))"
+        source_path = os.path.dirname(os.path.dirname(os.path.abspath(cli.__file__)))
+        output = subprocess.check_output([sys.executable, "-c", code], env=dict(os.environ, PYTHONPATH=source_path))
+        assert output.decode().strip() == "False"
+
+    def test_engine_api_containers(self):
+        api = EngineAPI(self.socket_path)
+        assert api.containers(filters={"label": "io.shippy.stack"}) == CONTAINERS
+        method, path, query = self.engine.requests[0]
+        assert json.loads(query["filters"][0]) == {"label": ["io.shippy.stack"]}
+        with self.assertRaises(EngineAPIError) as context:
+            api.get("/missing")
+        assert context.exception.status_code == 404
+
+    def test_list_stacks(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            cli.list_stacks(sha="def", app_name=None, size=False, docker_socket=self.socket_path)
+
+        lines = output.getvalue().splitlines()
+        assert lines[0].split()[:5] == ["STACK", "APP", "SHA", "STATE", "CONTAINERS"]
+        assert lines[2].split()[:5] == ["ghost_def", "ghost", "def", "stopped", "0/1"]
+        assert lines[2].split()[-2:] == ["3.0MB", "-"]
+        # One label-filtered query per resource type
+        queries = [(path, json.loads(query["filters"][0])) for method, path, query in self.engine.requests]
+        assert queries == [("/containers/json", {"label": ["io.shippy.stack", "io.shippy.sha=def"]}),
+                           ("/images/json", {"label": ["io.shippy.stack", "io.shippy.sha=def"]})]
+
+    def test_terminate_stack(self):
+        cli.terminate_stack(sha="abc", app_name="ghost", docker_socket=self.socket_path)
+        deletes = [(path, query) for method, path, query in self.engine.requests if method == "DELETE"]
+        assert deletes[0] == ("/containers/c1", {"v": ["1"], "force": ["1"]})
+        assert [path for path, query in deletes] == ["/containers/c1", "/containers/c2", "/images/i1"]
+
+        with self.assertRaises(SystemExit):
+            cli.terminate_stack(sha=None, app_name=None, docker_socket=self.socket_path)
+
+    def test_formatting(self):
+        assert cli.format_age(5) == "5 seconds"
+        assert cli.format_age(3 * 3600 + 5) == "3 hours"
+        assert cli.format_size(512) == "512B"
+        assert cli.format_size(1536) == "1.5kB"
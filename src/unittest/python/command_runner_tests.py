@@ -0,0 +1,96 @@
+import os
+import time
+import asyncio
+import tempfile
+import unittest
+import subprocess
+from concurrent.futures import CancelledError
+from shippy import command_runner
+from shippy.command_runner import CommandRunner, OutputBatcher
+
+
+class TestOutputBatcher(unittest.TestCase):
+
+    def test_batches_are_bounded(self):
+        batches = []
+        batcher = OutputBatcher("stdout", lambda stream, lines: batches.append(lines), max_lines=3, max_bytes=10,
+                                interval=60)
+        batcher.feed(b"a\nb\nc\nd")
+        assert batches == [["a", "b", "c"]]
+        batcher.feed(b"e\n" + b"x" * 25)
+        # An over-long line is split at max_bytes
+        assert batches[1:] == [["de", "x" * 10], ["x" * 10]]
+        batcher.close()
+        assert batches[3] == ["x" * 5]
+
+
+class TestCommandRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = CommandRunner(max_concurrent=2)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def test_streams_output_in_batches(self):
+        batches = []
+        result = self.runner.run("seq 1 500; echo oops >&2", on_output=lambda stream, lines: batches.append((stream, lines)))
+
+        assert result.returncode == 0
+        stdout = [line for stream, lines in batches if stream == "stdout" for line in lines]
+        assert stdout == [str(i) for i in range(1, 501)]
+        assert len(batches) < 10
+        assert ("stderr", ["oops"]) in batches
+
+    def test_repeated_runs_share_the_loop(self):
+        for _ in range(3):
+            assert self.runner.run("true").returncode == 0
+        assert command_runner.run("pwd", cwd=self.tmpdir.name, check=False).returncode == 0
+
+    def test_failure(self):
+        with self.assertRaises(subprocess.CalledProcessError) as e:
+            self.runner.run("exit 3")
+        assert e.exception.returncode == 3
+        assert self.runner.run("exit 3", check=False).returncode == 3
+
+    def test_output_files_and_environment(self):
+        path = os.path.join(self.tmpdir.name, "out.log")
+        with open(path, "wb") as f:
+            self.runner.run("echo $GREETING", env=dict(os.environ, GREETING="hello"), stdout=f)
+        with open(path) as f:
+            assert f.read() == "hello\n"
+
+    def test_timeout_kills_the_process_group(self):
+        marker = os.path.join(self.tmpdir.name, "marker")
+        started = time.monotonic()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            self.runner.run("(sleep 1 && touch {0}) & wait".format(marker), timeout=0.2)
+        assert time.monotonic() - started < 1
+        time.sleep(1.2)
+        assert not os.path.exists(marker)
+
+    def test_cancel(self):
+        future = self.runner.submit("sleep 5")
+        time.sleep(0.2)
+        future.cancel()
+        with self.assertRaises(CancelledError):
+            future.result()
+        # The slot is given back once the process is gone
+        deadline = time.monotonic() + 2
+        while self.runner.running and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert self.runner.running == 0
+
+    def test_concurrency_limit(self):
+        started = time.monotonic()
+        futures = [self.runner.submit("sleep 0.3") for _ in range(4)]
+        for future in futures:
+            future.result()
+        elapsed = time.monotonic() - started
+        assert 0.6 <= elapsed < 1.2
+
+    def test_run_async(self):
+        async def both():
+            return await asyncio.gather(self.runner.run_async("true"), self.runner.run_async("exit 1", check=False))
+
+        results = asyncio.run_coroutine_threadsafe(both(), self.runner.loop).result()
+        assert [result.returncode for result in results] == [0, 1]
@@ -1,9 +1,16 @@
+import os
+import json
+import tempfile
 import unittest
-from shippy.config_loader import ConfigLoader
+from unittest import mock
+from shippy.config_loader import ConfigLoader, ConfigStore
 
 class TestConfig(unittest.TestCase):
 
     def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.store = ConfigStore()
         self.mock_config = {
             "application_image": "tryghost/ghost",
             "application_repository": "https://github.com/tryghost/ghost",
@@ -35,4 +42,74 @@ class TestConfig(unittest.TestCase):
     #         "app_image": "tryghost/ghost"
     #     }
     #     with self.assertRaises(ValueError):
-    #         config.validate_config(invalid_config)
\ No newline at end of file
+    #         config.validate_config(invalid_config)
+
+    def _write(self, name, data):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, "w") as f:
+            json.dump(data, f)
+        return path
+
+    def test_single_app_file(self):
+        path = self._write("single.json", self.mock_config)
+        config = ConfigLoader(path, sha="abc", store=self.store).get()
+
+        assert config["app_name"] == "ghost"
+        assert config["app_sha"] == "abc"
+        assert config["application_image"] == "tryghost/ghost"
+
+    def test_validate_config(self):
+        assert ConfigLoader.validate(self.mock_config) == self.mock_config
+
+    def test_invalid_config(self):
+        with self.assertRaises(ValueError):
+            ConfigLoader.validate({"app_image": "tryghost/ghost"})
+
+    def test_multi_app_inheritance(self):
+        defaults = dict(self.mock_config)
+        del defaults["application_repository"]
+        path = self._write("env.json", {
+            "defaults": defaults,
+            "apps": {
+                "ghost": {"application_repository": "https://github.com/tryghost/ghost"},
+                "canary": {"extends": "ghost", "application_image": "tryghost/ghost:canary",
+                           "application_config": {"NODE_ENV": "staging"}}
+            }
+        })
+
+        assert self.store.apps(path) == ["canary", "ghost"]
+        canary = self.store.get(path, app="canary", sha="abc")
+        assert canary["application_image"] == "tryghost/ghost:canary"
+        assert canary["application_config"]["NODE_ENV"] == "staging"
+        assert canary["application_config"]["DB_HOST"] == "db"
+        assert "extends" not in canary
+        assert self.store.get(path, app="ghost")["application_image"] == "tryghost/ghost"
+
+        with self.assertRaises(ValueError):
+            self.store.get(path)
+        with self.assertRaises(ValueError):
+            self.store.get(path, app="missing")
+
+    def test_inheritance_cycle(self):
+        path = self._write("cycle.json", {"apps": {"a": {"extends": "b"}, "b": {"extends": "a"}}})
+        with self.assertRaises(ValueError):
+            self.store.get(path, app="a")
+
+    def test_cache_keyed_by_mtime_and_content(self):
+        path = self._write("single.json", self.mock_config)
+        with mock.patch("shippy.config_loader.json.loads", side_effect=json.loads) as loads, \
+                mock.patch.object(ConfigLoader, "validate", side_effect=ConfigLoader.validate) as validate:
+            first = self.store.get(path)
+            first["application_image"] = "mutated"
+            assert self.store.get(path)["application_image"] == "tryghost/ghost"
+
+            # Touched without changes, re-hashed but not re-parsed
+            os.utime(path, ns=(0, 0))
+            self.store.get(path)
+            assert loads.call_count == 1
+            assert validate.call_count == 1
+
+            self._write("single.json", dict(self.mock_config, application_image="tryghost/ghost:2"))
+            os.utime(path, ns=(10 ** 9, 10 ** 9))
+            assert self.store.get(path)["application_image"] == "tryghost/ghost:2"
+            assert loads.call_count == 2
@@ -0,0 +1,39 @@
+import unittest
+from shippy.context_filter import PathMatcher
+
+
+class TestPathMatcher(unittest.TestCase):
+
+    def test_no_rules_keeps_everything(self):
+        matcher = PathMatcher()
+        assert not matcher
+        assert matcher.matches("test/unit/foo.js")
+
+    def test_exclude(self):
+        matcher = PathMatcher(exclude=[".github", "test/**", "**/*.md", "docs/"])
+        assert not matcher.matches(".github/workflows/ci.yml")
+        assert not matcher.matches("test/unit/foo.js")
+        assert not matcher.matches("README.md")
+        assert not matcher.matches("core/server/README.md")
+        assert not matcher.matches("docs", is_dir=True)
+        assert matcher.matches("core/server/index.js")
+        assert matcher.matches("testing.js")
+
+    def test_include_with_exclude(self):
+        matcher = PathMatcher(include=["core", "package.json"], exclude=["core/test"])
+        assert matcher.matches("core/server/index.js")
+        assert matcher.matches("package.json")
+        assert not matcher.matches("Gruntfile.js")
+        assert not matcher.matches("core/test/foo.js")
+        assert matcher.matches("content", is_dir=True)
+
+    def test_character_classes(self):
+        matcher = PathMatcher(exclude=["*.[ch]", "file[!0-9]"])
+        assert not matcher.matches("main.c")
+        assert matcher.matches("main.py")
+        assert not matcher.matches("filex")
+        assert matcher.matches("file1")
+
+    def test_to_dockerignore(self):
+        matcher = PathMatcher(include=["core"], exclude=["core/test"])
+        assert matcher.to_dockerignore(["config.js"]) == "# Generated by shippy\n*\n!core\ncore/test\n!config.js\n"
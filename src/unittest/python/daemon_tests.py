@@ -0,0 +1,183 @@
+import os
+import logging
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from shippy.daemon import ShippyDaemon, DaemonClient, DaemonError, Job
+from shippy.engine_api import UnixHTTPConnection
+from shippy.pipeline import Pipeline
+
+LOGGER = logging.getLogger("shippy.tests")
+
+
+class FakeDeployStage:
+
+    def fetch(self):
+        LOGGER.info("fetching in pipeline thread")
+
+
+def fake_deploy_shas(config, shas, appconfig, parent_sha=None, docker_client=None, resume=False, force=False):
+    LOGGER.info("deploying %s", ",".join(shas))
+    if "bad" in shas:
+        raise SystemExit(1)
+    Pipeline(["fetch"]).run({sha: FakeDeployStage() for sha in shas})
+    return {}
+
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.tmpdir.name, "shippy.sock")
+        self.docker_client = mock.Mock()
+        self.daemon = ShippyDaemon(workers=2, docker_client=self.docker_client)
+        self.server = self.daemon.make_server(socket_path=self.socket_path)
+        self.daemon.start()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.client = DaemonClient(socket_path=self.socket_path, timeout=10)
+        patchers = [
+            mock.patch("shippy.daemon.deploy_shas", side_effect=fake_deploy_shas),
+            mock.patch("shippy.daemon.ConfigLoader")
+        ]
+        self.mocks = [patcher.start() for patcher in patchers]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.daemon.stop()
+        self.tmpdir.cleanup()
+
+    def test_deploy_job_logs(self):
+        job = self.client.deploy("config.json", "app.js", ["abc", "def"])
+        assert job["status"] in (Job.QUEUED, Job.RUNNING, Job.SUCCEEDED)
+
+        lines = list(self.client.logs(job["id"]))
+        final = self.client.job(job["id"])
+
+        assert final["status"] == Job.SUCCEEDED
+        assert final["result"] == {"deployed": ["abc", "def"]}
+        assert any("deploying abc,def" in line for line in lines)
+        # Records logged on pipeline threads are attributed to the job
+        assert sum("fetching in pipeline thread" in line for line in lines) == 2
+        deploy_shas = self.mocks[0]
+        assert deploy_shas.call_args[1]["docker_client"] is self.docker_client
+
+    def test_failed_job(self):
+        job = self.client.deploy("config.json", "app.js", ["bad"])
+        final = self.client.wait(job["id"])
+
+        assert final["status"] == Job.FAILED
+        assert final["error"] == "SystemExit: 1"
+
+    def test_jobs_do_not_share_logs(self):
+        first = self.client.deploy("config.json", "app.js", ["aaa"])
+        second = self.client.deploy("config.json", "app.js", ["bbb"])
+
+        first_lines = list(self.client.logs(first["id"]))
+        second_lines = list(self.client.logs(second["id"]))
+
+        assert not any("bbb" in line for line in first_lines)
+        assert not any("aaa" in line for line in second_lines)
+        assert [job["id"] for job in self.client.jobs()] == [first["id"], second["id"]]
+
+    def test_invalid_requests(self):
+        with self.assertRaises(DaemonError):
+            self.client.deploy("config.json", "app.js", [])
+        with self.assertRaises(DaemonError):
+            self.client.job("missing")
+
+    def test_malformed_parameters(self):
+        for shas in ("abc123", ["abc", 1], ["abc", ""]):
+            with self.assertRaises(DaemonError) as context:
+                self.client._request("POST", "/deploy", {"configpath": "config.json", "appconfig": "app.js", "shas": shas})
+            assert "shas must be a list" in str(context.exception)
+        assert self.daemon.list_jobs() == []
+
+    def test_body_must_be_an_object(self):
+        for body in ([], "x", 1):
+            with self.assertRaises(DaemonError) as context:
+                self.client._request("POST", "/terminate", body)
+            assert "JSON object" in str(context.exception)
+        assert self.daemon.list_jobs() == []
+
+    def test_requests_must_be_json(self):
+        connection = UnixHTTPConnection(self.socket_path, timeout=10)
+        self.addCleanup(connection.close)
+        connection.request("POST", "/deploy", body="configpath=config.json",
+                           headers={"Content-Type": "application/x-www-form-urlencoded"})
+        response = connection.getresponse()
+        response.read()
+
+        assert response.status == 415
+        assert self.daemon.list_jobs() == []
+
+    def test_list_stacks(self):
+        labels = {"com.docker.compose.service": "db", "io.shippy.stack": "ghost_abc", "io.shippy.app": "ghost",
+                  "io.shippy.sha": "abc"}
+        self.docker_client.containers.return_value = [
+            {"Names": ["/ghost_abc_db_1"], "Image": "mysql", "State": "running", "Status": "Up", "Created": 100,
+             "Labels": labels}
+        ]
+        self.docker_client.images.return_value = []
+
+        stacks = self.client.stacks(app_name="ghost", sha="abc")
+
+        assert [(stack["stack"], stack["state"], stack["created"]) for stack in stacks] == [("ghost_abc", "running", 100)]
+        filters = self.docker_client.containers.call_args[1]["filters"]
+        assert filters == {"label": ["io.shippy.stack", "io.shippy.app=ghost", "io.shippy.sha=abc"]}
+
+    def test_terminate(self):
+        self.docker_client.containers.return_value = [
+            {"Id": "c1", "Names": ["/ghost_abc_db_1"], "Labels": {}}
+        ]
+        self.docker_client.networks.return_value = []
+        self.docker_client.images.return_value = []
+
+        final = self.client.wait(self.client.terminate("abc")["id"])
+
+        assert final["status"] == Job.SUCCEEDED
+        assert final["result"] == {"terminated": "abc", "containers": 1, "networks": 0, "images": 0}
+        self.docker_client.remove_container.assert_called_once_with("c1", v=True, force=True)
+
+        # An orphaned data image left by an earlier, partial terminate
+        self.docker_client.containers.return_value = []
+        self.docker_client.images.return_value = [{"Id": "i1", "Labels": {}}]
+        final = self.client.wait(self.client.terminate("abc")["id"])
+        assert final["result"] == {"terminated": "abc", "containers": 0, "networks": 0, "images": 1}
+
+        self.docker_client.images.return_value = []
+        final = self.client.wait(self.client.terminate("abc")["id"])
+        assert final["status"] == Job.FAILED
+
+
+class TestDaemonTCP(unittest.TestCase):
+
+    def setUp(self):
+        self.daemon = ShippyDaemon(workers=1, docker_client=mock.Mock())
+
+    def serve(self, host, token=None):
+        server = self.daemon.make_server(address=(host, 0), token=token)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server.server_address
+
+    def test_refuses_public_address_without_token(self):
+        with self.assertRaises(ValueError):
+            self.daemon.make_server(address=("0.0.0.0", 0))
+        with self.assertRaises(ValueError):
+            self.daemon.make_server(address=("", 0))
+        assert DaemonClient(address=self.serve("127.0.0.1"), timeout=10).jobs() == []
+
+    def test_token_is_required(self):
+        address = self.serve("0.0.0.0", token="s3cret")
+        address = ("127.0.0.1", address[1])
+
+        assert DaemonClient(address=address, timeout=10, token="s3cret").jobs() == []
+        for token in (None, "wrong"):
+            with self.assertRaises(DaemonError):
+                DaemonClient(address=address, timeout=10, token=token).jobs()
@@ -0,0 +1,46 @@
+import unittest
+import threading
+from shippy.dag import Task, run_graph, validate_graph
+
+
+class TestDag(unittest.TestCase):
+
+    def test_validate_order(self):
+        tasks = [Task("c", None, ["a", "b"]), Task("b", None, ["a"]), Task("a", None)]
+        assert validate_graph(tasks) == ["a", "b", "c"]
+
+    def test_validate_cycle(self):
+        with self.assertRaises(ValueError):
+            validate_graph([Task("a", None, ["b"]), Task("b", None, ["a"])])
+
+    def test_validate_duplicate(self):
+        with self.assertRaises(ValueError):
+            validate_graph([Task("a", None), Task("a", None)])
+
+    def test_run_respects_dependencies(self):
+        finished = []
+        lock = threading.Lock()
+
+        def make(name):
+            def run():
+                with lock:
+                    finished.append(name)
+                return name.upper()
+            return run
+
+        tasks = [Task("a", make("a")), Task("b", make("b"), ["a"]), Task("c", make("c"), ["a"]), Task("d", make("d"), ["b", "c"])]
+        results = run_graph(tasks, max_workers=2)
+
+        assert results == {"a": "A", "b": "B", "c": "C", "d": "D"}
+        assert finished[0] == "a" and finished[-1] == "d"
+
+    def test_failure_stops_new_tasks(self):
+        failures = []
+
+        def fail():
+            raise RuntimeError("boom")
+
+        tasks = [Task("a", fail), Task("b", lambda: None, ["a"])]
+        with self.assertRaises(RuntimeError):
+            run_graph(tasks, on_failure=failures.append)
+        assert len(failures) == 1
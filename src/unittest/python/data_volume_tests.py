@@ -1,7 +1,113 @@
 import unittest
+import io
+import os
+import tarfile
+import gzip
+import tempfile
+import shutil
+from unittest import mock
+import docker
 from shippy.data_volume import DataVolume
+from extractor_tests import make_tarball
 
 class TestDataVolume(unittest.TestCase):
 
     def setUp(self):
-        pass
\ No newline at end of file
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = {
+            "app_name": "ghost",
+            "application_source_mountpoint": "/usr/src/ghost",
+        }
+        self.patcher = mock.patch("shippy.data_volume.APIClient")
+        self.client = self.patcher.start().return_value
+        self.client.build.return_value = [b'{"stream": "Successfully built"}']
+
+    def tearDown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_build_from_directory(self):
+        DataVolume(self.tmpdir, "1234abcd", self.config).build()
+
+        assert os.path.exists(os.path.join(self.tmpdir, "Dockerfile"))
+        self.client.build.assert_called_once_with(path=self.tmpdir, rm=True, tag="shippy_ghost_data_1234abcd",
+                                                  labels={"io.shippy.app": "ghost", "io.shippy.sha": "1234abcd",
+                                                          "io.shippy.stack": "ghost_1234abcd"})
+
+    def test_build_labels_inputs_digest(self):
+        DataVolume(self.tmpdir, "1234abcd", self.config, inputs_digest="f00d").build()
+        assert self.client.build.call_args[1]["labels"]["io.shippy.inputs"] == "f00d"
+
+    def test_build_from_streamed_context(self):
+        self.config["data_volume"] = {"context": "stream", "overlay_paths": ["node_modules"]}
+        with mock.patch("shippy.data_volume.BuildContext") as context:
+            DataVolume(self.tmpdir, "1234abcd", self.config).build(archive_path="/tmp/ghost.tar.gz", overlay_paths=["config.js"])
+
+        assert not os.path.exists(os.path.join(self.tmpdir, "Dockerfile"))
+        assert context.call_args[1]["archive_path"] == "/tmp/ghost.tar.gz"
+        assert context.call_args[1]["overlay_paths"] == ["node_modules", "config.js"]
+        assert self.client.build.call_args[1]["custom_context"]
+
+    def test_build_writes_dockerignore(self):
+        self.config["data_volume"] = {"exclude": ["test/**"]}
+        DataVolume(self.tmpdir, "1234abcd", self.config).build(overlay_paths=["config.js"])
+
+        with open(os.path.join(self.tmpdir, ".dockerignore")) as f:
+            assert f.read() == "# Generated by shippy\ntest/**\n!config.js\n"
+
+    def test_layered_build_reuses_parent_image(self):
+        self.config["data_volume"] = {"layered": True, "vendor_paths": ["node_modules"]}
+        volume = DataVolume(self.tmpdir, "1234abcd", self.config)
+        with mock.patch("shippy.data_volume.BuildContext") as context:
+            context.layer_names.return_value = ["layers/0", "layers/app"]
+            volume.build(parent_sha="0000aaaa")
+
+        dockerfile = context.call_args[0][1]
+        assert "COPY --chown=user:user layers/0/ /usr/src/ghost/\nCOPY --chown=user:user layers/app/ /usr/src/ghost/" in dockerfile
+        assert "chmod -R" not in dockerfile
+        assert context.call_args[1]["vendor_paths"] == ["node_modules"]
+        self.client.inspect_image.assert_called_once_with("shippy_ghost_data_0000aaaa")
+        assert self.client.build.call_args[1]["cache_from"] == ["shippy_ghost_data_0000aaaa"]
+
+    def test_layered_build_without_parent_image(self):
+        self.config["data_volume"] = {"layered": True}
+        self.client.inspect_image.side_effect = docker.errors.NotFound("missing")
+        with mock.patch("shippy.data_volume.BuildContext"):
+            DataVolume(self.tmpdir, "1234abcd", self.config).build(parent_sha="0000aaaa")
+
+        assert "cache_from" not in self.client.build.call_args[1]
+
+    def test_layered_build_adds_generated_vendor_paths(self):
+        self.config["data_volume"] = {"layered": True, "vendor_paths": ["node_modules", "vendor"]}
+        archive_path = os.path.join(self.tmpdir, "ghost.tar.gz")
+        with open(archive_path, "wb") as f:
+            f.write(make_tarball([
+                ("ghost-1234abcd/", "dir", None, 0o755),
+                ("ghost-1234abcd/index.js", "file", b"app", 0o644),
+            ]).getvalue())
+        sourcecode_path = os.path.join(self.tmpdir, "ghost")
+        os.makedirs(os.path.join(sourcecode_path, "node_modules", "express"))
+        with open(os.path.join(sourcecode_path, "node_modules", "express", "index.js"), "w") as f:
+            f.write("express")
+        contexts = []
+        self.client.build.side_effect = lambda fileobj, **kwargs: contexts.append(b"".join(fileobj)) or [b'{"stream": "ok"}']
+
+        DataVolume(sourcecode_path, "1234abcd", self.config).build(archive_path=archive_path)
+
+        with tarfile.open(fileobj=io.BytesIO(contexts[0])) as context:
+            names = context.getnames()
+        assert "layers/0/node_modules/express/index.js" in names
+        assert "layers/app/index.js" in names
+
+    def test_build_error(self):
+        self.client.build.return_value = [
+            b'{"stream": "Step 1/2 : FROM busybox\\n"}\r\n{"stream": "npm WARN 0 errors\\n"}\r\n{"err',
+            b'orDetail": {"message": "COPY failed"}, "error": "COPY failed"}\r\n',
+        ]
+        log_dir = os.path.join(self.tmpdir, "logs")
+        with self.assertLogs("shippy.data_volume", level="ERROR") as logs, self.assertRaises(SystemExit):
+            DataVolume(self.tmpdir, "1234abcd", self.config, log_dir=log_dir).build()
+
+        assert "COPY failed" in logs.output[0] and "0 errors" in logs.output[0]
+        with gzip.open(os.path.join(log_dir, "volume.log.gz"), "rt") as f:
+            assert f.read() == "==> docker build <==\nStep 1/2 : FROM busybox\nnpm WARN 0 errors\n"
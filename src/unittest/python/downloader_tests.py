@@ -0,0 +1,110 @@
+import unittest
+import os
+import time
+import hashlib
+import tempfile
+import shutil
+import requests
+from shippy.downloader import Downloader, DownloadError, parse_retry_after
+from fake_github import FakeGithubServer
+
+
+class TestDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.data = os.urandom(200 * 1024)
+        self.server = FakeGithubServer({"/archive.tar.gz": self.data}).start()
+        self.url = self.server.url("/archive.tar.gz")
+        self.destination = os.path.join(self.tmpdir, "archive.tar.gz")
+        self.downloader = Downloader(backoff=0, buffer_size=8192, progress=False)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def _read_destination(self):
+        with open(self.destination, "rb") as f:
+            return f.read()
+
+    def test_download(self):
+        digest = self.downloader.download(self.url, self.destination)
+        assert digest == hashlib.sha256(self.data).hexdigest()
+        assert self._read_destination() == self.data
+        assert not os.path.exists(self.destination + ".part")
+
+    def test_resumes_after_disconnect(self):
+        self.server.disconnects = [64 * 1024, 150 * 1024]
+        digest = self.downloader.download(self.url, self.destination)
+
+        assert digest == hashlib.sha256(self.data).hexdigest()
+        assert self._read_destination() == self.data
+        assert len(self.server.requests) == 3
+        assert self.server.requests[1]["headers"]["Range"] == "bytes=65536-"
+        assert self.server.requests[2]["headers"]["Range"] == "bytes=153600-"
+
+    def test_revalidates_with_etag(self):
+        self.downloader.download(self.url, self.destination)
+        digest = self.downloader.download(self.url, self.destination)
+
+        assert digest == hashlib.sha256(self.data).hexdigest()
+        assert self.server.requests[1]["headers"]["If-None-Match"] == FakeGithubServer.etag(self.data)
+
+    def test_rejected_revalidation_restarts(self):
+        self.downloader.download(self.url, self.destination)
+        self.server.errors = [(416, None)]
+        digest = self.downloader.download(self.url, self.destination)
+
+        assert digest == hashlib.sha256(self.data).hexdigest()
+        assert "If-None-Match" not in self.server.requests[2]["headers"]
+
+    def test_persistent_range_errors_restart_once(self):
+        self.server.errors = [(416, None)] * 10
+        with self.assertRaises(requests.exceptions.HTTPError) as context:
+            self.downloader.download(self.url, self.destination)
+        assert context.exception.response.status_code == 416
+        assert len(self.server.requests) == 2
+
+    def test_restarts_when_resource_changed(self):
+        self.server.disconnects = [64 * 1024]
+        with self.assertRaises(DownloadError):
+            Downloader(retries=0, progress=False).download(self.url, self.destination)
+
+        new_data = os.urandom(100 * 1024)
+        self.server.add_archive("/archive.tar.gz", new_data)
+        digest = self.downloader.download(self.url, self.destination)
+
+        assert digest == hashlib.sha256(new_data).hexdigest()
+        assert self._read_destination() == new_data
+
+    def test_gives_up_after_retries(self):
+        self.server.disconnects = [1024] * 3
+        with self.assertRaises(DownloadError):
+            Downloader(retries=2, backoff=0, progress=False).download(self.url, self.destination)
+
+    def test_retries_server_errors(self):
+        self.server.errors = [(503, None), (429, 0.3)]
+        started = time.monotonic()
+        digest = self.downloader.download(self.url, self.destination)
+
+        assert digest == hashlib.sha256(self.data).hexdigest()
+        assert len(self.server.requests) == 3
+        # The backoff is 0, so only Retry-After delayed the third request
+        assert time.monotonic() - started >= 0.3
+
+    def test_client_errors_are_not_retried(self):
+        self.server.errors = [(403, None)]
+        with self.assertRaises(Exception):
+            self.downloader.download(self.url, self.destination)
+        assert len(self.server.requests) == 1
+
+    def test_gives_up_on_persistent_server_errors(self):
+        self.server.errors = [(500, None)] * 3
+        with self.assertRaises(DownloadError):
+            Downloader(retries=2, backoff=0, progress=False).download(self.url, self.destination)
+
+    def test_parse_retry_after(self):
+        assert parse_retry_after("5") == 5.0
+        assert parse_retry_after(None) is None
+        assert parse_retry_after("soon") is None
+        assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
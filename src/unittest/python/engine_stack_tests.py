@@ -0,0 +1,134 @@
+import os
+import tempfile
+import unittest
+from docker import APIClient
+from fake_docker import FakeDockerServer, API_VERSION
+from shippy.container_stack import list_stacks, terminate_stacks, shippy_labels
+from shippy.engine_stack import EngineStack
+from shippy.deployment import Deployment
+
+
+class TestEngineStack(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.config = {
+            "app_name": "ghost",
+            "application_repository": "https://github.com/tryghost/ghost",
+            "application_image": "tryghost/ghost",
+            "application_config": {"NODE_ENV": "production", "DB_HOST": "db"},
+            "database_image": "mysql/mysql-server",
+            "database_config": {"MYSQL_DATABASE": "ghost"}
+        }
+        self.fake = FakeDockerServer(os.path.join(self.tmpdir.name, "docker.sock"),
+                                     images=["tryghost/ghost", "shippy_ghost_data_abc"], create_delay=0.2).start()
+        self.addCleanup(self.fake.stop)
+        self.client = APIClient(base_url=self.fake.base_url, version=API_VERSION)
+        self.addCleanup(self.client.close)
+        self.stack = EngineStack(self.config, "abc", self.tmpdir.name, "shippy_ghost_data_abc", client=self.client)
+
+    def test_start_creates_stack(self):
+        ids = self.stack.start()
+
+        assert set(ids) == {"ghost_source_data", "db", "ghost_app"}
+        assert [n["Name"] for n in self.fake.networks.values()] == ["ghost_abc_default"]
+        # The missing database image was pulled
+        assert "mysql/mysql-server:latest" in self.fake.images
+
+        app = self.fake.container_by_name("ghost_abc_ghost_app_1")
+        assert app["State"] == "running"
+        assert app["HostConfig"]["VolumesFrom"] == ["ghost_abc_ghost_source_data_1"]
+        assert app["HostConfig"]["NetworkMode"] == "bridge"
+        assert app["HostConfig"]["RestartPolicy"]["Name"] == "always"
+        assert app["Config"]["Hostname"] == "ghost_abc.dev.internal"
+        assert "NODE_ENV=production" in app["Config"]["Env"]
+
+        db = self.fake.container_by_name("ghost_abc_db_1")
+        assert db["HostConfig"]["NetworkMode"] == "ghost_abc_default"
+        assert db["Config"]["NetworkingConfig"]["EndpointsConfig"]["ghost_abc_default"]["Aliases"] == ["db"]
+        assert db["Labels"]["com.docker.compose.service"] == "db"
+
+    def test_independent_services_created_concurrently(self):
+        self.stack.start()
+        # Source data and db run together, the app waits for its volumes_from source
+        assert self.fake.peak_creates == 2
+        source = self.fake.container_by_name("ghost_abc_ghost_source_data_1")
+        app = self.fake.container_by_name("ghost_abc_ghost_app_1")
+        assert app["Created"] > source["Created"]
+
+    def test_redeploy_keeps_unchanged_containers(self):
+        self.fake.create_delay = 0
+        first = self.stack.start()
+        self.fake.container_by_name("ghost_abc_db_1")["State"] = "exited"
+        second = EngineStack(self.config, "abc", self.tmpdir.name, "shippy_ghost_data_abc", client=self.client).start()
+
+        assert second == first
+        assert len(self.fake.containers) == 3
+        assert len(self.fake.networks) == 1
+        assert self.fake.container_by_name("ghost_abc_db_1")["State"] == "running"
+
+    def test_redeploy_recreates_changed_containers_keeping_volumes(self):
+        self.fake.create_delay = 0
+        first = self.stack.start()
+        # A rebuilt data image, and a changed database setting
+        self.fake.images["shippy_ghost_data_abc:latest"]["Id"] = "sha256:rebuilt"
+        self.config["database_config"] = {"MYSQL_DATABASE": "blog"}
+        second = EngineStack(self.config, "abc", self.tmpdir.name, "shippy_ghost_data_abc", client=self.client).start()
+
+        # The app takes its volumes from the recreated source data container, so it is recreated too
+        assert all(second[service] != first[service] for service in ("ghost_source_data", "db", "ghost_app"))
+        assert len(self.fake.containers) == 3
+        assert self.fake.removed_volumes == []
+
+        unchanged = EngineStack(self.config, "abc", self.tmpdir.name, "shippy_ghost_data_abc", client=self.client).start()
+        assert unchanged == second
+
+    def test_resources_are_labelled(self):
+        self.stack.start()
+        labels = {"io.shippy.app": "ghost", "io.shippy.sha": "abc", "io.shippy.stack": "ghost_abc"}
+        for container in self.fake.containers.values():
+            assert labels.items() <= container["Labels"].items()
+        for network in self.fake.networks.values():
+            assert labels.items() <= network["Labels"].items()
+
+    def test_list_stop_and_terminate(self):
+        self.fake.create_delay = 0
+        self.fake.add_image("shippy_ghost_data_def", labels=shippy_labels("ghost", "def"), size=2048)
+        self.stack.start()
+        other = EngineStack(self.config, "def", self.tmpdir.name, "shippy_ghost_data_def", client=self.client)
+        other.start()
+
+        stacks = list_stacks(self.client, app_name="ghost")
+        assert [stack["stack"] for stack in stacks] == ["ghost_abc", "ghost_def"]
+        assert stacks[0]["state"] == "running"
+        assert len(stacks[0]["containers"]) == 3
+        assert (stacks[0]["image_size"], stacks[1]["image_size"]) == (0, 2048)
+        assert stacks[0]["disk_size"] is None
+        assert list_stacks(self.client, size=True)[0]["disk_size"] == 3 * 1024
+        assert list_stacks(self.client, app_name="other") == []
+
+        self.stack.stop()
+        assert [stack["state"] for stack in list_stacks(self.client)] == ["stopped", "running"]
+        assert {c["name"] for c in other.list(self.client)} == {
+            "ghost_def_ghost_source_data_1", "ghost_def_db_1", "ghost_def_ghost_app_1"}
+
+        assert terminate_stacks(self.client, sha="def") == {"containers": 3, "networks": 1, "images": 1}
+        assert [stack["sha"] for stack in list_stacks(self.client)] == ["abc"]
+        assert "shippy_ghost_data_def:latest" not in self.fake.images
+        assert "tryghost/ghost:latest" in self.fake.images
+
+        EngineStack(self.config, "abc", self.tmpdir.name, None, client=self.client).terminate()
+        assert self.fake.containers == {}
+        assert self.fake.networks == {}
+        assert "shippy_ghost_data_abc:latest" not in self.fake.images
+
+    def test_deployment_selects_backend(self):
+        deployment = Deployment(dict(self.config, stack_backend="engine"), "abc", "app.js",
+                                workspace=self.tmpdir.name, docker_client=self.client)
+        stack = deployment._make_stack(self.tmpdir.name, "tag")
+        assert isinstance(stack, EngineStack)
+        assert stack.cli is self.client
+
+        deployment = Deployment(self.config, "abc", "app.js", workspace=self.tmpdir.name)
+        assert not isinstance(deployment._make_stack(self.tmpdir.name, "tag"), EngineStack)
@@ -0,0 +1,137 @@
+import unittest
+import io
+import os
+import stat
+import tarfile
+import tempfile
+import shutil
+from shippy.extractor import ArchiveExtractor, UnsafeArchiveError
+
+
+def make_tarball(members):
+    """
+    Builds an in-memory gzipped tarball from (name, type, payload, mode) tuples
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for name, kind, payload, mode in members:
+            info = tarfile.TarInfo(name)
+            info.mode = mode
+            if kind == "dir":
+                info.type = tarfile.DIRTYPE
+                archive.addfile(info)
+            elif kind == "sym":
+                info.type = tarfile.SYMTYPE
+                info.linkname = payload
+                archive.addfile(info)
+            elif kind == "link":
+                info.type = tarfile.LNKTYPE
+                info.linkname = payload
+                archive.addfile(info)
+            else:
+                info.size = len(payload)
+                archive.addfile(info, io.BytesIO(payload))
+    buffer.seek(0)
+    return buffer
+
+
+class TestArchiveExtractor(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.destination = os.path.join(self.tmpdir, "out")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_strips_top_level_directory(self):
+        archive = make_tarball([
+            ("shippy-1234abcd/", "dir", None, 0o755),
+            ("shippy-1234abcd/README.md", "file", b"readme", 0o644),
+            ("shippy-1234abcd/bin/run", "file", b"#!/bin/sh", 0o755),
+            ("shippy-1234abcd/bin/link", "sym", "run", 0o777),
+        ])
+        ArchiveExtractor(self.destination).extract(archive)
+
+        with open(os.path.join(self.destination, "README.md"), "rb") as f:
+            assert f.read() == b"readme"
+        assert stat.S_IMODE(os.stat(os.path.join(self.destination, "bin/run")).st_mode) == 0o755
+        assert os.readlink(os.path.join(self.destination, "bin/link")) == "run"
+
+    def test_rejects_parent_references(self):
+        archive = make_tarball([("shippy-1234abcd/../../evil", "file", b"x", 0o644)])
+        with self.assertRaises(UnsafeArchiveError):
+            ArchiveExtractor(self.destination).extract(archive)
+
+    def test_rejects_symlink_escaping_destination(self):
+        archive = make_tarball([("shippy-1234abcd/escape", "sym", "../../etc", 0o777)])
+        with self.assertRaises(UnsafeArchiveError):
+            ArchiveExtractor(self.destination).extract(archive)
+
+    def test_rejects_writes_through_symlink(self):
+        archive = make_tarball([
+            ("shippy-1234abcd/lib", "sym", ".", 0o777),
+            ("shippy-1234abcd/lib/file", "file", b"x", 0o644),
+        ])
+        with self.assertRaises(UnsafeArchiveError):
+            ArchiveExtractor(self.destination).extract(archive)
+
+    def test_rejects_symlink_resolving_through_another_symlink(self):
+        destination = os.path.join(self.tmpdir, "deep", "out")
+        archive = make_tarball([
+            ("top/s1/s2/b", "sym", "../..", 0o777),
+            ("top/c", "sym", "s1/s2/b/../../escaped.txt", 0o777),
+            ("top/c", "file", b"escaped", 0o644),
+        ])
+        with self.assertRaises(UnsafeArchiveError):
+            ArchiveExtractor(destination).extract(archive)
+        assert not os.path.exists(os.path.join(self.tmpdir, "escaped.txt"))
+
+    def test_member_replaces_symlink_instead_of_writing_through_it(self):
+        archive = make_tarball([
+            ("shippy-1234abcd/target", "file", b"original", 0o644),
+            ("shippy-1234abcd/link", "sym", "target", 0o777),
+            ("shippy-1234abcd/link", "file", b"replaced", 0o644),
+            ("shippy-1234abcd/hard", "sym", "target", 0o777),
+            ("shippy-1234abcd/hard", "link", "shippy-1234abcd/link", 0o644),
+        ])
+        ArchiveExtractor(self.destination, workers=2).extract(archive)
+
+        with open(os.path.join(self.destination, "target"), "rb") as f:
+            assert f.read() == b"original"
+        for name in ("link", "hard"):
+            assert not os.path.islink(os.path.join(self.destination, name))
+            with open(os.path.join(self.destination, name), "rb") as f:
+                assert f.read() == b"replaced"
+
+    def test_parallel_extraction(self):
+        members = [("shippy-1234abcd/src/{0}/file_{1}.py".format(i % 7, i), "file", str(i).encode() * 100, 0o644) for i in range(500)]
+        members.append(("shippy-1234abcd/big.bin", "file", os.urandom(2 * 1024 * 1024), 0o600))
+        extractor = ArchiveExtractor(self.destination, workers=4)
+        extractor.extract(make_tarball(members))
+
+        assert extractor.files_extracted == 501
+        for i in range(500):
+            with open(os.path.join(self.destination, "src/{0}/file_{1}.py".format(i % 7, i)), "rb") as f:
+                assert f.read() == str(i).encode() * 100
+        assert os.path.getsize(os.path.join(self.destination, "big.bin")) == 2 * 1024 * 1024
+
+    def test_hardlink_waits_for_source_write(self):
+        archive = make_tarball([
+            ("shippy-1234abcd/original", "file", b"payload", 0o644),
+            ("shippy-1234abcd/copy", "link", "shippy-1234abcd/original", 0o644),
+        ])
+        ArchiveExtractor(self.destination, workers=2).extract(archive)
+
+        with open(os.path.join(self.destination, "copy"), "rb") as f:
+            assert f.read() == b"payload"
+
+    def test_directory_modes_applied_last(self):
+        archive = make_tarball([
+            ("shippy-1234abcd/readonly/", "dir", None, 0o555),
+            ("shippy-1234abcd/readonly/file", "file", b"x", 0o644),
+        ])
+        ArchiveExtractor(self.destination).extract(archive)
+
+        assert stat.S_IMODE(os.stat(os.path.join(self.destination, "readonly")).st_mode) == 0o755
+        assert os.path.exists(os.path.join(self.destination, "readonly/file"))
@@ -0,0 +1,455 @@
+"""
+Local server imitating the subset of the Docker Engine API used by shippy, listening on a
+UNIX socket so it can be driven by docker.APIClient
+"""
+import json
+import time
+import random
+import struct
+import uuid
+import threading
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+from shippy.daemon import UnixHTTPServer
+
+API_VERSION = "1.41"
+
+
+class _DockerSocketServer(UnixHTTPServer):
+    # dockerd accepts far more pending connections than socketserver's default of 5
+    request_queue_size = 128
+
+
+def normalize_image(name):
+    return name if ":" in name.rsplit("/", 1)[-1] else name + ":latest"
+
+
+class FakeDockerServer:
+
+    def __init__(self, socket_path, images=None, create_delay=0.0, healthchecks=None, container_ip="127.0.0.1",
+                 pull_delay=0.0, failure_rate=0.0, seed=0):
+        """
+        :param socket_path: (str) UNIX socket to listen on
+        :param images: (list) Image names present initially
+        :param create_delay: (float) Seconds each container creation takes
+        :param healthchecks: (dict) Maps image names to the healthcheck test their containers get
+        :param container_ip: (str) Address reported for every container
+        :param pull_delay: (float) Seconds each image pull takes
+        :param failure_rate: (float) Probability of each container creation failing with a server error
+        :param seed: (int) Seed of the injected failures
+        """
+        self.socket_path = socket_path
+        self.images = {}
+        self.create_delay = create_delay
+        self.healthchecks = {normalize_image(image): test for image, test in (healthchecks or {}).items()}
+        self.container_ip = container_ip
+        self.pull_delay = pull_delay
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.pull_errors = {}
+        self.active_pulls = 0
+        self.peak_pulls = 0
+        self.containers = {}
+        self.networks = {}
+        self.requests = []
+        self.events = []
+        self.logs = {}
+        self.memory_usage = {}
+        self.builds = []
+        # Names of containers removed together with their anonymous volumes
+        self.removed_volumes = []
+        self.active_creates = 0
+        self.peak_creates = 0
+        self.closing = False
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        for image in images or []:
+            self.add_image(image)
+        self.server = _DockerSocketServer(socket_path, self._make_handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return "unix://" + self.socket_path
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.changed:
+            self.closing = True
+            self.changed.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def find_container(self, ref):
+        for container in self.containers.values():
+            if container["Id"] == ref or container["Name"] == ref:
+                return container
+        return None
+
+    def container_by_name(self, name):
+        return self.find_container(name)
+
+    def add_image(self, name, labels=None, size=0):
+        name = normalize_image(name)
+        with self.lock:
+            self.images[name] = {"Id": name, "RepoTags": [name], "Labels": labels or {}, "Size": size,
+                                 "Created": time.time(), "Config": {"Labels": labels or {}}}
+
+    def _emit(self, container, action, **attributes):
+        """
+        Records an event, must be called holding the lock
+        """
+        attributes = dict(container["Labels"], name=container["Name"], image=container["Image"], **attributes)
+        self.events.append({"Type": "container", "Action": action, "status": action, "id": container["Id"],
+                            "Actor": {"ID": container["Id"], "Attributes": attributes}, "time": int(time.time()),
+                            "timeNano": time.time_ns()})
+        self.changed.notify_all()
+
+    def set_health(self, name, status):
+        with self.changed:
+            container = self.container_by_name(name)
+            container["Health"] = status
+            self._emit(container, "health_status: {0}".format(status))
+
+    def exit(self, name, code):
+        with self.changed:
+            container = self.container_by_name(name)
+            container["State"] = "exited"
+            container["ExitCode"] = code
+            self._emit(container, "die", exitCode=str(code))
+
+    def add_log(self, name, line):
+        with self.changed:
+            self.logs.setdefault(name, []).append(line)
+            self.changed.notify_all()
+
+    def inspect(self, container):
+        state = {"Status": container["State"], "Running": container["State"] == "running",
+                 "StartedAt": container.get("StartedAt", "0001-01-01T00:00:00Z"), "ExitCode": container.get("ExitCode", 0)}
+        config = dict(container["Config"])
+        if container.get("Health"):
+            state["Health"] = {"Status": container["Health"]}
+            config["Healthcheck"] = {"Test": self.healthchecks[normalize_image(container["Image"])]}
+        return {"Id": container["Id"], "Name": "/" + container["Name"], "Image": container["ImageID"], "State": state,
+                "Config": config, "HostConfig": container["HostConfig"],
+                "NetworkSettings": {"Networks": {"bridge": {"IPAddress": self.container_ip}}}}
+
+    def _matches_labels(self, labels, filters):
+        for label in filters.get("label", []):
+            key, _, value = label.partition("=")
+            if key not in labels or (value and labels[key] != value):
+                return False
+        return True
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body=None):
+                data = json.dumps(body).encode() if body is not None else b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _body(self):
+                if self.headers.get("Transfer-Encoding") == "chunked":
+                    chunks = []
+                    while True:
+                        size = int(self.rfile.readline().split(b";")[0], 16)
+                        chunks.append(self.rfile.read(size))
+                        self.rfile.readline()
+                        if not size:
+                            break
+                    data = b"".join(chunks)
+                else:
+                    length = int(self.headers.get("Content-Length") or 0)
+                    data = self.rfile.read(length) if length else b""
+                if self.headers.get("Content-Type", "").endswith("tar"):
+                    return data
+                return json.loads(data) if data else {}
+
+            def _route(self, method):
+                url = urlsplit(self.path)
+                path = unquote(url.path)
+                if path.startswith("/v"):
+                    path = "/" + path.split("/", 2)[2]
+                query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                body = self._body()
+                with fake.lock:
+                    fake.requests.append((method, path))
+                try:
+                    handler = getattr(self, "_" + method.lower())
+                    handler(path, query, body)
+                except KeyError as e:
+                    self._send(404, {"message": "No such object: {0}".format(e.args[0])})
+
+            def do_GET(self):
+                self._route("GET")
+
+            def do_POST(self):
+                self._route("POST")
+
+            def do_DELETE(self):
+                self._route("DELETE")
+
+            def _get(self, path, query, body):
+                filters = json.loads(query.get("filters", "{}"))
+                if path == "/version":
+                    self._send(200, {"ApiVersion": API_VERSION, "Version": "fake"})
+                elif path == "/containers/json":
+                    show_all = query.get("all") in ("1", "True", "true")
+                    with fake.lock:
+                        containers = [
+                            {"Id": c["Id"], "Names": ["/" + c["Name"]], "Image": c["Image"], "Labels": c["Labels"],
+                             "State": c["State"], "Status": "Up" if c["State"] == "running" else "Exited",
+                             "Created": c["Created"]}
+                            for c in fake.containers.values()
+                            if (show_all or c["State"] == "running") and fake._matches_labels(c["Labels"], filters)
+                        ]
+                    if query.get("size") in ("1", "True", "true"):
+                        for container in containers:
+                            container["SizeRw"] = 1024
+                    self._send(200, containers)
+                elif path.startswith("/containers/") and path.endswith("/json"):
+                    container = fake.find_container(path[len("/containers/"):-len("/json")])
+                    if container is None:
+                        raise KeyError(path)
+                    self._send(200, fake.inspect(container))
+                elif path.startswith("/containers/") and path.endswith("/stats"):
+                    container = fake.find_container(path[len("/containers/"):-len("/stats")])
+                    if container is None:
+                        raise KeyError(path)
+                    usage = fake.memory_usage.get(container["Name"], 0) if container["State"] == "running" else 0
+                    self._send(200, {"memory_stats": {"usage": usage} if usage else {}})
+                elif path.startswith("/containers/") and path.endswith("/logs"):
+                    container = fake.find_container(path[len("/containers/"):-len("/logs")])
+                    if container is None:
+                        raise KeyError(path)
+                    self._stream_logs(container["Name"], follow=query.get("follow") in ("1", "True", "true"))
+                elif path == "/events":
+                    self._stream_events(float(query.get("since") or 0), filters)
+                elif path == "/networks":
+                    names = filters.get("name", [])
+                    with fake.lock:
+                        networks = [n for n in fake.networks.values() if not names or n["Name"] in names]
+                        networks = [n for n in networks if fake._matches_labels(n["Labels"], filters)]
+                    self._send(200, networks)
+                elif path == "/images/json":
+                    with fake.lock:
+                        images = [dict(i) for i in fake.images.values() if fake._matches_labels(i["Labels"], filters)]
+                    self._send(200, images)
+                elif path.startswith("/images/") and path.endswith("/json"):
+                    self._send(200, fake.images[normalize_image(path[len("/images/"):-len("/json")])])
+                else:
+                    raise KeyError(path)
+
+            def _start_stream(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+            def _write_chunk(self, data):
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+
+            def _stream(self, source, follow):
+                """
+                Writes the entries of a growing list as chunks until the server closes, must hold the lock
+
+                :param source: (callable) Returns the chunks written so far and since, None entries are skipped
+                """
+                self._start_stream()
+                offset = 0
+                try:
+                    while not fake.closing:
+                        entries = source()[offset:]
+                        offset += len(entries)
+                        fake.lock.release()
+                        try:
+                            for chunk in entries:
+                                if chunk is not None:
+                                    self._write_chunk(chunk)
+                        finally:
+                            fake.lock.acquire()
+                        if not follow:
+                            break
+                        if not entries:
+                            fake.changed.wait(0.1)
+                    self._write_chunk(b"")
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+
+            def _stream_events(self, since, filters):
+                def encode(event):
+                    if event["time"] >= since and fake._matches_labels(event["Actor"]["Attributes"], filters):
+                        return json.dumps(event).encode() + b"\n"
+                    return None
+                with fake.changed:
+                    self._stream(lambda: [encode(event) for event in fake.events], follow=True)
+
+            def _stream_logs(self, name, follow):
+                def encode(line):
+                    data = line.encode() + b"\n"
+                    return struct.pack(">BxxxL", 1, len(data)) + data
+                with fake.changed:
+                    self._stream(lambda: [encode(line) for line in fake.logs.get(name, [])], follow)
+
+            def _post(self, path, query, body):
+                if path == "/containers/create":
+                    self._create_container(query["name"], body)
+                elif path.startswith("/containers/") and path.endswith(("/start", "/stop")):
+                    ref, _, action = path[len("/containers/"):].rpartition("/")
+                    container = fake.find_container(ref)
+                    if container is None:
+                        raise KeyError(ref)
+                    with fake.changed:
+                        if action == "start":
+                            container["State"] = "running"
+                            container["StartedAt"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+                            if normalize_image(container["Image"]) in fake.healthchecks:
+                                container["Health"] = "starting"
+                            fake._emit(container, "start")
+                        else:
+                            container["State"] = "exited"
+                            fake._emit(container, "die", exitCode="0")
+                            fake._emit(container, "stop")
+                    self._send(204)
+                elif path == "/networks/create":
+                    with fake.lock:
+                        if any(n["Name"] == body["Name"] for n in fake.networks.values()):
+                            self._send(409, {"message": "network exists"})
+                            return
+                        network = {"Id": uuid.uuid4().hex, "Name": body["Name"], "Driver": body.get("Driver"),
+                                   "Labels": body.get("Labels") or {}}
+                        fake.networks[network["Id"]] = network
+                    self._send(201, {"Id": network["Id"]})
+                elif path == "/build":
+                    self._build(query, body)
+                elif path == "/images/create":
+                    name = normalize_image(query["fromImage"] + (":" + query["tag"] if query.get("tag") else ""))
+                    self._pull(name)
+                else:
+                    raise KeyError(path)
+
+            def _build(self, query, context):
+                """
+                Records the size of the build context and tags an image, without running the Dockerfile
+                """
+                name = normalize_image(query["t"])
+                fake.add_image(name, labels=json.loads(query.get("labels") or "{}"), size=len(context))
+                with fake.lock:
+                    fake.builds.append({"tag": name, "context_bytes": len(context)})
+                self._start_stream()
+                for line in ("Step 1/1 : FROM busybox\n", "Successfully built {0}\n".format(name),
+                             "Successfully tagged {0}\n".format(name)):
+                    self._write_chunk(json.dumps({"stream": line}).encode() + b"\r\n")
+                self._write_chunk(b"")
+
+            def _pull(self, name):
+                """
+                Streams the progress of pulling two layers, or an error message
+                """
+                with fake.lock:
+                    fake.active_pulls += 1
+                    fake.peak_pulls = max(fake.peak_pulls, fake.active_pulls)
+                try:
+                    self._start_stream()
+                    tag = name.rsplit(":", 1)[-1]
+                    messages = [{"status": "Pulling from {0}".format(name.rsplit(":", 1)[0]), "id": tag}]
+                    for layer in ("layer1", "layer2"):
+                        messages.append({"status": "Pulling fs layer", "id": layer, "progressDetail": {}})
+                    for layer in ("layer1", "layer2"):
+                        messages.append({"status": "Downloading", "id": layer,
+                                         "progressDetail": {"current": 512, "total": 1024}})
+                    for message in messages:
+                        self._write_chunk(json.dumps(message).encode() + b"\r\n")
+                    time.sleep(fake.pull_delay)
+                    if name in fake.pull_errors:
+                        self._write_chunk(json.dumps({"error": fake.pull_errors[name]}).encode() + b"\r\n")
+                    else:
+                        for layer in ("layer1", "layer2"):
+                            self._write_chunk(json.dumps({"status": "Pull complete", "id": layer,
+                                                          "progressDetail": {}}).encode() + b"\r\n")
+                        fake.add_image(name, size=2048)
+                        self._write_chunk(json.dumps({"status": "Status: Downloaded newer image for " + name})
+                                          .encode() + b"\r\n")
+                    self._write_chunk(b"")
+                finally:
+                    with fake.lock:
+                        fake.active_pulls -= 1
+
+            def _create_container(self, name, body):
+                with fake.lock:
+                    fake.active_creates += 1
+                    fake.peak_creates = max(fake.peak_creates, fake.active_creates)
+                try:
+                    time.sleep(fake.create_delay)
+                    with fake.lock:
+                        if fake.random.random() < fake.failure_rate:
+                            self._send(500, {"message": "Injected failure creating {0}".format(name)})
+                            return
+                        if normalize_image(body["Image"]) not in fake.images:
+                            self._send(404, {"message": "No such image: {0}".format(body["Image"])})
+                            return
+                        if fake.container_by_name(name):
+                            self._send(409, {"message": "Conflict. The container name {0} is already in use".format(name)})
+                            return
+                        host_config = body.get("HostConfig") or {}
+                        for source in host_config.get("VolumesFrom") or []:
+                            if fake.container_by_name(source.split(":")[0]) is None:
+                                self._send(404, {"message": "No such container: {0}".format(source)})
+                                return
+                        container = {"Id": uuid.uuid4().hex, "Name": name, "Image": body["Image"], "State": "created",
+                                     "ImageID": fake.images[normalize_image(body["Image"])]["Id"],
+                                     "Labels": body.get("Labels") or {}, "Config": body, "HostConfig": host_config,
+                                     "Created": time.time()}
+                        fake.containers[container["Id"]] = container
+                    self._send(201, {"Id": container["Id"], "Warnings": []})
+                finally:
+                    with fake.lock:
+                        fake.active_creates -= 1
+
+            def _delete(self, path, query, body):
+                with fake.lock:
+                    if path.startswith("/containers/"):
+                        container = fake.find_container(path[len("/containers/"):])
+                        if container is None:
+                            raise KeyError(path)
+                        if container["State"] == "running" and query.get("force") not in ("1", "True", "true"):
+                            self._send(409, {"message": "container is running"})
+                            return
+                        del fake.containers[container["Id"]]
+                        if query.get("v") in ("1", "True", "true"):
+                            fake.removed_volumes.append(container["Name"])
+                    elif path.startswith("/networks/"):
+                        ref = path[len("/networks/"):]
+                        network = next((n for n in fake.networks.values() if ref in (n["Id"], n["Name"])), None)
+                        if network is None:
+                            raise KeyError(ref)
+                        del fake.networks[network["Id"]]
+                    elif path.startswith("/images/"):
+                        name = normalize_image(path[len("/images/"):])
+                        del fake.images[name]
+                    else:
+                        raise KeyError(path)
+                self._send(204 if not path.startswith("/images/") else 200, None if not path.startswith("/images/") else [{"Untagged": path}])
+
+        return Handler
@@ -0,0 +1,140 @@
+"""
+Local HTTP server imitating the github archive endpoints, with support for Range and
+ETag requests and injectable mid-transfer disconnects
+"""
+import random
+import threading
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeGithubServer:
+
+    def __init__(self, archives=None, chunk_size=4096, latency=0.0, disconnect_rate=0.0, seed=0):
+        """
+        :param archives: (dict) Maps request paths to archive bytes
+        :param chunk_size: (int) Bytes written per socket write
+        :param latency: (float) Seconds to sleep before answering each request
+        :param disconnect_rate: (float) Probability of dropping each response part way through
+        :param seed: (int) Seed of the random disconnects
+        """
+        self.archives = dict(archives or {})
+        self.chunk_size = chunk_size
+        self.latency = latency
+        self.disconnect_rate = disconnect_rate
+        self.random = random.Random(seed)
+        # Byte offsets at which to drop the connection, consumed one per request
+        self.disconnects = []
+        # (status, Retry-After or None) error responses, consumed one per request
+        self.errors = []
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:{0}".format(self.server.server_address[1])
+
+    def url(self, path):
+        return self.base_url + path
+
+    def add_archive(self, path, data):
+        self.archives[path] = data
+
+    @staticmethod
+    def etag(data):
+        return '"{0}"'.format(hashlib.sha1(data).hexdigest())
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if fake.latency:
+                    threading.Event().wait(fake.latency)
+                with fake.lock:
+                    fake.requests.append({"path": self.path, "headers": dict(self.headers)})
+                    disconnect_at = fake.disconnects.pop(0) if fake.disconnects else None
+                    error = fake.errors.pop(0) if fake.errors else None
+                    # Where a random disconnect happens, as a fraction of the remaining bytes
+                    disconnect_fraction = fake.random.random() if fake.random.random() < fake.disconnect_rate else None
+
+                if error is not None:
+                    status, retry_after = error
+                    self.send_response(status)
+                    if retry_after is not None:
+                        self.send_header("Retry-After", str(retry_after))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                data = fake.archives.get(self.path)
+                if data is None:
+                    self.send_error(404)
+                    return
+
+                etag = fake.etag(data)
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                start = 0
+                status = 200
+                range_header = self.headers.get("Range")
+                if_range = self.headers.get("If-Range")
+                if range_header and (if_range is None or if_range == etag):
+                    start = int(range_header.split("=")[1].split("-")[0])
+                    if start >= len(data):
+                        self.send_response(416)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    status = 206
+
+                body = data[start:]
+                if disconnect_at is None and disconnect_fraction is not None:
+                    disconnect_at = start + int(len(body) * disconnect_fraction)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/x-gzip")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                if status == 206:
+                    self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(start, len(data) - 1, len(data)))
+                self.end_headers()
+
+                limit = len(body) if disconnect_at is None else max(disconnect_at - start, 0)
+                sent = 0
+                while sent < limit:
+                    chunk = body[sent:min(sent + fake.chunk_size, limit)]
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+                if disconnect_at is not None:
+                    self.wfile.flush()
+                    self.close_connection = True
+                    self.connection.shutdown(2)
+
+        return Handler
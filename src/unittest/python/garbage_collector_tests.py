@@ -0,0 +1,122 @@
+import os
+import tempfile
+import unittest
+from docker import APIClient
+from fake_docker import FakeDockerServer, API_VERSION
+from shippy.container_stack import list_stacks, shippy_labels
+from shippy.engine_stack import EngineStack
+from shippy.garbage_collector import GarbageCollector, GCPolicy
+from shippy.journal import DeployJournal
+
+MB = 1024 * 1024
+
+
+def make_stack(name, app="ghost", last_used=0, disk=0, memory=0, pinned=False):
+    return {"stack": name, "app": app, "sha": name.rsplit("_", 1)[-1], "last_used": last_used,
+            "disk_usage": disk, "memory_usage": memory, "pinned": pinned}
+
+
+class TestPlan(unittest.TestCase):
+
+    def plan(self, stacks, **policy):
+        evictions = GarbageCollector(None, GCPolicy(**policy)).plan(stacks, now=100 * 3600)
+        return [stack["stack"] for stack, reason in evictions]
+
+    def test_max_age(self):
+        stacks = [make_stack("ghost_a", last_used=10 * 3600), make_stack("ghost_b", last_used=99 * 3600)]
+        assert self.plan(stacks, max_age_hours=24) == ["ghost_a"]
+
+    def test_max_stacks_per_app_evicts_least_recently_used(self):
+        stacks = [make_stack("ghost_c", last_used=3), make_stack("ghost_a", last_used=1),
+                  make_stack("ghost_b", last_used=2), make_stack("blog_a", app="blog", last_used=0)]
+        assert self.plan(stacks, max_stacks_per_app=2) == ["ghost_a"]
+
+    def test_pinned_and_protected_stacks_are_kept(self):
+        stacks = [make_stack("ghost_a", last_used=1, pinned=True), make_stack("ghost_b", last_used=2),
+                  make_stack("ghost_c", last_used=3)]
+        collector = GarbageCollector(None, GCPolicy(max_stacks_per_app=1))
+        evictions = collector.plan(stacks, protect={"ghost_b"})
+        assert [stack["stack"] for stack, reason in evictions] == ["ghost_c"]
+
+    def test_reserve_makes_room_for_new_stacks(self):
+        stacks = [make_stack("ghost_a", last_used=1), make_stack("ghost_b", last_used=2)]
+        collector = GarbageCollector(None, GCPolicy(max_stacks_per_app=2))
+        assert [stack["stack"] for stack, _ in collector.plan(stacks, reserve={"ghost": 1})] == ["ghost_a"]
+
+    def test_budgets(self):
+        stacks = [make_stack("ghost_a", last_used=1, disk=300 * MB, memory=10 * MB),
+                  make_stack("ghost_b", last_used=2, disk=300 * MB, memory=500 * MB),
+                  make_stack("ghost_c", last_used=3, disk=300 * MB, memory=10 * MB)]
+        assert self.plan(stacks, disk_budget_mb=700) == ["ghost_a"]
+        assert self.plan(stacks, memory_budget_mb=100) == ["ghost_a", "ghost_b"]
+
+    def test_policy_from_config(self):
+        policy = GCPolicy.from_config({"gc": {"max_stacks_per_app": 3, "pinned": ["abc"]}}, max_stacks_per_app=5,
+                                      max_age_hours=None)
+        assert policy.max_stacks_per_app == 5
+        assert policy.pinned == {"abc"}
+        assert policy.enabled
+        assert not GCPolicy.from_config({}).enabled
+
+
+class TestGarbageCollector(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.config = {
+            "app_name": "ghost",
+            "application_repository": "https://github.com/tryghost/ghost",
+            "application_image": "tryghost/ghost",
+            "application_config": {},
+            "database_image": "mysql",
+            "database_config": {}
+        }
+        self.fake = FakeDockerServer(os.path.join(self.tmpdir.name, "docker.sock"),
+                                     images=["tryghost/ghost", "mysql"]).start()
+        self.addCleanup(self.fake.stop)
+        self.client = APIClient(base_url=self.fake.base_url, version=API_VERSION)
+        self.addCleanup(self.client.close)
+        self.journal = DeployJournal(os.path.join(self.tmpdir.name, "journal.sqlite"))
+        for sha in ("aaa", "bbb", "ccc"):
+            self.fake.add_image("shippy_ghost_data_" + sha, labels=shippy_labels("ghost", sha), size=100 * MB)
+            EngineStack(self.config, sha, self.tmpdir.name, "shippy_ghost_data_" + sha, client=self.client).start()
+            os.makedirs(os.path.join(self.tmpdir.name, "ghost_" + sha))
+            self.fake.memory_usage["ghost_{0}_ghost_app_1".format(sha)] = 200 * MB
+        # A data image whose stack never started
+        self.fake.add_image("shippy_ghost_data_ddd", labels=shippy_labels("ghost", "ddd"), size=100 * MB)
+
+    def collector(self, **policy):
+        return GarbageCollector(self.client, GCPolicy(**policy), journal=self.journal, workspace=self.tmpdir.name)
+
+    def test_collect(self):
+        self.journal.pin("bbb")
+        stacks = {stack["stack"]: stack for stack in self.collector(disk_budget_mb=1000, memory_budget_mb=1000).collect()}
+
+        assert stacks["ghost_ddd"]["state"] == "orphaned"
+        assert stacks["ghost_aaa"]["disk_usage"] == 100 * MB + 3 * 1024
+        assert stacks["ghost_aaa"]["memory_usage"] == 200 * MB
+        assert stacks["ghost_bbb"]["pinned"] and not stacks["ghost_aaa"]["pinned"]
+
+    def test_run_removes_least_recently_used(self):
+        self.journal.pin("aaa", app_name="ghost")
+        self.journal.begin("ghost_bbb", "digest")
+
+        evicted = self.collector(max_stacks_per_app=2).run()
+
+        # aaa is pinned and bbb was redeployed most recently
+        assert [stack["stack"] for stack, reason in evicted] == ["ghost_ccc", "ghost_ddd"]
+        assert [stack["stack"] for stack in list_stacks(self.client, orphans=True)] == ["ghost_aaa", "ghost_bbb"]
+        assert "shippy_ghost_data_ccc:latest" not in self.fake.images
+        assert not os.path.exists(os.path.join(self.tmpdir.name, "ghost_ccc"))
+        assert os.path.exists(os.path.join(self.tmpdir.name, "ghost_aaa"))
+
+    def test_dry_run(self):
+        evicted = self.collector(max_age_hours=0).run(dry_run=True)
+        assert len(evicted) == 4
+        assert len(list_stacks(self.client, orphans=True)) == 4
+
+    def test_make_room(self):
+        evicted = self.collector(max_stacks_per_app=3).make_room("ghost", ["aaa", "eee"])
+        # Three stacks are kept once eee is deployed, including aaa which is being redeployed
+        assert [stack["stack"] for stack, reason in evicted] == ["ghost_bbb", "ghost_ccc"]
@@ -0,0 +1,88 @@
+import os
+import time
+import tempfile
+import unittest
+from unittest import mock
+from docker import APIClient
+from fake_docker import FakeDockerServer, API_VERSION
+from shippy.deployment import Deployment
+from shippy.image_puller import ImagePuller, ImagePullError, PullProgress, split_image_name
+
+
+class TestPullProgress(unittest.TestCase):
+
+    def test_split_image_name(self):
+        assert split_image_name("mysql") == ("mysql", "latest")
+        assert split_image_name("mysql/mysql-server:8.0") == ("mysql/mysql-server", "8.0")
+        assert split_image_name("localhost:5000/ghost") == ("localhost:5000/ghost", "latest")
+
+    def test_update(self):
+        progress = PullProgress("mysql")
+        progress.update({"status": "Pulling from library/mysql", "id": "latest"})
+        progress.update({"status": "Downloading", "id": "a", "progressDetail": {"current": 10, "total": 40}})
+        progress.update({"status": "Already exists", "id": "b", "progressDetail": {}})
+        progress.update({"status": "Pull complete", "id": "a", "progressDetail": {}})
+
+        summary = progress.summary()
+        assert (summary["layers"], summary["complete"], summary["downloaded"], summary["size"]) == (2, 2, 40, 40)
+
+    def test_error(self):
+        with self.assertRaises(ImagePullError):
+            PullProgress("mysql").update({"error": "manifest unknown"})
+
+
+class TestImagePuller(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.fake = FakeDockerServer(os.path.join(self.tmpdir.name, "docker.sock"), images=["tryghost/ghost"],
+                                     pull_delay=0.3).start()
+        self.addCleanup(self.fake.stop)
+        self.client = APIClient(base_url=self.fake.base_url, version=API_VERSION)
+        self.addCleanup(self.client.close)
+
+    def test_pulls_missing_images(self):
+        summaries = ImagePuller(self.client, ["tryghost/ghost", "mysql", "redis:6", "mysql"]).wait(timeout=10)
+
+        assert summaries["tryghost/ghost"]["status"] == "present"
+        assert summaries["mysql"]["status"] == "pulled"
+        assert summaries["mysql"]["complete"] == 2
+        assert "redis:6" in self.fake.images
+        # Both pulls ran at once
+        assert self.fake.peak_pulls == 2
+
+    def test_pull_error(self):
+        self.fake.pull_errors["mysql:latest"] = "manifest unknown"
+        with self.assertRaisesRegex(ImagePullError, "manifest unknown"):
+            ImagePuller(self.client, ["mysql"]).wait(timeout=10)
+
+    def test_pulls_overlap_with_the_build(self):
+        config = {
+            "app_name": "ghost",
+            "application_repository": "https://github.com/tryghost/ghost",
+            "application_image": "tryghost/ghost",
+            "application_config": {},
+            "database_image": "mysql",
+            "database_config": {}
+        }
+        deployment = Deployment(config, "abc", None, workspace=self.tmpdir.name, docker_client=self.client)
+        started = {}
+
+        def stage(name):
+            def run():
+                if name == "start":
+                    deployment.pull()
+                    started["images"] = set(self.fake.images)
+                else:
+                    time.sleep(0.1)
+            return run
+
+        with mock.patch.object(Deployment, "run_stage", side_effect=lambda name: stage(name)()):
+            began = time.monotonic()
+            deployment.run()
+            elapsed = time.monotonic() - began
+
+        assert "mysql:latest" in started["images"]
+        # The 300ms pull ran alongside the five 100ms stages before start
+        assert elapsed < 0.3 + 5 * 0.1 - 0.1
@@ -0,0 +1,186 @@
+import os
+import tempfile
+import unittest
+import requests
+from unittest import mock
+from docker.errors import NotFound
+from shippy.deployment import Deployment
+from shippy.container_stack import INPUTS_LABEL, SHA_LABEL
+from shippy.journal import DeployJournal, tree_digest, COMPLETED, FAILED
+
+
+class FakeDeployment(Deployment):
+    """
+    Deployment whose stages write small files instead of downloading and building
+    """
+
+    def __init__(self, *args, fail_stage=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fail_stage = fail_stage
+        self.ran = []
+
+    def _track(self, stage):
+        self.ran.append(stage)
+        if stage == self.fail_stage:
+            raise SystemExit(1)
+
+    def fetch(self):
+        self._track("fetch")
+        os.makedirs(self.workdir, exist_ok=True)
+        self.download_path = os.path.join(self.workdir, "ghost.tar.gz")
+        with open(self.download_path, "w") as f:
+            f.write("archive")
+
+    def unpack(self):
+        self._track("unpack")
+        self.output_dir = os.path.join(self.workdir, "ghost")
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(os.path.join(self.output_dir, "index.js"), "w") as f:
+            f.write("source")
+
+    def build(self):
+        self._track("build")
+        with open(os.path.join(self.output_dir, "bundle.js"), "w") as f:
+            f.write("built")
+
+    def volume(self):
+        self._track("volume")
+        self.data_volume = mock.Mock(**{"get_name.return_value": "shippy_ghost_data_abc"})
+
+    def compose(self):
+        self._track("compose")
+        self.container_stack = self._make_stack(self.output_dir, self.data_volume.get_name())
+        self.container_stack.write_compose_file()
+
+    def start(self):
+        self._track("start")
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.journal = DeployJournal(os.path.join(self.tmpdir.name, "journal.sqlite"))
+        self.config = {
+            "app_name": "ghost",
+            "application_repository": "https://github.com/tryghost/ghost",
+            "application_image": "tryghost/ghost",
+            "application_config": {},
+            "database_image": "mysql",
+            "database_config": {}
+        }
+        self.appconfig = os.path.join(self.tmpdir.name, "config.js")
+        with open(self.appconfig, "w") as f:
+            f.write("module.exports = {}")
+        self.docker_client = mock.Mock(**{"inspect_image.return_value": {"Id": "sha256:1"}})
+
+    def deploy(self, resume=True, fail_stage=None, force=False):
+        deployment = FakeDeployment(self.config, "abc", self.appconfig, workspace=self.tmpdir.name,
+                                    docker_client=self.docker_client, resume=resume, journal=self.journal,
+                                    fail_stage=fail_stage, force=force)
+        try:
+            deployment.run()
+        except SystemExit:
+            pass
+        return deployment
+
+    def test_records_stages(self):
+        self.deploy(fail_stage="volume")
+        stages = self.journal.stages("ghost_abc")
+
+        assert [stages[name]["status"] for name in ("fetch", "unpack", "build")] == [COMPLETED] * 3
+        assert stages["volume"]["status"] == FAILED
+        assert stages["volume"]["error"] == "SystemExit: 1"
+        assert "compose" not in stages
+        assert stages["fetch"]["artifacts"][0]["kind"] == "file"
+
+    def test_resume_skips_completed_stages(self):
+        self.deploy(fail_stage="compose")
+        deployment = self.deploy()
+
+        assert deployment.ran == ["compose", "start"]
+        assert deployment.output_dir == os.path.join(self.tmpdir.name, "ghost_abc", "ghost")
+        assert deployment.data_volume.get_name() == "shippy_ghost_data_abc"
+
+        # Starting is always repeated
+        assert self.deploy().ran == ["start"]
+
+    def test_changed_outputs_are_rebuilt(self):
+        self.deploy()
+        with open(os.path.join(self.tmpdir.name, "ghost_abc", "ghost", "bundle.js"), "a") as f:
+            f.write("edited by hand, longer")
+        assert self.deploy().ran == ["unpack", "build", "volume", "compose", "start"]
+
+        # The data image is gone, the service images are still there
+        def inspect_image(image):
+            if image.startswith("shippy_"):
+                raise NotFound("gone")
+            return {"Id": "sha256:1"}
+        self.docker_client.inspect_image.side_effect = inspect_image
+        assert self.deploy().ran == ["volume", "compose", "start"]
+
+    def test_changed_inputs_start_over(self):
+        self.deploy()
+        with open(self.appconfig, "a") as f:
+            f.write("// changed")
+        assert self.deploy().ran == list(Deployment.STAGES)
+
+    def test_without_resume_everything_runs(self):
+        self.deploy()
+        assert self.deploy(resume=False).ran == list(Deployment.STAGES)
+
+    def add_data_image(self):
+        digest = Deployment(self.config, "abc", self.appconfig, workspace=self.tmpdir.name)._inputs_digest()
+        self.docker_client.inspect_image.return_value = {
+            "Id": "sha256:1", "Config": {"Labels": {SHA_LABEL: "abc", INPUTS_LABEL: digest}}
+        }
+
+    def test_prebuilt_image_skips_to_compose(self):
+        self.add_data_image()
+        deployment = self.deploy(resume=False)
+
+        assert deployment.ran == ["compose", "start"]
+        assert deployment.data_volume.get_name() == "shippy_ghost_data_abc"
+        assert os.path.exists(os.path.join(self.tmpdir.name, "ghost_abc", "ghost", "docker-compose.yml"))
+
+    def test_prebuilt_image_with_other_inputs_is_rebuilt(self):
+        self.add_data_image()
+        with open(self.appconfig, "a") as f:
+            f.write("// changed")
+        assert self.deploy(resume=False).ran == list(Deployment.STAGES)
+
+    def test_prebuilt_image_ignores_settings_outside_the_image(self):
+        self.add_data_image()
+        self.config["database_image"] = "mariadb"
+        assert self.deploy(resume=False).ran == ["compose", "start"]
+
+        self.config["application_build_cmds"] = ["npm install"]
+        assert self.deploy(resume=False).ran == list(Deployment.STAGES)
+
+    def test_unreachable_docker_falls_through_to_a_full_deploy(self):
+        errors = [requests.exceptions.ConnectionError("refused")]
+
+        def inspect_image(image):
+            if image.startswith("shippy_") and errors:
+                raise errors.pop()
+            return {"Id": "sha256:1"}
+
+        self.docker_client.inspect_image.side_effect = inspect_image
+        assert self.deploy(resume=False).ran == list(Deployment.STAGES)
+
+    def test_force_rebuilds_prebuilt_image(self):
+        self.add_data_image()
+        assert self.deploy(force=True).ran == list(Deployment.STAGES)
+
+    def test_tree_digest(self):
+        path = os.path.join(self.tmpdir.name, "tree")
+        assert tree_digest(path) is None
+        os.makedirs(os.path.join(path, "lib"))
+        with open(os.path.join(path, "lib", "a.js"), "w") as f:
+            f.write("a")
+        digest = tree_digest(path)
+        assert digest == tree_digest(path)
+        with open(os.path.join(path, "b.js"), "w") as f:
+            f.write("b")
+        assert tree_digest(path) != digest
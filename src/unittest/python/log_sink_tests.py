@@ -0,0 +1,66 @@
+import os
+import gzip
+import tempfile
+import unittest
+from shippy.log_sink import LogTail, LogSink, BuildStreamParser
+
+
+class TestLogTail(unittest.TestCase):
+
+    def test_keeps_the_last_bytes(self):
+        tail = LogTail(max_bytes=10)
+        for chunk in (b"aaaa", b"bbbb", b"cccc", b"dd"):
+            tail.append(chunk)
+        assert tail.text() == "bbbbccccdd"
+        tail.append(b"x" * 25)
+        assert tail.text() == "x" * 10
+
+
+class TestLogSink(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def test_interleaves_sources_at_line_boundaries(self):
+        path = os.path.join(self.tmpdir.name, "logs", "build.log.gz")
+        with LogSink(path) as sink:
+            sink.write("a (stdout)", b"one\ntw")
+            sink.write("b (stderr)", b"oops\n")
+            sink.write("a (stdout)", b"o\n")
+            sink.write("a (stdout)", b"no newline")
+
+        with gzip.open(path, "rt") as f:
+            assert f.read() == "==> a (stdout) <==\none\n==> b (stderr) <==\noops\n==> a (stdout) <==\ntwo\nno newline\n"
+        assert sink.tail("a (stdout)") == "one\ntwo\nno newline"
+        assert sink.tail("missing") == ""
+
+    def test_tail_only(self):
+        with LogSink() as sink:
+            sink.write("docker build", b"Step 1/1\n")
+        assert sink.tail("docker build") == "Step 1/1\n"
+        assert sink.bytes_written == 0
+
+
+class TestBuildStreamParser(unittest.TestCase):
+
+    def test_split_and_combined_messages(self):
+        parser = BuildStreamParser()
+        events = parser.feed(b'{"stream": "Step 2/5 : RUN npm install\\n"}\r\n{"stat')
+        events += parser.feed(b'us": "Downloading", "progressDetail": {"current": 1}}\r\n{"aux": {"ID": "sha256:ab')
+        events += parser.feed(b'c"}}\r\n{"stream": "caf\xc3')
+        events += parser.feed(b'\xa9 error-free\\n"}\r\n')
+
+        assert [event.kind for event in events] == ["step", "progress", "aux", "output"]
+        assert (events[0].step, events[0].total) == (2, 5)
+        assert events[1].message == "Downloading"
+        assert parser.image_id == "sha256:abc"
+        assert events[3].message == "café error-free\n"
+
+    def test_error(self):
+        events = BuildStreamParser().feed(b'{"errorDetail": {"code": 1, "message": "RUN failed"}, "error": "failed"}\n')
+        assert [(event.kind, event.message) for event in events] == [("error", "RUN failed")]
+
+    def test_skips_malformed_lines(self):
+        events = BuildStreamParser().feed(b'not json\n{"stream": "ok\\n"}\n')
+        assert [event.message for event in events] == ["ok\n"]
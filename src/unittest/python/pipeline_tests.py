@@ -0,0 +1,75 @@
+import time
+import tempfile
+import unittest
+import threading
+from shippy.pipeline import Pipeline
+from shippy.cli import read_shas
+
+
+class FakeJob:
+
+    def __init__(self, tracker, fail_stage=None):
+        self.tracker = tracker
+        self.fail_stage = fail_stage
+        self.completed = []
+
+    def _stage(self, name):
+        self.tracker.enter(name)
+        try:
+            time.sleep(0.02)
+            if name == self.fail_stage:
+                raise SystemExit(1)
+            self.completed.append(name)
+        finally:
+            self.tracker.leave(name)
+
+    def fetch(self):
+        self._stage("fetch")
+
+    def build(self):
+        self._stage("build")
+
+
+class StageTracker:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = {}
+        self.peak = {}
+
+    def enter(self, name):
+        with self.lock:
+            self.active[name] = self.active.get(name, 0) + 1
+            self.peak[name] = max(self.peak.get(name, 0), self.active[name])
+
+    def leave(self, name):
+        with self.lock:
+            self.active[name] -= 1
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_stage_concurrency_limits(self):
+        tracker = StageTracker()
+        jobs = {str(i): FakeJob(tracker) for i in range(6)}
+        failures = Pipeline(["fetch", "build"], concurrency={"fetch": 3, "build": 1}).run(jobs)
+
+        assert failures == {}
+        assert tracker.peak["fetch"] == 3
+        assert tracker.peak["build"] == 1
+        assert all(job.completed == ["fetch", "build"] for job in jobs.values())
+
+    def test_failure_is_isolated(self):
+        tracker = StageTracker()
+        jobs = {"good": FakeJob(tracker), "bad": FakeJob(tracker, fail_stage="fetch")}
+        failures = Pipeline(["fetch", "build"]).run(jobs)
+
+        assert list(failures) == ["bad"]
+        assert jobs["bad"].completed == []
+        assert jobs["good"].completed == ["fetch", "build"]
+
+    def test_read_shas(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+            f.write("abc\n# comment\n\ndef  # trailing\nabc\n")
+            f.flush()
+            assert read_shas(["123", "abc"], f.name) == ["123", "abc", "def"]
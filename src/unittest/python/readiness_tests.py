@@ -0,0 +1,133 @@
+import os
+import time
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from docker import APIClient
+from fake_docker import FakeDockerServer, API_VERSION
+from shippy.engine_stack import EngineStack
+from shippy.readiness import ReadinessMonitor, ReadinessError, ServiceCheck, warm_up
+
+
+class FakeApp:
+    """
+    HTTP server standing in for the application, failing until it is marked ready
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.hits = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                fake.hits += 1
+                self.send_response(200 if fake.ready else 503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def later(delay, func, *args):
+    timer = threading.Timer(delay, func, args)
+    timer.start()
+    return timer
+
+
+class TestReadiness(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        config = {
+            "app_name": "ghost",
+            "application_repository": "https://github.com/tryghost/ghost",
+            "application_image": "tryghost/ghost",
+            "application_config": {},
+            "database_image": "mysql",
+            "database_config": {}
+        }
+        self.fake = FakeDockerServer(os.path.join(self.tmpdir.name, "docker.sock"),
+                                     images=["tryghost/ghost", "mysql", "data"],
+                                     healthchecks={"mysql": ["CMD", "mysqladmin", "ping"]}).start()
+        self.addCleanup(self.fake.stop)
+        self.client = APIClient(base_url=self.fake.base_url, version=API_VERSION)
+        self.addCleanup(self.client.close)
+        self.app = FakeApp()
+        self.addCleanup(self.app.stop)
+        self.stack = EngineStack(config, "abc", self.tmpdir.name, "data", client=self.client)
+        self.since = int(time.time())
+        self.stack.start()
+
+    def test_healthcheck_and_http_probe(self):
+        monitor = ReadinessMonitor.from_config(self.stack, {
+            "services": {"app": {"http": {"port": self.app.port, "path": "/ping"}}}
+        }, client=self.client)
+        monitor.probe_interval = 0.05
+        later(0.3, self.fake.set_health, "ghost_abc_db_1", "healthy")
+        later(0.5, setattr, self.app, "ready", True)
+
+        ready_times = monitor.wait(since=self.since)
+
+        assert set(ready_times) == {"ghost_source_data", "db", "ghost_app"}
+        assert ready_times["db"] >= 0.3
+        assert ready_times["ghost_app"] >= 0.5
+        assert ready_times["ghost_source_data"] < 0.3
+
+    def test_log_line(self):
+        self.fake.set_health("ghost_abc_db_1", "healthy")
+        monitor = ReadinessMonitor.from_config(self.stack, {
+            "services": {"db": {"log": r"ready for connections\. port: \d+"}}
+        }, client=self.client)
+        self.fake.add_log("ghost_abc_db_1", "Initializing database")
+        later(0.3, self.fake.add_log, "ghost_abc_db_1", "mysqld: ready for connections. port: 3306")
+
+        assert monitor.wait(since=self.since)["db"] >= 0.3
+
+    def test_timeout(self):
+        monitor = ReadinessMonitor.from_config(self.stack, {"timeout": 0.5}, client=self.client)
+        started = time.monotonic()
+        with self.assertRaises(ReadinessError) as context:
+            monitor.wait(since=self.since)
+        assert "db to become healthy" in str(context.exception)
+        assert time.monotonic() - started < 2
+
+    def test_exit_without_restart_fails_fast(self):
+        self.fake.set_health("ghost_abc_db_1", "healthy")
+        container = "ghost_abc_ghost_source_data_1"
+        monitor = ReadinessMonitor(self.client, self.stack.project, [ServiceCheck("ghost_source_data", container, tcp=1)],
+                                   timeout=30, probe_interval=0.05)
+        later(0.2, self.fake.exit, container, 1)
+        started = time.monotonic()
+        with self.assertRaises(ReadinessError) as context:
+            monitor.wait(since=self.since)
+        assert "exited with code 1" in str(context.exception)
+        assert time.monotonic() - started < 5
+
+    def test_unknown_service(self):
+        with self.assertRaises(ValueError):
+            ReadinessMonitor.from_config(self.stack, {"services": {"cache": {"tcp": 6379}}}, client=self.client)
+
+    def test_warm_up(self):
+        self.app.ready = True
+        latencies = warm_up("127.0.0.1", self.app.port, requests=10, concurrency=3)
+        assert len(latencies) == 10
+        assert self.app.hits == 10
+
+    def test_warm_up_logs_the_first_request(self):
+        self.app.ready = True
+        with self.assertLogs("shippy.readiness", level="INFO") as logs:
+            warm_up("127.0.0.1", self.app.port, requests=4, concurrency=2)
+        assert "4/4 requests, first request 0." in logs.output[-1]
@@ -1,5 +1,13 @@
 import unittest
+import os
+import tempfile
+import shutil
+from unittest import mock
+from shippy.cache import ArchiveCache
+from shippy.downloader import Downloader
 from shippy.repository_archive import RepositoryArchive
+from extractor_tests import make_tarball
+from fake_github import FakeGithubServer
 
 
 class TestRepositoryArchive(unittest.TestCase):
@@ -13,5 +21,67 @@ class TestRepositoryArchive(unittest.TestCase):
         assert self.repo.get_archive_url(self.sha) == "https://api.github.com/repos/codesplicer/shippy/tarball/1234abcd"
 
     def test_fetch(self):
-        # Need to mock requests, test that it hits the right URL
-        pass
+        data = os.urandom(64 * 1024)
+        with FakeGithubServer({"/repos/codesplicer/shippy/tarball/1234abcd": data}) as server, \
+                mock.patch("shippy.repository_archive.GITHUB_API_BASEURL", server.base_url):
+            tmpdir = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, tmpdir)
+            repo = RepositoryArchive(self.repo_url, downloader=Downloader(backoff=0, progress=False))
+            path = repo.fetch(self.sha, download_path=tmpdir)
+
+            assert path == os.path.join(tmpdir, "shippy.tar.gz")
+            assert [request["path"] for request in server.requests] == ["/repos/codesplicer/shippy/tarball/1234abcd"]
+        with open(path, "rb") as f:
+            assert f.read() == data
+
+
+class TestRepositoryArchiveStreaming(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.tmpdir, "shippy")
+        self.sha = "1234abcd"
+        self.data = make_tarball([
+            ("codesplicer-shippy-1234abcd/", "dir", None, 0o755),
+            ("codesplicer-shippy-1234abcd/setup.py", "file", os.urandom(100 * 1024), 0o644),
+        ]).getvalue()
+        self.server = FakeGithubServer({"/repos/codesplicer/shippy/tarball/1234abcd": self.data}, chunk_size=1024).start()
+        self.patcher = mock.patch("shippy.repository_archive.GITHUB_API_BASEURL", self.server.base_url)
+        self.patcher.start()
+        self.repo = RepositoryArchive("https://github.com/codesplicer/shippy", downloader=Downloader(backoff=0, progress=False))
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_fetch_extract(self):
+        self.server.disconnects = [20 * 1024]
+        self.repo.fetch_extract(self.sha, self.output_dir)
+
+        assert os.path.getsize(os.path.join(self.output_dir, "setup.py")) == 100 * 1024
+        assert len(self.server.requests) == 2
+        assert not [name for name in os.listdir(self.tmpdir) if name.endswith(".tar.gz")]
+
+    def test_fetch_extract_populates_cache(self):
+        cache = ArchiveCache(os.path.join(self.tmpdir, "cache"), max_size=10 * 1024 * 1024)
+        self.repo.fetch_extract(self.sha, self.output_dir, cache=cache)
+        shutil.rmtree(self.output_dir)
+        self.repo.fetch_extract(self.sha, self.output_dir, cache=cache)
+
+        assert os.path.getsize(os.path.join(self.output_dir, "setup.py")) == 100 * 1024
+        assert len(self.server.requests) == 1
+
+    def test_failed_fetch_extract_leaves_no_stream_file(self):
+        cache = ArchiveCache(os.path.join(self.tmpdir, "cache"), max_size=10 * 1024 * 1024)
+        with mock.patch("shippy.repository_archive.ArchiveExtractor.extract", side_effect=IOError("disk full")), \
+                self.assertRaises(IOError):
+            self.repo.fetch_extract(self.sha, self.output_dir, cache=cache)
+
+        leftovers = [name for _, _, names in os.walk(cache.root) for name in names if name.endswith(".stream")]
+        assert leftovers == []
+
+    def test_get_parent_sha(self):
+        self.server.add_archive("/repos/codesplicer/shippy/commits/1234abcd", b'{"sha": "1234abcd", "parents": [{"sha": "0000aaaa"}]}')
+        assert self.repo.get_parent_sha(self.sha) == "0000aaaa"
+        assert self.repo.get_parent_sha("missing") is None
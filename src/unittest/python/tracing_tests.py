@@ -0,0 +1,103 @@
+import os
+import json
+import pstats
+import tempfile
+import unittest
+from unittest import mock
+from shippy import tracing
+from shippy.deployment import Deployment
+from shippy.tracing import Tracer
+
+
+class TestTracer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def test_nested_spans(self):
+        tracer = Tracer()
+        with tracer.span("fetch", app="ghost", sha="abc") as stage:
+            with tracing.span("download") as child:
+                tracing.count(bytes_downloaded=100)
+                tracing.count(bytes_downloaded=50)
+            tracing.annotate(cache="miss")
+
+        assert child.parent is stage and child.trace_id == stage.trace_id
+        assert child.path == "fetch.download"
+        assert child.attributes == {"bytes_downloaded": 150}
+        assert child.labels() == {"app": "ghost", "sha": "abc", "cache": "miss"}
+        assert stage.attributes["cache"] == "miss"
+        assert [span.path for span in tracer.spans] == ["fetch.download", "fetch"]
+        assert stage.duration >= child.duration
+
+    def test_module_functions_without_a_span(self):
+        with tracing.span("download") as span:
+            tracing.count(bytes_downloaded=1)
+        assert span is None
+        assert tracing.current_span() is None
+
+    def test_failed_span(self):
+        tracer = Tracer()
+        with self.assertRaises(SystemExit):
+            with tracer.span("build"):
+                raise SystemExit(1)
+        assert tracer.spans[0].status == "error"
+        assert tracer.spans[0].error == "SystemExit: 1"
+
+    def test_prometheus_metrics(self):
+        tracer = Tracer()
+        for command in ("npm install", "npm install"):
+            with tracer.span("build", app="ghost", sha="abc"):
+                with tracing.span("command", command=command):
+                    tracing.count(files=2)
+
+        lines = tracer.prometheus_metrics().splitlines()
+        assert "# TYPE shippy_span_duration_seconds gauge" in lines
+        assert ('shippy_span_files{app="ghost",command="npm install",sha="abc",span="build.command",status="ok"} 4'
+                in lines)
+        assert len([line for line in lines if line.startswith("shippy_span_duration_seconds")]) == 2
+
+    def test_export(self):
+        jsonl_path = os.path.join(self.tmpdir.name, "spans", "spans.jsonl")
+        prometheus_path = os.path.join(self.tmpdir.name, "shippy.prom")
+        tracer = Tracer.from_config({"tracing": {"jsonl_path": jsonl_path, "prometheus_path": prometheus_path}})
+        with tracer.span("fetch"):
+            pass
+        tracer.export()
+        tracer.export()
+
+        with open(jsonl_path) as f:
+            records = [json.loads(line) for line in f]
+        assert [record["name"] for record in records] == ["fetch", "fetch"]
+        assert records[0]["parent_id"] is None
+        with open(prometheus_path) as f:
+            assert 'shippy_span_duration_seconds{span="fetch",status="ok"}' in f.read()
+
+    def test_deployment_stages_are_profiled(self):
+        config = {
+            "app_name": "ghost",
+            "application_repository": "https://github.com/tryghost/ghost",
+            "application_image": "tryghost/ghost",
+            "application_config": {},
+            "database_image": "mysql",
+            "database_config": {}
+        }
+        profile_dir = os.path.join(self.tmpdir.name, "profiles")
+        tracer = Tracer(profile_dir=profile_dir)
+        deployment = Deployment(config, "abc", "config.js", workspace=self.tmpdir.name, tracer=tracer)
+
+        download_path = os.path.join(self.tmpdir.name, "ghost.tar.gz")
+        open(download_path, "w").close()
+
+        def fetch(deployment):
+            deployment.download_path = download_path
+            tracing.count(bytes_downloaded=10)
+
+        with mock.patch.object(Deployment, "fetch", fetch):
+            deployment.run_stage("fetch")
+
+        assert tracer.spans[0].path == "fetch"
+        assert tracer.spans[0].attributes == {"app": "ghost", "sha": "abc", "bytes_downloaded": 10}
+        stats = pstats.Stats(os.path.join(profile_dir, "ghost_abc.fetch.pstats"))
+        assert stats.total_calls > 0
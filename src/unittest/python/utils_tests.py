@@ -1,7 +1,10 @@
 import unittest
 import os
+import tempfile
+import shutil
 from shippy import utils
 from unittest import mock
+from extractor_tests import make_tarball
 
 class TestUtils(unittest.TestCase):
 
@@ -40,3 +43,26 @@ class TestUtils(unittest.TestCase):
 
     def test_get_repository_appname(self):
         assert utils.get_repository_appname(self.repo_url) == "shippy"
+
+    def test_unpack_archive(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            archive_path = os.path.join(tmpdir, "shippy.tar.gz")
+            with open(archive_path, "wb") as f:
+                f.write(make_tarball([("codesplicer-shippy-1234abcd/setup.py", "file", b"setup", 0o644)]).getvalue())
+            output_dir = utils.unpack_archive(archive_path, "shippy", working_dir=tmpdir)
+            assert output_dir == os.path.join(tmpdir, "shippy")
+            assert os.path.exists(os.path.join(output_dir, "setup.py"))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_unpack_invalid_archive(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            archive_path = os.path.join(tmpdir, "shippy.tar.gz")
+            with open(archive_path, "wb") as f:
+                f.write(b"not a tarball")
+            with self.assertRaises(SystemExit):
+                utils.unpack_archive(archive_path, "shippy", working_dir=tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)